@@ -28,9 +28,10 @@ def index(related_key: str):
 
 
 @app.get("/target/audio/recognize")
-def recognize_target_audio(audio_id: str, related_key: str, local_audio_path: str):
+def recognize_target_audio(audio_id: str, related_key: str, local_audio_path: str, start: float = None,
+                           end: float = None):
 
-    FileRecognizer(djv).recognize_file(local_audio_path, related_key, audio_id)
+    FileRecognizer(djv).recognize_file(local_audio_path, related_key, audio_id, start=start, end=end)
     return {"success": True, "code": 0, "msg": "ok"}
 
 
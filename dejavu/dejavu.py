@@ -45,9 +45,30 @@ if __name__ == '__main__':
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
                              '--recognize file path/to/file \n')
+    parser.add_argument('-m', '--migrate-hashes', nargs='?', type=int, const=100, metavar='BATCH_SIZE',
+                        help='Convert the BYTEA fingerprint hashes of a postgres catalog\n'
+                             'to BIGINT, committing every BATCH_SIZE audios (100 by default).\n'
+                             'The configured database_type must be postgres_bigint.\n'
+                             'Usage: \n'
+                             '--migrate-hashes [batch_size] \n')
+    parser.add_argument('-b', '--build-index', metavar='PATH',
+                        help='Export the fingerprints table of a postgres catalog to an\n'
+                             'index file, to be set as the index_file of the configuration.\n'
+                             'Usage: \n'
+                             '--build-index /path/to/fingerprints.idx \n')
+    parser.add_argument('-s', '--update-hash-stats', nargs='?', type=int, const=100, metavar='BATCH_SIZE',
+                        help='Count the audios each hash of a postgres catalog is found in,\n'
+                             'for the stop_hashes of the configuration. Only the audios\n'
+                             'fingerprinted since the last update are counted, committing\n'
+                             'every BATCH_SIZE audios (100 by default).\n'
+                             'Usage: \n'
+                             '--update-hash-stats [batch_size] [--full] \n')
+    parser.add_argument('--full', action='store_true',
+                        help='With --update-hash-stats, count every audio again from scratch.\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if not args.fingerprint and not args.recognize and args.migrate_hashes is None and not args.build_index \
+            and args.update_hash_stats is None:
         parser.print_help()
         sys.exit(0)
 
@@ -82,3 +103,24 @@ if __name__ == '__main__':
         elif source == 'file':
             audios = djv.recognize(FileRecognizer, opt_arg)
         print(audios)
+
+    elif args.migrate_hashes is not None:
+        if not hasattr(djv.db, "migrate_hashes"):
+            print(f"The {djv.db.type} database has no hashes to migrate, use the postgres_bigint database_type.")
+            sys.exit(1)
+        converted = djv.db.migrate_hashes(args.migrate_hashes)
+        print(f"Converted {converted} fingerprints")
+
+    elif args.build_index:
+        if not hasattr(djv.db, "export_index_file"):
+            print(f"Index files can't be built from a {djv.db.type} database, use a postgres database_type.")
+            sys.exit(1)
+        exported = djv.db.export_index_file(args.build_index)
+        print(f"Exported {exported} fingerprints to {args.build_index}")
+
+    elif args.update_hash_stats is not None:
+        if not hasattr(djv.db, "update_hash_stats"):
+            print(f"The {djv.db.type} database keeps no hash statistics, use a postgres database_type.")
+            sys.exit(1)
+        counted = djv.db.update_hash_stats(args.update_hash_stats, args.full)
+        print(f"Counted the hashes of {counted} audios")
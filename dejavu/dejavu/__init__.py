@@ -3,9 +3,11 @@ import os
 import sys
 import traceback
 import uuid
-from itertools import groupby
 from time import time
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
 import dejavu.logic.decoder as decoder
 from dejavu.base_classes.base_database import get_database
 from dejavu.base_classes.matched_information import Matched_Information
@@ -29,8 +31,13 @@ from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
                                     FIELD_RELATED_AUDIOS_HASHES_MATCHED_IN_PUT, FIELD_RELATED_AUDIOS_INPUT_CONFIDENCE,
                                     FIELD_RELATED_AUDIOS_FINGERPRINTED_CONFIDENCE, FIELD_RELATED_AUDIOS_OFFSET,
                                     FIELD_RELATED_AUDIOS_OFFSET_SECONDS, FIELD_RELATED_AUDIOS_FILE_SHA1,
-                                    OFFSET_SECS, AUDIO_ID, AUDIO_NAME, TOPN)
-from dejavu.logic.fingerprint import fingerprint
+                                    ANALYSIS_FS, CHANNEL_STRATEGY, FINGERPRINT_HASH_FORMAT, OFFSET_SECS, AUDIO_ID,
+                                    AUDIO_NAME, PARALLEL_FINGERPRINT_MIN_SECONDS, PEAK_DENSITY, TOPN)
+from dejavu.logic.alignment import count_offsets, top_counts
+from dejavu.logic.fingerprint import fingerprint, fingerprint_parallel
+from dejavu.logic.file_manifest import FileManifest
+from dejavu.logic.file_scanner import scan_files
+from dejavu.logic.fingerprint_cache import FingerprintCache
 
 
 class Dejavu:
@@ -43,11 +50,66 @@ class Dejavu:
         self.db = db_cls(**config.get("database", {}))
         # self.db.setup()
 
+        # fingerprint index file built with `dejavu.py --build-index`, fingerprints are looked up in it instead
+        # of the database when given.
+        index_file = self.config.get("index_file", None)
+        if index_file and os.path.exists(index_file):
+            self.db.use_index_file(index_file)
+        elif index_file:
+            print(f"The index file {index_file} doesn't exist, fingerprints are looked up in the database.")
+
+        # Bloom filter over every stored hash, dropping the query hashes absent from the catalog before they are
+        # looked up. Disabled unless configured.
+        filter_config = self.config.get("hash_filter", None)
+        if filter_config:
+            self.db.use_hash_filter(**filter_config)
+
+        # policy for the query hashes found in too many audios (see `dejavu.py --update-hash-stats`), which are
+        # skipped, capped or downweighted. Disabled unless configured.
+        stop_hashes_config = self.config.get("stop_hashes", None)
+        if stop_hashes_config:
+            if not hasattr(self.db, "update_hash_stats"):
+                raise ValueError(f"stop_hashes needs the hash statistics the {self.db.type} database doesn't keep, "
+                                 "use a postgres, postgres_bigint, postgres_memory or postgres_bigint_memory "
+                                 "database_type.")
+            self.db.use_stop_hashes(**stop_hashes_config)
+
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
+
+        # sampling rate audios are analysed at, None means their own rate. Since offsets are measured in
+        # windows of this rate it must be the same at ingest and recognition time.
+        self.analysis_fs = self.config.get("analysis_fs", ANALYSIS_FS)
+
+        # how multi-channel audio is fingerprinted, it must be the same at ingest and recognition time.
+        self.channel_strategy = self.config.get("channel_strategy", CHANNEL_STRATEGY)
+
+        # keyword arguments given to fingerprint(), they must be the same at ingest and recognition time.
+        self.fingerprint_options = {
+            "hash_format": self.config.get("hash_format", FINGERPRINT_HASH_FORMAT),
+            "peak_density": self.config.get("peak_density", PEAK_DENSITY)
+        }
+
+        # local cache of already computed fingerprints, disabled unless configured.
+        cache_config = self.config.get("fingerprint_cache", None)
+        self.fingerprint_cache = FingerprintCache(**cache_config) if cache_config else None
+
+        # channels at least this long (in seconds) are fingerprinted in a process pool when fingerprinting a
+        # single file or recognizing, None disables it.
+        self.parallel_min_seconds = self.config.get("parallel_fingerprint_min_seconds",
+                                                    PARALLEL_FINGERPRINT_MIN_SECONDS)
+
+        # whether the database counts the offset differences of the matches itself, returning only the best
+        # candidates of each audio instead of every matching row.
+        self.match_aggregation = self.config.get("match_aggregation", False)
+
+        # manifest of already hashed files, so rescans only hash new or modified files. Disabled unless configured.
+        manifest_path = self.config.get("file_manifest", None)
+        self.file_manifest = FileManifest(manifest_path) if manifest_path else None
+
         self.__load_fingerprinted_audio_hashes()
 
     def __load_fingerprinted_audio_hashes(self) -> None:
@@ -96,40 +158,50 @@ class Dejavu:
 
         pool = multiprocessing.Pool(nprocesses)
 
-        filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
-            # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.audiohashes_set:
-                print(f"{filename} already fingerprinted, continuing...")
-                continue
-
-            filenames_to_fingerprint.append(filename)
-
         # Prepare _fingerprint_worker input
-        worker_input = list(zip(filenames_to_fingerprint, [self.limit] * len(filenames_to_fingerprint)))
+        worker_options = self.get_fingerprint_parameters()
+        worker_options["fingerprint_cache"] = self.fingerprint_cache
+
+        def worker_input():
+            # files are hashed while the tree is walked and sent to the workers as soon as they are known to
+            # be new, the pool consumes this generator from its own thread.
+            dispatched = set()
+            for filename, file_hash in scan_files(path, extensions, manifest=self.file_manifest):
+                # don't refingerprint already fingerprinted files, nor copies of the same file
+                if file_hash in self.audiohashes_set or file_hash in dispatched:
+                    print(f"{filename} already fingerprinted, continuing...")
+                    continue
+
+                dispatched.add(file_hash)
+                yield filename, worker_options
 
         # Send off our tasks
-        iterator = pool.imap_unordered(Dejavu._fingerprint_worker, worker_input)
+        iterator = pool.imap_unordered(Dejavu._fingerprint_worker, worker_input())
 
         # Loop till we have all of them
-        while True:
-            try:
-                audio_name, hashes, file_hash = next(iterator)
-            except multiprocessing.TimeoutError:
-                continue
-            except StopIteration:
-                break
-            except Exception:
-                print("Failed fingerprinting")
-                # Print traceback because we can't reraise it here
-                traceback.print_exc(file=sys.stdout)
-            else:
-                audio_id = uuid.uuid1().hex
-                sid = self.db.insert_audios(audio_id, audio_name, file_hash, len(hashes))
-
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_audio_fingerprinted(sid)
-                self.__load_fingerprinted_audio_hashes()
+        try:
+            while True:
+                try:
+                    audio_name, hashes, file_hash = next(iterator)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                except Exception:
+                    print("Failed fingerprinting")
+                    # Print traceback because we can't reraise it here
+                    traceback.print_exc(file=sys.stdout)
+                else:
+                    audio_id = uuid.uuid1().hex
+                    sid = self.db.insert_audios(audio_id, audio_name, file_hash, len(hashes))
+
+                    self.db.insert_hashes(sid, hashes)
+                    self.db.set_audio_fingerprinted(sid)
+                    # reloading every audio after each file is quadratic on big trees.
+                    self.audiohashes_set.add(file_hash)
+        finally:
+            # the hashes inserted since the last periodic save must reach the saved hash filter.
+            self.db.flush_hash_filter()
 
         pool.close()
         pool.join()
@@ -143,25 +215,58 @@ class Dejavu:
         :param audio_name: audio name associated to the audio file.
         """
         audio_name_from_path = decoder.get_audio_name_from_path(file_path)
-        audio_hash = decoder.unique_hash(file_path)
         audio_name = audio_name or audio_name_from_path
+
+        # the hash of the file is only known beforehand if the manifest or the cache recorded it, otherwise it
+        # comes from the same read that decodes the file.
+        stat = os.stat(file_path)
+        audio_hash = self.file_manifest.get(file_path, stat) if self.file_manifest else None
+        if audio_hash is None and self.fingerprint_cache:
+            digests = self.fingerprint_cache.get_digests(file_path, stat)
+            audio_hash = digests[0] if digests else None
+
         # don't refingerprint already fingerprinted files
         if audio_hash in self.audiohashes_set:
             print(f"{audio_name} already fingerprinted, continuing...")
-        else:
-            audio_name, hashes, file_hash = Dejavu._fingerprint_worker(
-                file_path,
-                self.limit,
-                audio_name=audio_name
-            )
-            audio_id = uuid.uuid1().hex
-            sid = self.db.insert_audios(audio_id, audio_name, file_hash)
-
-            self.db.insert_hashes(sid, hashes)
-            self.db.set_audio_fingerprinted(sid)
-            self.__load_fingerprinted_audio_hashes()
-
-    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[str, int]], float]:
+            return
+
+        worker_options = self.get_fingerprint_parameters()
+        worker_options["fingerprint_cache"] = self.fingerprint_cache
+        worker_options["parallel_min_seconds"] = self.parallel_min_seconds
+        audio_name, hashes, file_hash = Dejavu._fingerprint_worker(
+            (file_path, worker_options),
+            audio_name=audio_name
+        )
+        if self.file_manifest:
+            self.file_manifest.put(file_path, file_hash, stat)
+            self.file_manifest.commit()
+        if file_hash in self.audiohashes_set:
+            print(f"{audio_name} already fingerprinted, continuing...")
+            return
+
+        audio_id = uuid.uuid1().hex
+        sid = self.db.insert_audios(audio_id, audio_name, file_hash, len(hashes))
+
+        self.db.insert_hashes(sid, hashes)
+        self.db.flush_hash_filter()
+        self.db.set_audio_fingerprinted(sid)
+        self.__load_fingerprinted_audio_hashes()
+
+    def get_fingerprint_parameters(self) -> Dict[str, any]:
+        """
+        Every parameter used to decode and fingerprint audio files, which must be the same at ingest and
+        at recognition time.
+
+        :return: a dictionary with the keyword arguments of get_file_fingerprints.
+        """
+        return {
+            "limit": self.limit,
+            "analysis_fs": self.analysis_fs,
+            "channel_strategy": self.channel_strategy,
+            "fingerprint_options": self.fingerprint_options
+        }
+
+    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[any, int]], float]:
         f"""
         Generate the fingerprints for the given sample data (channel).
 
@@ -170,21 +275,28 @@ class Dejavu:
         :return: a list of tuples for hash and its corresponding offset, together with the generation time.
         """
         t = time()
-        hashes = fingerprint(samples, Fs=Fs)
+        hashes = Dejavu._fingerprint_channel(samples, Fs, self.fingerprint_options, self.parallel_min_seconds)
         fingerprint_time = time() - t
         return hashes, fingerprint_time
 
-    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+    def find_matches(self, hashes: List[Tuple[str, int]]) \
+            -> Tuple[Union[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]], List[Tuple[str, int, int]]],
+                     Dict[str, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
 
         :param hashes: list of tuples for hashes and their corresponding offsets
-        :return: a tuple containing the matches found against the db, a dictionary which counts the different
-         hashes matched for each audio (with the audio id as key), and the time that the query took.
+        :return: a tuple containing the matches found against the db, as (audio_indexes, offset_differences,
+         weights) arrays, a dictionary which counts the different hashes matched for each audio (with the audio
+         id as key), and the time that the query took. With match_aggregation the matches are
+         (audio_id, offset_difference, count) candidates counted by the db.
 
         """
         t = time()
-        matches, dedup_hashes = self.db.return_matches(hashes)
+        if self.match_aggregation:
+            matches, dedup_hashes = self.db.return_aligned_matches(hashes)
+        else:
+            matches, dedup_hashes = self.db.return_matches(hashes)
         query_time = time() - t
 
         return matches, dedup_hashes, query_time
@@ -253,34 +365,48 @@ class Dejavu:
             source_audios.append(source_audio)
         return source_audios
 
-    def align_matches(self, matches: List[Tuple[int, int]], dedup_hashes: Dict[str, int], queried_hashes: int,
-                      topn: int = TOPN) -> List[Dict[str, any]]:
+    def align_matches(self, matches: Union[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]],
+                                           List[Tuple[str, int, int]]],
+                      dedup_hashes: Dict[str, int], queried_hashes: int, topn: int = TOPN) -> List[Dict[str, any]]:
         """
         Finds hash matches that align in time with other matches and finds
         consensus about which hashes are "true" signal from the audio.
 
-        :param matches: matches from the database
+        :param matches: matches from the database, (audio_indexes, offset_differences, weights) arrays, or
+        (audio_id, offset_difference, count) candidates grouped by audio with match_aggregation.
         :param dedup_hashes: dictionary containing the hashes matched without duplicates for each audio
         (key is the audio id).
         :param queried_hashes: amount of hashes sent for matching against the db
         :param topn: number of results being returned back.
         :return: a list of dictionaries (based on topn) with match information.
         """
-        # count offset occurrences per audio and keep only the maximum ones.
-        sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
-        counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
-        audios_matches = sorted(
-            [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
-            key=lambda count: count[2], reverse=True
-        )
+        if self.match_aggregation:
+            # the db already counted the offsets, its candidates come best first within each audio.
+            best = {}
+            for audio_id, offset, count in matches:
+                if audio_id not in best or count > best[audio_id][2]:
+                    best[audio_id] = (audio_id, offset, count)
+            audios_matches = sorted(best.values(), key=lambda count: count[2], reverse=True)
+        else:
+            # count offset occurrences per audio and keep only the maximum ones.
+            audio_indexes, offsets, weights = matches
+            audio_indexes, offsets, counts = count_offsets(audio_indexes, offsets, weights=weights)
+            audios_matches = [(self.db.audio_ids[audio_indexes[i]], int(offsets[i]), counts[i].item())
+                              for i in top_counts(counts, topn)]
+
+        # offsets are measured in windows of the analysis sampling rate
+        fs = self.analysis_fs or DEFAULT_FS
+
+        # a single query for the audios not cached yet.
+        audios = self.db.get_audios_by_ids([audio_id for audio_id, _, _ in audios_matches[0:topn]])
 
         audios_result = []
         for audio_id, offset, _ in audios_matches[0:topn]:  # consider topn elements in the result
-            audio = self.db.get_audio_by_id(audio_id)
+            audio = audios[audio_id]
 
             audio_name = audio.get(AUDIO_NAME, None)
             audio_hashes = audio.get(FIELD_TOTAL_HASHES, None)
-            nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
+            nseconds = round(float(offset) / fs * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
             hashes_matched = dedup_hashes[audio_id]
 
             audio_result = {
@@ -305,34 +431,67 @@ class Dejavu:
         return r.recognize(*options, **kwoptions)
 
     @staticmethod
-    def _fingerprint_worker(arguments):
+    def _fingerprint_worker(arguments, audio_name: str = None):
         # Pool.imap sends arguments as tuples so we have to unpack
         # them ourself.
-        try:
-            file_name, limit = arguments
-        except ValueError:
-            pass
+        file_name, options = arguments
 
-        audio_name = os.path.basename(file_name)
+        audio_name = audio_name or os.path.basename(file_name)
 
-        fingerprints, file_hash = Dejavu.get_file_fingerprints(file_name, limit, print_output=True)
+        fingerprints, file_hash = Dejavu.get_file_fingerprints(file_name, print_output=True, **options)
 
         return audio_name, fingerprints, file_hash
 
     @staticmethod
-    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False):
-        channels, fs, file_hash = decoder.read(file_name, limit)
+    def get_file_fingerprints(file_name: str, limit: int, print_output: bool = False, analysis_fs: int = ANALYSIS_FS,
+                              channel_strategy: str = CHANNEL_STRATEGY, fingerprint_options: Dict[str, any] = None,
+                              fingerprint_cache: FingerprintCache = None, parallel_min_seconds: float = None):
+        fingerprint_options = fingerprint_options or {}
+        t = time()
+
+        cache_parameters = dict(limit=limit, analysis_fs=analysis_fs, channel_strategy=channel_strategy,
+                                **fingerprint_options)
+        if fingerprint_cache:
+            # files whose digests are unknown are a miss, they are hashed by the read that decodes them.
+            stat = os.stat(file_name)
+            digests = fingerprint_cache.get_digests(file_name, stat)
+            if digests:
+                file_hash = digests[0]
+                cached = fingerprint_cache.get(fingerprint_cache.key(file_hash, **cache_parameters))
+                if cached is not None:
+                    if print_output:
+                        print(f"Loaded {len(cached)} cached hashes for {file_name}")
+                    return set(cached), file_hash
+
+        channels, fs, file_hash, file_md5 = decoder.read_hashed(file_name, limit, fs=analysis_fs)
+        channels = decoder.select_channels(channels, channel_strategy)
         fingerprints = set()
         channel_amount = len(channels)
         for channeln, channel in enumerate(channels, start=1):
             if print_output:
                 print(f"Fingerprinting channel {channeln}/{channel_amount} for {file_name}")
 
-            hashes = fingerprint(channel, Fs=fs)
+            hashes = Dejavu._fingerprint_channel(channel, fs, fingerprint_options, parallel_min_seconds)
 
             if print_output:
                 print(f"Finished channel {channeln}/{channel_amount} for {file_name}")
 
             fingerprints |= set(hashes)
 
+        if print_output:
+            print(f"Fingerprinted {file_name} with channel strategy {channel_strategy}: "
+                  f"{len(fingerprints)} hashes in {round(time() - t, 3)} seconds")
+
+        if fingerprint_cache:
+            fingerprint_cache.put_digests(file_name, file_hash, file_md5, stat)
+            fingerprint_cache.put(fingerprint_cache.key(file_hash, **cache_parameters), fingerprints)
+
         return fingerprints, file_hash
+
+    @staticmethod
+    def _fingerprint_channel(channel: List[int], fs: int, fingerprint_options: Dict[str, any],
+                             parallel_min_seconds: float = None) -> List[Tuple[any, int]]:
+        # long channels are split in segments fingerprinted in a process pool, the hashes are the same.
+        if parallel_min_seconds is not None and len(channel) >= parallel_min_seconds * fs:
+            return fingerprint_parallel(channel, Fs=fs, **fingerprint_options)
+        return fingerprint(channel, Fs=fs, **fingerprint_options)
@@ -1,8 +1,10 @@
 import abc
 import importlib
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from dejavu.config.settings import DATABASES
+import numpy as np
+
+from dejavu.config.settings import DATABASES, MATCH_CANDIDATES_PER_AUDIO
 
 
 class BaseDatabase(object, metaclass=abc.ABCMeta):
@@ -27,6 +29,28 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def pool_stats(self) -> Dict[str, float]:
+        """
+        Returns the usage statistics of the connection pool of the current process.
+
+        :return: a dictionary with the statistics, empty if the database has no pool.
+        """
+        return {}
+
+    def hash_filter_stats(self) -> Dict[str, float]:
+        """
+        Returns the statistics of the hash filter dropping query hashes absent from the catalog.
+
+        :return: a dictionary with the statistics, empty if no filter is used.
+        """
+        return {}
+
+    def flush_hash_filter(self) -> None:
+        """
+        Called once fingerprints are done being inserted, saves the hashes added to the hash filter, if any.
+        """
+        pass
+
     def setup(self) -> None:
         """
         Called on creation or shortly afterwards.
@@ -139,6 +163,17 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_audios_by_ids(self, audio_ids: List[str], batch_size: int = 1000) -> Dict[str, Dict[str, str]]:
+        """
+        Brings the info of several audios from the database.
+
+        :param audio_ids: audio identifiers.
+        :param batch_size: number of query's batches.
+        :return: a dictionary with the audios found by their identifier.
+        """
+        pass
+
     @abc.abstractmethod
     def insert(self, fingerprint: str, audio_id: int, offset: int):
         """
@@ -202,26 +237,43 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
 
         :param audio_id: Song identifier the fingerprints belong to
         :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed 64-bit integer hash
             - offset: Offset this hash was created from/at.
         :param batch_size: insert batches.
         """
 
     @abc.abstractmethod
     def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
-            -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+            -> Tuple[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]], Dict[str, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
         :param hashes: A sequence of tuples in the format (hash, offset)
-            - hash: Part of a sha1 hash, in hexadecimal format
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed 64-bit integer hash
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :return: the matches as a tuple of two int32 arrays, with a row per match, plus their weights, and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each audio.
-            - audio id: Song identifier
+            - audio index: dense index of the audio id, see CommonDatabase.audio_index
             - offset_difference: (database_offset - sampled_offset)
+            - weight: what the match counts when aligning, None unless stop hashes are downweighted.
+        """
+        pass
+
+    @abc.abstractmethod
+    def return_aligned_matches(self, hashes: List[Tuple[str, int]], candidates: int = MATCH_CANDIDATES_PER_AUDIO) \
+            -> Tuple[List[Tuple[int, int, int]], Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and counts, for each audio, how many of them
+        match at each offset difference.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed 64-bit integer hash
+            - offset: Offset this hash was created from/at.
+        :param candidates: number of offset differences returned per audio, the most matched ones.
+        :return: a list of (sid, offset_difference, count) tuples and a dictionary with the amount of hashes
+        matched (not considering duplicated hashes) in each audio, just like return_matches.
         """
         pass
 
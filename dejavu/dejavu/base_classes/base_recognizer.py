@@ -1,10 +1,11 @@
 import abc
 from time import time
-from typing import Dict, List, Tuple
+from typing import Dict, List, Set, Tuple
 
 import numpy as np
 
 from dejavu.config.settings import DEFAULT_FS
+from dejavu.logic.decoder import resample, select_channels
 
 
 class BaseRecognizer(object, metaclass=abc.ABCMeta):
@@ -13,20 +14,33 @@ class BaseRecognizer(object, metaclass=abc.ABCMeta):
         self.Fs = DEFAULT_FS
 
     def _recognize(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
+        hashes, fingerprint_time = self._fingerprint(*data)
+        final_results, query_time, align_time = self._match(hashes)
+        return final_results, fingerprint_time, query_time, align_time
+
+    def _fingerprint(self, *data) -> Tuple[Set[Tuple[any, int]], float]:
         fingerprint_times = []
+        # recorded audio comes at its own rate, it is analysed at the same rate the db was fingerprinted with.
+        if self.dejavu.analysis_fs and self.Fs != self.dejavu.analysis_fs:
+            data = resample(data, self.Fs, self.dejavu.analysis_fs)
+            self.Fs = self.dejavu.analysis_fs
+
         hashes = set()  # to remove possible duplicated fingerprints we built a set.
-        for channel in data:
+        for channel in select_channels(data, self.dejavu.channel_strategy):
             fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=self.Fs)
             fingerprint_times.append(fingerprint_time)
             hashes |= set(fingerprints)
 
+        return hashes, np.sum(fingerprint_times)
+
+    def _match(self, hashes: Set[Tuple[any, int]]) -> Tuple[List[Dict[str, any]], float, float]:
         matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
 
         t = time()
         final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
         align_time = time() - t
 
-        return final_results, np.sum(fingerprint_times), query_time, align_time
+        return final_results, query_time, align_time
 
     @abc.abstractmethod
     def recognize(self) -> Dict[str, any]:
@@ -1,7 +1,22 @@
 import abc
-from typing import Dict, List, Tuple
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
 
 from dejavu.base_classes.base_database import BaseDatabase
+from dejavu.config.settings import (FIELD_AUDIO_ID,
+                                    HASH_FILTER_CAPACITY_FACTOR,
+                                    HASH_FILTER_FALSE_POSITIVE_RATE,
+                                    HASH_FILTER_MIN_CAPACITY,
+                                    HASH_FILTER_SAVE_INTERVAL,
+                                    MATCH_CANDIDATES_PER_AUDIO, STOP_HASH_CAP,
+                                    STOP_HASH_MAX_DF, STOP_HASH_POLICY)
+from dejavu.logic.alignment import count_offsets
+from dejavu.logic.hash_filter import BloomFilter
+from dejavu.logic.index_file import IndexFile
+from dejavu.logic.stop_hashes import StopHashes, cap_postings
 
 
 class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
@@ -11,6 +26,26 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
     def __init__(self):
         super().__init__()
+        # metadata of the audios already read, by audio id. It lives in the process, insert_audios,
+        # set_audio_fingerprinted and delete_audios_by_id drop the entries they change.
+        self.audio_cache = {}
+        # dense index of every audio id seen, see audio_index. Indexes are never reused, the lock keeps threads
+        # sharing the instance from giving the same index to two audios.
+        self.audio_indexes = {}
+        self.audio_ids = []
+        self._audio_index_lock = threading.Lock()
+        # fingerprint lookups are answered by this index file instead of the fingerprints table when set, see
+        # use_index_file.
+        self.index_file = None
+        self._index_file_audios = None
+        # Bloom filter dropping the query hashes surely absent from the catalog when set, see use_hash_filter.
+        self.hash_filter = None
+        self.hash_filter_path = None
+        self.hash_filter_save_interval = HASH_FILTER_SAVE_INTERVAL
+        self._hash_filter_mtime = None
+        self._hash_filter_unsaved = 0
+        # hashes found in too many audios and how to look them up, see use_stop_hashes.
+        self.stop_hashes = None
 
     def before_fork(self) -> None:
         """
@@ -24,7 +59,8 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
         This will be called in the new process.
         """
-        pass
+        # a lock held by another thread at fork time would never be released.
+        self._audio_index_lock = threading.Lock()
 
     def setup(self) -> None:
         """
@@ -41,6 +77,10 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         Called when the database should be cleared of all data.
         """
+        self.audio_cache.clear()
+        if self.hash_filter is not None:
+            self.hash_filter.bits[:] = 0
+            self.save_hash_filter()
         with self.cursor() as cur:
 
             cur.execute(self.DROP_RELATED_AUDIOS)
@@ -87,6 +127,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
         :param audio_id: audio identifier.
         """
+        self.audio_cache.pop(audio_id, None)
         with self.cursor() as cur:
             cur.execute(self.UPDATE_AUDIO_FINGERPRINTED, (audio_id,))
 
@@ -98,7 +139,12 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         with self.cursor(dictionary=True) as cur:
             cur.execute(self.SELECT_AUDIOS)
-            return list(cur)
+            audios = list(cur)
+
+        self.audio_cache.update((audio[FIELD_AUDIO_ID], audio) for audio in audios)
+        for audio in audios:
+            self.audio_index(audio[FIELD_AUDIO_ID])
+        return audios
 
     def get_matched_info(self, related_key: str) -> List[Dict[str, any]]:
         """
@@ -153,9 +199,37 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param audio_id: audio identifier.
         :return: a audio by its identifier. Result must be a Dictionary.
         """
-        with self.cursor(dictionary=True) as cur:
-            cur.execute(self.SELECT_AUDIO, (audio_id,))
-            return cur.fetchone()
+        audio = self.audio_cache.get(audio_id)
+        if audio is None:
+            with self.cursor(dictionary=True) as cur:
+                cur.execute(self.SELECT_AUDIO, (audio_id,))
+                audio = cur.fetchone()
+            if audio is not None:
+                self.audio_cache[audio_id] = audio
+        return audio
+
+    def get_audios_by_ids(self, audio_ids: List[str], batch_size: int = 1000) -> Dict[str, Dict[str, str]]:
+        """
+        Brings the info of several audios from the database, only the ones not cached yet are queried.
+
+        :param audio_ids: audio identifiers.
+        :param batch_size: number of query's batches.
+        :return: a dictionary with the audios found by their identifier.
+        """
+        audios = {audio_id: self.audio_cache[audio_id] for audio_id in audio_ids if audio_id in self.audio_cache}
+        missing = [audio_id for audio_id in dict.fromkeys(audio_ids) if audio_id not in audios]
+
+        if missing:
+            with self.cursor(dictionary=True) as cur:
+                for index in range(0, len(missing), batch_size):
+                    # Create our IN part of the query
+                    query = self.SELECT_AUDIOS_BY_IDS % ', '.join(['%s'] * len(missing[index: index + batch_size]))
+
+                    cur.execute(query, missing[index: index + batch_size])
+                    for audio in cur:
+                        audios[audio[FIELD_AUDIO_ID]] = self.audio_cache[audio[FIELD_AUDIO_ID]] = audio
+
+        return audios
 
     def count_matched_audios_by_md5(self, md5: str) -> int:
         """
@@ -178,7 +252,8 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param offset: The offset this fingerprint is from.
         """
         with self.cursor() as cur:
-            cur.execute(self.INSERT_FINGERPRINT, (fingerprint, audio_id, offset))
+            cur.execute(self.INSERT_FINGERPRINT, (audio_id, self.normalize_hash(fingerprint), offset))
+        self.add_to_hash_filter([(fingerprint, offset)])
 
     @abc.abstractmethod
     def insert_audios(self, audio_id: str, audio_name: str, file_hash: str, total_hashes: int) -> int:
@@ -215,7 +290,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         with self.cursor() as cur:
             if fingerprint:
-                cur.execute(self.SELECT, (fingerprint,))
+                cur.execute(self.SELECT, (self.normalize_hash(fingerprint),))
             else:  # select all if no key
                 cur.execute(self.SELECT_ALL)
             return list(cur)
@@ -238,14 +313,15 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
             - offset: Offset this hash was created from/at.
         :param batch_size: insert batches.
         """
-        values = [(audio_id, hsh, int(offset)) for hsh, offset in hashes]
+        values = [(audio_id, self.normalize_hash(hsh), int(offset)) for hsh, offset in hashes]
 
         with self.cursor() as cur:
             for index in range(0, len(hashes), batch_size):
                 cur.executemany(self.INSERT_FINGERPRINT, values[index: index + batch_size])
+        self.add_to_hash_filter(hashes)
 
-    def return_matches(self, hashes: List[Tuple[str, int]],
-                       batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
+            -> Tuple[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]], Dict[str, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
@@ -253,43 +329,318 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
         :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :return: the matches as a tuple of two int32 arrays, with a row per match, plus their weights, and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each audio.
-            - audio id: Song identifier
+            - audio index: dense index of the audio id in the catalog, see audio_index
             - offset_difference: (database_offset - sampled_offset)
+            - weight: what the match counts when aligning, None unless stop hashes are downweighted.
         """
-        # Create a dictionary of hash => offset pairs for later lookups
+        # Create a dictionary of hash => position of its offsets for later lookups
         mapper = {}
         for hsh, offset in hashes:
-            if hsh.upper() in mapper.keys():
-                mapper[hsh.upper()].append(offset)
-            else:
-                mapper[hsh.upper()] = [offset]
+            mapper.setdefault(self.normalize_hash(hsh), []).append(offset)
 
         values = list(mapper.keys())
+        queried = len(values)
+        if self.hash_filter is not None:
+            values = self.filter_hashes(values)
+        passed = len(values)
+
+        # stop hashes go last, so they are looked up apart.
+        stop_dfs = np.zeros(0, dtype=np.int64)
+        if self.stop_hashes is not None:
+            values, stop_dfs = self.split_stop_hashes(values)
+        n_common = len(values) - len(stop_dfs)
+
+        # the sampled offsets of each unique hash, flattened in the order of values.
+        n_sampled = np.array([len(mapper[hsh]) for hsh in values], dtype=np.int64)
+        first_sampled = np.cumsum(n_sampled) - n_sampled
+        flat_sampled = np.fromiter((offset for hsh in values for offset in mapper[hsh]), dtype=np.int64,
+                                   count=int(n_sampled.sum()))
+
+        row_positions, row_audios, row_offsets = self.lookup_hashes(values[:n_common], batch_size)
+        if len(stop_dfs):
+            limit = self.stop_hashes.cap if self.stop_hashes.policy == "cap" else None
+            stop_positions, stop_audios, stop_offsets = self.lookup_hashes(values[n_common:], batch_size, limit)
+            row_positions = np.concatenate((row_positions, stop_positions + n_common))
+            row_audios = np.concatenate((row_audios, stop_audios))
+            row_offsets = np.concatenate((row_offsets, stop_offsets))
+        if self.hash_filter is not None:
+            # skipped stop hashes are in the catalog, they count as found.
+            skipped = passed - len(values)
+            self.hash_filter.record(queried, passed, len(np.unique(row_positions)) + skipped)
+
+        # in order to count each hash only once per db offset we count the rows of each audio.
+        dedup_hashes = {self.audio_ids[index]: int(count)
+                        for index, count in enumerate(np.bincount(row_audios)) if count}
+
+        #  we now evaluate all offset for each hash matched
+        repeats = n_sampled[row_positions]
+        audio_indexes = np.repeat(row_audios, repeats)
+        group_starts = np.repeat(np.cumsum(repeats) - repeats, repeats)
+        sampled = flat_sampled[np.repeat(first_sampled[row_positions], repeats)
+                               + np.arange(len(audio_indexes)) - group_starts]
+        offsets = (np.repeat(row_offsets.astype(np.int64), repeats) - sampled).astype(np.int32)
+
+        weights = None
+        if self.stop_hashes is not None and self.stop_hashes.policy == "downweight":
+            hash_weights = np.r_[np.ones(n_common), self.stop_hashes.weights(stop_dfs)]
+            weights = np.repeat(hash_weights[row_positions], repeats)
+
+        return (audio_indexes, offsets, weights), dedup_hashes
+
+    def return_aligned_matches(self, hashes: List[Tuple[str, int]], candidates: int = MATCH_CANDIDATES_PER_AUDIO) \
+            -> Tuple[List[Tuple[str, int, int]], Dict[str, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and counts, for each audio, how many of them
+        match at each offset difference. The counting is done here, on the rows of return_matches.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+        :param candidates: number of offset differences returned per audio, the most matched ones.
+        :return: a list of (sid, offset_difference, count) tuples and a dictionary with the amount of hashes
+        matched (not considering duplicated hashes) in each audio.
+        """
+        (audio_indexes, offsets, weights), dedup_hashes = self.return_matches(hashes)
+        audio_indexes, offsets, counts = count_offsets(audio_indexes, offsets, candidates, weights)
+
+        results = [(self.audio_ids[index], offset, count)
+                   for index, offset, count in zip(audio_indexes.tolist(), offsets.tolist(), counts.tolist())]
+        return results, dedup_hashes
 
-        # in order to count each hash only once per db offset we use the dic below
-        dedup_hashes = {}
+    def audio_index(self, audio_id: str) -> int:
+        """
+        Dense index of an audio id within this process, matches refer to their audio by it.
 
-        results = []
+        :param audio_id: audio identifier.
+        :return: the index of the audio, audio_ids[index] is its id.
+        """
+        index = self.audio_indexes.get(audio_id)
+        if index is None:
+            with self._audio_index_lock:
+                index = self.audio_indexes.get(audio_id)
+                if index is None:
+                    index = self.audio_indexes[audio_id] = len(self.audio_ids)
+                    self.audio_ids.append(audio_id)
+        return index
+
+    def lookup_hashes(self, values: List[Union[str, int]], batch_size: int = 1000, limit: Optional[int] = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the fingerprints of a set of hashes, in the index file when one is used (see use_index_file) or
+        else in the fingerprints table. return_matches only needs this to be overridden to look hashes up
+        somewhere else.
+
+        :param values: unique hashes, as given by normalize_hash.
+        :param batch_size: number of hashes per query.
+        :param limit: fingerprints fetched per hash at most, all of them when None.
+        :return: a tuple of arrays (positions, audio_indexes, offsets) with a row per fingerprint found, where
+        positions is the index in values of the hash of the fingerprint.
+        """
+        if self.index_file is not None:
+            keys = np.fromiter((hash_to_int(value) for value in values), dtype=np.int64, count=len(values))
+            row_positions, row_audios, row_offsets = self.index_file.lookup(keys)
+            if limit is not None:
+                keep = cap_postings(row_positions, limit)
+                row_positions, row_audios, row_offsets = row_positions[keep], row_audios[keep], row_offsets[keep]
+            return row_positions, self._index_file_audios[row_audios], row_offsets
+
+        positions = {hsh: position for position, hsh in enumerate(values)}
+
+        row_positions, row_audios, row_offsets = [], [], []
         with self.cursor() as cur:
-            for index in range(0, len(values), batch_size):
-                # Create our IN part of the query
-                query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
+            if limit is None:
+                rows = self.select_matches(cur, values, batch_size)
+            else:
+                rows = self.select_limited_matches(cur, values, limit)
+            for hsh, sid, offset in rows:
+                row_positions.append(positions[hsh])
+                row_audios.append(self.audio_index(sid))
+                row_offsets.append(offset)
+
+        return (np.array(row_positions, dtype=np.int64), np.array(row_audios, dtype=np.int32),
+                np.array(row_offsets, dtype=np.int32))
+
+    def select_limited_matches(self, cur, values: List[Union[str, int]], limit: int) -> Iterator[Tuple]:
+        """
+        Looks up the fingerprints of a few hashes, one query per hash fetching up to limit fingerprints.
+
+        :param cur: open cursor.
+        :param values: unique hashes, as given by normalize_hash.
+        :param limit: fingerprints fetched per hash at most.
+        :return: an iterator over the (hash, audio_id, offset) rows found.
+        """
+        for value in values:
+            cur.execute(self.SELECT_LIMITED, (value, limit))
+            yield from cur
+
+    def use_stop_hashes(self, policy: str = STOP_HASH_POLICY, max_df: int = STOP_HASH_MAX_DF,
+                        cap: int = STOP_HASH_CAP) -> None:
+        """
+        Applies a policy to the query hashes found in more than max_df audios according to the hash statistics
+        (see update_hash_stats), read once here: they are skipped, capped to `cap` fingerprints each or
+        downweighted when aligning, see dejavu.logic.stop_hashes.
+
+        :param policy: skip, cap or downweight.
+        :param max_df: number of audios a hash can be found in before it is a stop hash.
+        :param cap: fingerprints fetched per stop hash with the cap policy.
+        """
+        keys, dfs = self.select_stop_hashes(max_df)
+        self.stop_hashes = StopHashes(keys, dfs, policy, max_df, cap)
 
-                cur.execute(query, values[index: index + batch_size])
+    def select_stop_hashes(self, max_df: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the hashes found in more than max_df audios from the hash statistics.
+
+        :param max_df: number of audios a hash can be found in before it is a stop hash.
+        :return: a tuple of arrays (hashes, dfs), hashes as given by hash_to_int.
+        """
+        raise NotImplementedError(f"The {self.type} database keeps no hash statistics.")
+
+    def split_stop_hashes(self, values: List[Union[str, int]]) -> Tuple[List[Union[str, int]], np.ndarray]:
+        """
+        :param values: unique hashes, as given by normalize_hash.
+        :return: the hashes with the stop hashes last, or left out with the skip policy, and the df of each of
+        the stop hashes kept.
+        """
+        keys = np.fromiter((hash_to_int(value) for value in values), dtype=np.int64, count=len(values))
+        stop, dfs = self.stop_hashes.find(keys)
+        common = [value for value, is_stop in zip(values, stop) if not is_stop]
+        if self.stop_hashes.policy == "skip":
+            return common, dfs[:0]
+        return common + [value for value, is_stop in zip(values, stop) if is_stop], dfs[stop]
 
-                for hsh, sid, offset in cur:
-                    if sid not in dedup_hashes.keys():
-                        dedup_hashes[sid] = 1
-                    else:
-                        dedup_hashes[sid] += 1
-                    #  we now evaluate all offset for each  hash matched
-                    for audio_sampled_offset in mapper[hsh]:
-                        results.append((sid, offset - audio_sampled_offset))
+    def use_index_file(self, path: str) -> None:
+        """
+        Looks fingerprints up in an index file (see dejavu.logic.index_file) instead of the fingerprints table.
+        The file is a snapshot, fingerprints inserted after it was built are not found until it is rebuilt.
 
-            return results, dedup_hashes
+        :param path: path of the index file.
+        """
+        index_file = IndexFile(path)
+        self._index_file_audios = np.array([self.audio_index(audio_id) for audio_id in index_file.audio_ids],
+                                           dtype=np.int32)
+        self.index_file = index_file
+
+    def iter_fingerprints(self, batch_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Streams the whole fingerprints table.
+
+        :param batch_size: number of fingerprints of each batch.
+        :return: an iterator over (hashes, audio_indexes, offsets) arrays of up to batch_size fingerprints,
+        hashes as given by hash_to_int and audio indexes as given by audio_index.
+        """
+        raise NotImplementedError(f"The {self.type} database can't stream its fingerprints.")
+
+    def use_hash_filter(self, path: str, false_positive_rate: float = HASH_FILTER_FALSE_POSITIVE_RATE,
+                        save_interval: int = HASH_FILTER_SAVE_INTERVAL) -> None:
+        """
+        Drops the query hashes surely absent from the catalog before looking them up, with a Bloom filter over
+        every stored hash. The filter is read from path, or built from the fingerprints table and saved there
+        when missing. Inserted fingerprints are added to it and it is saved again every save_interval audios
+        and once inserting is done (see flush_hash_filter), other processes merge the saved filter into theirs
+        on their next lookup. Deleted fingerprints stay in the filter, they only let a few more absent hashes
+        through.
+
+        :param path: path of the filter file.
+        :param false_positive_rate: fraction of absent hashes let through, only used when the filter is built.
+        :param save_interval: audios inserted between two saves of the filter.
+        """
+        if os.path.exists(path):
+            hash_filter = BloomFilter.load(path)
+        else:
+            capacity = max(self.get_num_fingerprints() * HASH_FILTER_CAPACITY_FACTOR, HASH_FILTER_MIN_CAPACITY)
+            hash_filter = BloomFilter.for_capacity(capacity, false_positive_rate)
+            for hashes, _, _ in self.iter_fingerprints(HASH_FILTER_MIN_CAPACITY):
+                hash_filter.add(hashes)
+            hash_filter.save(path)
+
+        self.hash_filter = hash_filter
+        self.hash_filter_path = path
+        self.hash_filter_save_interval = save_interval
+        self._hash_filter_mtime = os.stat(path).st_mtime_ns
+        self._hash_filter_unsaved = 0
+
+    def hash_filter_stats(self) -> Dict[str, float]:
+        """
+        :return: the lookups counted by the hash filter of this process, see BloomFilter.stats.
+        """
+        return self.hash_filter.stats() if self.hash_filter is not None else {}
+
+    def filter_hashes(self, values: List[Union[str, int]]) -> List[Union[str, int]]:
+        """
+        :param values: unique hashes, as given by normalize_hash.
+        :return: the hashes the hash filter lets through.
+        """
+        self._merge_saved_hash_filter()
+        keys = np.fromiter((hash_to_int(value) for value in values), dtype=np.int64, count=len(values))
+        return [value for value, passed in zip(values, self.hash_filter.contains(keys)) if passed]
+
+    def add_to_hash_filter(self, hashes: List[Tuple[Union[str, int], int]]) -> None:
+        """
+        Adds inserted fingerprints to the hash filter, if any, saving it every hash_filter_save_interval calls.
+
+        :param hashes: A sequence of tuples in the format (hash, offset).
+        """
+        if self.hash_filter is None:
+            return
+        self.hash_filter.add(np.fromiter((hash_to_int(hsh) for hsh, _ in hashes), dtype=np.int64,
+                                         count=len(hashes)))
+        self._hash_filter_unsaved += 1
+        if self._hash_filter_unsaved >= self.hash_filter_save_interval:
+            self.save_hash_filter()
+
+    def flush_hash_filter(self) -> None:
+        """
+        Saves the hash filter if fingerprints were added to it since it was last saved. Hashes left unsaved
+        would be missing from the filter of every other process, which would drop them as absent.
+        """
+        if self.hash_filter is not None and self._hash_filter_unsaved:
+            self.save_hash_filter()
+
+    def save_hash_filter(self) -> None:
+        """
+        Saves the hash filter, merging first the hashes other processes saved since it was read.
+        """
+        self._merge_saved_hash_filter()
+        self.hash_filter.save(self.hash_filter_path)
+        self._hash_filter_mtime = os.stat(self.hash_filter_path).st_mtime_ns
+        self._hash_filter_unsaved = 0
+
+    def _merge_saved_hash_filter(self) -> None:
+        try:
+            mtime = os.stat(self.hash_filter_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._hash_filter_mtime:
+            self.hash_filter.merge(BloomFilter.load(self.hash_filter_path))
+            self._hash_filter_mtime = mtime
+
+    def select_matches(self, cur, values: List[Union[str, int]], batch_size: int = 1000) -> Iterator[Tuple]:
+        """
+        Looks up the fingerprints of a set of hashes, with an IN list of up to batch_size hashes per query.
+
+        :param cur: open cursor.
+        :param values: unique hashes, as given by normalize_hash.
+        :param batch_size: number of hashes per query.
+        :return: an iterator over the (hash, audio_id, offset) rows found.
+        """
+        for index in range(0, len(values), batch_size):
+            # Create our IN part of the query
+            query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
+
+            cur.execute(query, values[index: index + batch_size])
+            yield from cur
+
+    def normalize_hash(self, hsh: Union[str, int]) -> Union[str, int]:
+        """
+        Converts a fingerprint hash to the form the queries take and return it in, upper case hexadecimal
+        strings unless the database stores hashes as integers.
+
+        :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+        :return: the hash as stored in the database.
+        """
+        return hash_to_hex(hsh)
 
     def delete_audios_by_id(self, audio_ids: List[int], batch_size: int = 1000) -> None:
         """
@@ -298,9 +649,38 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param audio_ids: audio ids to be deleted from the database.
         :param batch_size: number of query's batches.
         """
+        for audio_id in audio_ids:
+            self.audio_cache.pop(audio_id, None)
+
         with self.cursor() as cur:
             for index in range(0, len(audio_ids), batch_size):
                 # Create our IN part of the query
                 query = self.DELETE_AUDIOS % ', '.join(['%s'] * len(audio_ids[index: index + batch_size]))
 
                 cur.execute(query, audio_ids[index: index + batch_size])
+
+
+def hash_to_hex(hsh: Union[str, int]) -> str:
+    """
+    Normalizes a fingerprint hash to the upper case hexadecimal form stored in the database.
+
+    :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+    :return: the hash as an upper case hexadecimal string.
+    """
+    if isinstance(hsh, str):
+        return hsh.upper()
+    return format(int(hsh), '016X')
+
+
+def hash_to_int(hsh: Union[str, int]) -> int:
+    """
+    Normalizes a fingerprint hash to the signed 64-bit integer stored in BIGINT hash columns. 'sha1' hashes
+    keep their first 16 hexadecimal digits, the same 8 bytes the BYTEA to BIGINT migration keeps.
+
+    :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+    :return: the hash as a signed 64-bit integer.
+    """
+    if isinstance(hsh, str):
+        hsh = int(hsh[:16].ljust(16, '0'), 16)
+        return hsh - (1 << 64) if hsh >= (1 << 63) else hsh
+    return int(hsh)
@@ -27,9 +27,52 @@ OFFSET_SECS = 'offset_seconds'
 # DATABASE CLASS INSTANCES:
 DATABASES = {
     'mysql': ("dejavu.database_handler.mysql_database", "MySQLDatabase"),
-    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase")
+    'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase"),
+    'postgres_bigint': ("dejavu.database_handler.postgres_database", "PostgreSQLBigIntDatabase"),
+    'postgres_memory': ("dejavu.database_handler.memory_database", "PostgreSQLMemoryDatabase"),
+    'postgres_bigint_memory': ("dejavu.database_handler.memory_database", "PostgreSQLBigIntMemoryDatabase")
 }
 
+# DATABASE CONNECTION POOL:
+# Connections are shared by every database instance of a process with the same connection options, they can
+# be overridden with a "pool" dictionary within the "database" key of the configuration.
+# Connections opened along with the pool, and kept open once released, at least.
+DATABASE_POOL_MIN_SIZE = 1
+# Connections open at once, at most. Once all of them are in use cursors wait for one to be released.
+DATABASE_POOL_MAX_SIZE = 10
+# Seconds a cursor waits for a connection before failing.
+DATABASE_POOL_TIMEOUT = 30
+# Connections idle for longer than this amount of seconds are pinged before being reused.
+DATABASE_POOL_PING_INTERVAL = 30
+# Connections idle for longer than this amount of seconds are closed, as long as DATABASE_POOL_MIN_SIZE remain.
+DATABASE_POOL_MAX_IDLE_TIME = 600
+
+# IN MEMORY FINGERPRINT INDEX (memory database types):
+# Fingerprints fetched by each round trip of the server side cursor streaming the fingerprints table, when loading
+# the index or exporting an index file.
+MEMORY_INDEX_LOAD_BATCH_SIZE = 100000
+# Fingerprints inserted since startup are kept apart and merged into the sorted index once they reach this amount.
+MEMORY_INDEX_MERGE_SIZE = 1000000
+
+# HASH FILTER (enabled with the "hash_filter" key of the configuration):
+# Fraction of the hashes absent from the catalog the Bloom filter lets through to the database.
+HASH_FILTER_FALSE_POSITIVE_RATE = 0.01
+# The filter is sized for this many times the fingerprints stored when it is built, so the catalog can grow.
+HASH_FILTER_CAPACITY_FACTOR = 2
+HASH_FILTER_MIN_CAPACITY = 1000000
+# Audios inserted between two saves of the filter to disk.
+HASH_FILTER_SAVE_INTERVAL = 100
+
+# STOP HASHES (enabled with the "stop_hashes" key of the configuration, postgres only):
+# What is done with the query hashes found in too many audios: "skip", "cap" or "downweight" them.
+STOP_HASH_POLICY = "skip"
+# Number of audios a hash can be found in before it is a stop hash.
+STOP_HASH_MAX_DF = 1000
+# Fingerprints fetched per stop hash with the "cap" policy.
+STOP_HASH_CAP = 100
+# Audios counted in each transaction when updating the hash statistics.
+HASH_STATS_BATCH_SIZE = 100
+
 # TABLE AUDIOS
 AUDIOS_TABLE_NAME = "audios"
 
@@ -42,11 +85,22 @@ FIELD_TOTAL_HASHES = 'total_hashes'
 
 # TABLE FINGERPRINTS
 FINGERPRINTS_TABLE_NAME = "fingerprints"
+# Session table the fingerprints of a file are copied into before being merged (postgres only).
+FINGERPRINTS_STAGING_TABLE_NAME = "fingerprints_staging"
 
 # FINGERPRINTS FIELDS
 FIELD_HASH = 'hash'
 FIELD_OFFSET = 'offset'
 
+# TABLE HASH_STATS (postgres only)
+HASH_STATS_TABLE_NAME = "hash_stats"
+# Audios whose fingerprints are counted in the hash statistics.
+HASH_STATS_AUDIOS_TABLE_NAME = "hash_stats_audios"
+
+# HASH_STATS FIELDS
+FIELD_HASH_AUDIOS = 'audios'
+FIELD_HASH_POSTINGS = 'postings'
+
 # TABLE MATCHED_AUDIOS
 MATCHED_AUDIOS_TABLE_NAME = "matched_audios"
 
@@ -99,10 +153,53 @@ FIELD_RELATED_AUDIOS_FILE_SHA1 = 'file_sha1'
 # And 2 sets a square mask, i.e. all elements are considered neighbors.
 CONNECTIVITY_MASK = 2
 
+# Strategy used to fingerprint audios with more than one channel. It must be the same at ingest and at
+# recognition time.
+# Possible values are: ['per_channel', 'mono', 'best']
+# Where 'per_channel' fingerprints every channel separately and joins the hashes (the original dejavu
+# behaviour), 'mono' downmixes all the channels to a single one before fingerprinting, and 'best' only
+# fingerprints the channel with the highest energy. Both 'mono' and 'best' do a single FFT and peak finding
+# pass per file, and store roughly 1 / channels of the rows 'per_channel' stores.
+CHANNEL_STRATEGY = 'per_channel'
+CHANNEL_STRATEGIES = ['per_channel', 'mono', 'best']
+
 # Sampling rate, related to the Nyquist conditions, which affects
 # the range frequencies we can detect.
 DEFAULT_FS = 44100
 
+# Sampling rate audios are resampled to before fingerprinting, None means every audio is analysed at its own
+# rate (the original dejavu behaviour). Lower rates such as 11025 or 16000 cut the samples and FFT work by 3-4x
+# and are usually enough for speech or broadcast content. Offsets are measured in windows of the analysis rate,
+# so it must be the same at ingest and at recognition time.
+ANALYSIS_FS = None
+
+# Binaries used to decode audio files. When both are found files are decoded by piping the raw samples out of
+# ffmpeg, which also resamples to ANALYSIS_FS and trims to the fingerprint limit at the source, otherwise pydub
+# is used.
+FFMPEG_BINARY = 'ffmpeg'
+FFPROBE_BINARY = 'ffprobe'
+
+# Number of threads hashing files while a directory is scanned for fingerprinting.
+HASHING_THREADS = 8
+
+# Number of frames read at once from the decoder, and size of the blocks yielded when decoding as a stream.
+DECODER_BLOCK_SIZE = 2 ** 16
+
+# Maximum size in bytes of the on-disk fingerprint cache (enabled with the "fingerprint_cache" key of the
+# configuration), once over it the least recently used entries are evicted.
+FINGERPRINT_CACHE_MAX_SIZE = 2 * 2 ** 30
+# Entries a process stores between two scans of the cache directory. In between, the size of the cache is kept
+# as a running total, which misses the entries stored by other processes.
+FINGERPRINT_CACHE_SCAN_INTERVAL = 100
+
+# Channels longer than this amount of seconds are split in segments which are fingerprinted in a process pool
+# when fingerprinting a single file or recognizing a file, None disables it. The hashes are exactly the same
+# ones a single process generates.
+PARALLEL_FINGERPRINT_MIN_SECONDS = 600
+
+# Length in seconds of the segments a channel is split in for parallel fingerprinting.
+PARALLEL_FINGERPRINT_SEGMENT_SECONDS = 60
+
 # Size of the FFT window, affects frequency granularity
 DEFAULT_WINDOW_SIZE = 4096
 
@@ -111,6 +208,10 @@ DEFAULT_WINDOW_SIZE = 4096
 # matching, but potentially more fingerprints.
 DEFAULT_OVERLAP_RATIO = 0.5
 
+# Number of FFT windows transformed at once by the spectrogram engine. Bigger blocks are slightly faster,
+# but the complex spectrum of a whole block is kept in memory.
+SPECTROGRAM_BLOCK_SIZE = 256
+
 # Degree to which a fingerprint can be paired with its neighbors. Higher values will
 # cause more fingerprints, but potentially better accuracy.
 DEFAULT_FAN_VALUE = 5  # 15 was the original value.
@@ -120,6 +221,17 @@ DEFAULT_FAN_VALUE = 5  # 15 was the original value.
 # affect accuracy.
 DEFAULT_AMP_MIN = 10
 
+# Target amount of peaks per second kept from the spectrogram, None keeps every peak above DEFAULT_AMP_MIN (the
+# original dejavu behaviour). When set, only the strongest peaks of each time slice and frequency band are kept,
+# so the hashes stored per second of audio (and the rows fetched per query) stay bounded no matter how dense the
+# material is. It must be the same at ingest and at recognition time.
+PEAK_DENSITY = None
+
+# Length in seconds of the time slices, and amount of equally wide frequency bands, the peak density is
+# enforced on. The PEAK_DENSITY * PEAK_DENSITY_SLICE_SECONDS peaks of a slice are evenly split among its bands.
+PEAK_DENSITY_SLICE_SECONDS = 1
+PEAK_DENSITY_BANDS = 4
+
 # Number of cells around an amplitude peak in the spectrogram in order
 # for Dejavu to consider it a spectral peak. Higher values mean less
 # fingerprints and faster matching, but can potentially affect accuracy.
@@ -141,5 +253,23 @@ PEAK_SORT = True
 # with potentially lesser collisions of matches.
 FINGERPRINT_REDUCTION = 20
 
+# Format of the hashes generated from each pair of peaks.
+# Possible values are: ['sha1', 'packed']
+# Where 'sha1' is the original dejavu format, an hexadecimal string made of the first FINGERPRINT_REDUCTION
+# characters of sha1("freq1|freq2|t_delta"). Catalogs fingerprinted with it must keep using it.
+# And 'packed' stores freq1, freq2 and t_delta as bit fields of a single 64-bit integer, which avoids the
+# sha1 computation altogether and is considerably cheaper to generate, store and compare.
+FINGERPRINT_HASH_FORMAT = 'sha1'
+HASH_FORMATS = ['sha1', 'packed']
+
+# Bit widths of the fields of a 'packed' hash, laid out as freq1 | freq2 | t_delta from the most to the
+# least significant bits. 23 + 23 + 16 bits keep the result a non negative signed 64-bit integer.
+PACKED_HASH_FREQ_BITS = 23
+PACKED_HASH_DELTA_BITS = 16
+
 # Number of results being returned for file recognition
 TOPN = 2
+
+# Offset candidates returned per audio when the database computes the offset histogram of the matches (enabled
+# with the "match_aggregation" key of the configuration), alignment only uses the best one.
+MATCH_CANDIDATES_PER_AUDIO = 1
@@ -0,0 +1,222 @@
+import os
+import threading
+from collections import deque
+from time import monotonic
+from typing import Callable, Dict, Hashable
+
+from dejavu.config.settings import (DATABASE_POOL_MAX_IDLE_TIME,
+                                    DATABASE_POOL_MAX_SIZE,
+                                    DATABASE_POOL_MIN_SIZE,
+                                    DATABASE_POOL_PING_INTERVAL,
+                                    DATABASE_POOL_TIMEOUT)
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of database connections.
+
+    Between min_size and max_size connections are kept open, the first min_size are opened along with the pool
+    so the first queries don't pay for them. Connections idle for more than ping_interval
+    seconds are checked with the given ping function before being handed out, and the ones idle for more than
+    max_idle_time seconds are closed as long as min_size connections remain. Once max_size connections are in
+    use, acquire waits up to timeout seconds for one to be released.
+    """
+    def __init__(self, connect: Callable[[], any], ping: Callable[[any], bool], close: Callable[[any], None],
+                 min_size: int = DATABASE_POOL_MIN_SIZE, max_size: int = DATABASE_POOL_MAX_SIZE,
+                 timeout: float = DATABASE_POOL_TIMEOUT, ping_interval: float = DATABASE_POOL_PING_INTERVAL,
+                 max_idle_time: float = DATABASE_POOL_MAX_IDLE_TIME):
+        self._connect = connect
+        self._ping = ping
+        self._close = close
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.max_idle_time = max_idle_time
+
+        self._condition = threading.Condition()
+        self._idle = deque()  # (connection, released at), the most recently released on the right.
+        self._size = 0  # open connections, idle or in use.
+        self._stats = {"acquired": 0, "waited": 0, "wait_time": 0.0, "max_wait_time": 0.0, "timeouts": 0,
+                       "opened": 0, "closed": 0, "failed_pings": 0}
+
+        now = monotonic()
+        try:
+            for _ in range(min(self.min_size, self.max_size)):
+                self._idle.append((self._connect(), now))
+                self._size += 1
+                self._stats["opened"] += 1
+        except Exception:
+            self.close()
+            raise
+
+    def acquire(self) -> any:
+        """
+        Takes a connection from the pool, opening a new one if none is idle and max_size is not reached.
+
+        :return: an open connection, to be given back with release.
+        """
+        started = monotonic()
+        waited = False
+        with self._condition:
+            while True:
+                now = monotonic()
+                while self._idle:
+                    conn, released = self._idle.pop()
+                    if now - released < self.ping_interval or self._alive(conn):
+                        self._account(started, waited)
+                        return conn
+                    self._stats["failed_pings"] += 1
+                    self._discard(conn)
+
+                if self._size < self.max_size:
+                    # reserve the slot, the connection itself is opened outside the lock.
+                    self._size += 1
+                    self._account(started, waited)
+                    break
+
+                remaining = self.timeout - (now - started)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection released within {self.timeout} seconds "
+                                      f"({self.max_size} in use)")
+                waited = True
+                self._condition.wait(remaining)
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._stats["opened"] += 1
+        return conn
+
+    def release(self, conn: any, broken: bool = False) -> None:
+        """
+        Gives a connection back to the pool.
+
+        :param conn: connection taken with acquire.
+        :param broken: whether the connection is known to be unusable, in which case it is closed.
+        """
+        with self._condition:
+            if broken:
+                self._discard(conn)
+            else:
+                now = monotonic()
+                self._idle.append((conn, now))
+                self._prune(now)
+            self._condition.notify()
+
+    def reset(self) -> None:
+        """
+        Forgets every connection without closing them, to be called in a forked process. Connections inherited
+        from the parent share their sockets with it, closing them here would end the parent's sessions.
+        """
+        with self._condition:
+            _inherited.extend(conn for conn, _ in self._idle)
+            self._idle.clear()
+            self._size = 0
+            self._condition = threading.Condition()
+
+    def close(self) -> None:
+        """
+        Closes every idle connection.
+        """
+        with self._condition:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                self._discard(conn)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: usage statistics of the pool: connections open, in use and idle, acquisitions, how many of
+        them had to wait and for how long, timeouts, and connections opened, closed and found dead.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle),
+                         min_size=self.min_size, max_size=self.max_size)
+        stats["mean_wait_time"] = stats["wait_time"] / stats["waited"] if stats["waited"] else 0.0
+        return stats
+
+    def _account(self, started: float, waited: bool) -> None:
+        self._stats["acquired"] += 1
+        if waited:
+            wait_time = monotonic() - started
+            self._stats["waited"] += 1
+            self._stats["wait_time"] += wait_time
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], wait_time)
+
+    def _alive(self, conn: any) -> bool:
+        try:
+            return bool(self._ping(conn))
+        except Exception:
+            return False
+
+    def _discard(self, conn: any) -> None:
+        self._size -= 1
+        self._stats["closed"] += 1
+        try:
+            self._close(conn)
+        except Exception:
+            pass
+
+    def _prune(self, now: float) -> None:
+        # the least recently released connections are on the left.
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle_time:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# connections inherited from a parent process, kept referenced so they are never closed (see reset).
+_inherited = []
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(key: Hashable, factory: Callable[[], ConnectionPool]) -> ConnectionPool:
+    """
+    Process wide registry of pools, every database instance with the same connection options shares a pool.
+
+    :param key: connection options identifying the pool.
+    :param factory: builds the pool if there is none for the key yet.
+    :return: the pool of the current process for the key.
+    """
+    with _pools_lock:
+        if os.getpid() != _pools_pid:
+            # forked without after_fork being called.
+            _reset_pools()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = factory()
+        return pool
+
+
+def reset_pools() -> None:
+    """
+    Resets every pool of the process, see ConnectionPool.reset.
+    """
+    with _pools_lock:
+        _reset_pools()
+
+
+def _reset_pools() -> None:
+    global _pools_pid
+    for pool in _pools.values():
+        pool.reset()
+    _pools.clear()
+    _pools_pid = os.getpid()
+
+
+def pool_key(options: Dict[str, any]) -> Hashable:
+    return tuple(sorted((name, repr(value)) for name, value in options.items()))
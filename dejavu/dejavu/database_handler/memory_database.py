@@ -0,0 +1,155 @@
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from dejavu.base_classes.common_database import CommonDatabase, hash_to_int
+from dejavu.config.settings import (MATCH_CANDIDATES_PER_AUDIO,
+                                    MEMORY_INDEX_LOAD_BATCH_SIZE,
+                                    MEMORY_INDEX_MERGE_SIZE)
+from dejavu.database_handler.postgres_database import (
+    ARRAY_BATCH_SIZE, COPY_BATCH_SIZE, PostgreSQLBigIntDatabase,
+    PostgreSQLDatabase)
+from dejavu.logic.fingerprint_index import FingerprintIndex
+from dejavu.logic.stop_hashes import cap_postings
+
+
+class PostgreSQLMemoryDatabase(PostgreSQLDatabase):
+    """
+    PostgreSQL database answering fingerprint lookups from an in memory index (see FingerprintIndex) instead of
+    the fingerprints table. The index is loaded the first time it is needed, or by calling load_index at
+    startup, streaming the whole table through a server side cursor. Fingerprints inserted or deleted are
+    written through to the table, which remains the source of truth for every other process.
+
+    Hashes are indexed as signed 64-bit integers (see hash_to_int), 'sha1' hashes by their first 64 bits.
+    """
+    type = "postgres_memory"
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.index = None
+        self._index_lock = threading.Lock()
+
+    def after_fork(self) -> None:
+        super().after_fork()
+        # the index is inherited, a lock held by another thread at fork time would never be released.
+        self._index_lock = threading.Lock()
+
+    def setup(self) -> None:
+        """
+        Called on creation or shortly afterwards, loads the index.
+        """
+        super().setup()
+        self.load_index()
+
+    def empty(self) -> None:
+        """
+        Called when the database should be cleared of all data.
+        """
+        super().empty()
+        with self._index_lock:
+            self.index = FingerprintIndex()
+
+    def load_index(self, batch_size: int = MEMORY_INDEX_LOAD_BATCH_SIZE) -> FingerprintIndex:
+        """
+        Loads the fingerprints table into memory, unless it was already loaded.
+
+        :param batch_size: number of rows fetched by each round trip of the server side cursor.
+        :return: the index.
+        """
+        with self._index_lock:
+            if self.index is None:
+                self.index = FingerprintIndex.load(self.iter_fingerprints(batch_size), MEMORY_INDEX_MERGE_SIZE)
+            return self.index
+
+    def insert(self, fingerprint: str, audio_id: str, offset: int):
+        """
+        Inserts a single fingerprint into the database and the index.
+
+        :param fingerprint: Part of a sha1 hash, in hexadecimal format
+        :param audio_id: Song identifier this fingerprint is off
+        :param offset: The offset this fingerprint is from.
+        """
+        super().insert(fingerprint, audio_id, offset)
+        self._add_to_index(audio_id, [(fingerprint, offset)])
+
+    def insert_hashes(self, audio_id: str, hashes: List[Tuple[Union[str, int], int]],
+                      batch_size: int = COPY_BATCH_SIZE) -> None:
+        """
+        Insert a multitude of fingerprints into the database and the index, see PostgreSQLDatabase.insert_hashes.
+
+        :param audio_id: Song identifier the fingerprints belong to
+        :param hashes: A sequence of tuples in the format (hash, offset)
+        :param batch_size: number of rows sent by each COPY.
+        """
+        hashes = list(hashes)
+        super().insert_hashes(audio_id, hashes, batch_size)
+        self._add_to_index(audio_id, hashes)
+
+    def _add_to_index(self, audio_id: str, hashes: List[Tuple[Union[str, int], int]]) -> None:
+        # waits for a load in progress, its snapshot of the table may have been taken before this insert.
+        with self._index_lock:
+            index = self.index
+        if index is not None:
+            index.add(np.fromiter((hash_to_int(hsh) for hsh, _ in hashes), dtype=np.int64, count=len(hashes)),
+                      np.full(len(hashes), self.audio_index(audio_id), dtype=np.int32),
+                      np.fromiter((offset for _, offset in hashes), dtype=np.int32, count=len(hashes)))
+
+    def delete_audios_by_id(self, audio_ids: List[str], batch_size: int = 1000) -> None:
+        """
+        Given a list of audio ids it deletes all audios specified and their corresponding fingerprints, from
+        the database and the index.
+
+        :param audio_ids: audio ids to be deleted from the database.
+        :param batch_size: number of query's batches.
+        """
+        super().delete_audios_by_id(audio_ids, batch_size)
+        with self._index_lock:
+            index = self.index
+        if index is not None:
+            index.remove_audios(self.audio_index(audio_id) for audio_id in audio_ids)
+
+    def lookup_hashes(self, values: List[Union[str, int]], batch_size: int = ARRAY_BATCH_SIZE,
+                      limit: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the fingerprints of a set of hashes in the index, see CommonDatabase.lookup_hashes.
+
+        :param values: unique hashes, as given by normalize_hash.
+        :param batch_size: unused, the whole set is looked up at once.
+        :param limit: fingerprints kept per hash at most, all of them when None.
+        :return: a tuple of arrays (positions, audio_indexes, offsets) with a row per fingerprint found.
+        """
+        keys = np.fromiter((hash_to_int(value) for value in values), dtype=np.int64, count=len(values))
+        positions, audios, offsets = self.load_index().lookup(keys)
+        if limit is not None:
+            keep = cap_postings(positions, limit)
+            positions, audios, offsets = positions[keep], audios[keep], offsets[keep]
+        return positions, audios, offsets
+
+    def return_aligned_matches(self, hashes: List[Tuple[Union[str, int], int]],
+                               candidates: int = MATCH_CANDIDATES_PER_AUDIO) \
+            -> Tuple[List[Tuple[str, int, int]], Dict[str, int]]:
+        """
+        Counts the offset differences of the matches found in the index, see
+        CommonDatabase.return_aligned_matches. The server side histogram would read the fingerprints table.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+        :param candidates: number of offset differences returned per audio, the most matched ones.
+        :return: a list of (sid, offset_difference, count) tuples and a dictionary with the amount of hashes
+        matched (not considering duplicated hashes) in each audio.
+        """
+        return CommonDatabase.return_aligned_matches(self, hashes, candidates)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # the index is not pickled, the new process loads its own.
+        self.index = None
+        self._index_lock = threading.Lock()
+
+
+class PostgreSQLBigIntMemoryDatabase(PostgreSQLMemoryDatabase, PostgreSQLBigIntDatabase):
+    """
+    In memory index (see PostgreSQLMemoryDatabase) over a fingerprints table storing BIGINT hashes (see
+    PostgreSQLBigIntDatabase).
+    """
+    type = "postgres_bigint_memory"
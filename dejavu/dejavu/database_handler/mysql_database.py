@@ -1,13 +1,23 @@
-import queue
+from typing import Dict, Iterator, Tuple, Union
 
 import mysql.connector
-from mysql.connector.errors import DatabaseError
+import numpy as np
+from mysql.connector.errors import Error
 
-from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.base_classes.common_database import (CommonDatabase, hash_to_hex,
+                                                 hash_to_int)
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_HASH, FIELD_OFFSET, FIELD_AUDIO_ID,
-                                    FIELD_AUDIONAME, FIELD_TOTAL_HASHES,
-                                    FINGERPRINTS_TABLENAME, AUDIOS_TABLENAME)
+                                    FIELD_AUDIO_NAME as FIELD_AUDIONAME, FIELD_TOTAL_HASHES,
+                                    FINGERPRINTS_TABLE_NAME as FINGERPRINTS_TABLENAME,
+                                    AUDIOS_TABLE_NAME as AUDIOS_TABLENAME,
+                                    MEMORY_INDEX_LOAD_BATCH_SIZE)
+from dejavu.database_handler.connection_pool import (ConnectionPool, get_pool,
+                                                     pool_key, reset_pools)
+
+
+# hexadecimal digits of the BINARY(10) hash column.
+HASH_HEX_WIDTH = 20
 
 
 class MySQLDatabase(CommonDatabase):
@@ -70,14 +80,37 @@ class MySQLDatabase(CommonDatabase):
         WHERE `{FIELD_HASH}` IN (%s);
     """
 
+    SELECT_LIMITED = f"""
+        SELECT HEX(`{FIELD_HASH}`), `{FIELD_AUDIO_ID}`, `{FIELD_OFFSET}`
+        FROM `{FINGERPRINTS_TABLENAME}`
+        WHERE `{FIELD_HASH}` = UNHEX(%s)
+        LIMIT %s;
+    """
+
     SELECT_ALL = f"SELECT `{FIELD_AUDIO_ID}`, `{FIELD_OFFSET}` FROM `{FINGERPRINTS_TABLENAME}`;"
 
+    # every fingerprint, read through an unbuffered cursor.
+    SELECT_ALL_HASHES = f"""
+        SELECT HEX(`{FIELD_HASH}`), `{FIELD_AUDIO_ID}`, `{FIELD_OFFSET}`
+        FROM `{FINGERPRINTS_TABLENAME}`;
+    """
+
     SELECT_AUDIO = f"""
         SELECT `{FIELD_AUDIONAME}`, HEX(`{FIELD_FILE_SHA1}`) AS `{FIELD_FILE_SHA1}`, `{FIELD_TOTAL_HASHES}`
         FROM `{AUDIOS_TABLENAME}`
         WHERE `{FIELD_AUDIO_ID}` = %s;
     """
 
+    SELECT_AUDIOS_BY_IDS = f"""
+        SELECT
+            `{FIELD_AUDIO_ID}`
+        ,   `{FIELD_AUDIONAME}`
+        ,   HEX(`{FIELD_FILE_SHA1}`) AS `{FIELD_FILE_SHA1}`
+        ,   `{FIELD_TOTAL_HASHES}`
+        FROM `{AUDIOS_TABLENAME}`
+        WHERE `{FIELD_AUDIO_ID}` IN (%s);
+    """
+
     SELECT_NUM_FINGERPRINTS = f"SELECT COUNT(*) AS n FROM `{FINGERPRINTS_TABLENAME}`;"
 
     SELECT_UNIQUE_AUDIO_IDS = f"""
@@ -124,9 +157,16 @@ class MySQLDatabase(CommonDatabase):
         self._options = options
 
     def after_fork(self) -> None:
-        # Clear the cursor cache, we don't want any stale connections from
-        # the previous process.
-        Cursor.clear_cache()
+        super().after_fork()
+        # Forget the pooled connections, we don't want to share the connections
+        # of the previous process.
+        reset_pools()
+
+    def pool_stats(self) -> Dict[str, float]:
+        """
+        :return: usage statistics of the connection pool of this process, see ConnectionPool.stats.
+        """
+        return self.cursor.pool().stats()
 
     def insert_audios(self, audio_name: str, file_hash: str, total_hashes: int) -> int:
         """
@@ -140,64 +180,113 @@ class MySQLDatabase(CommonDatabase):
         """
         with self.cursor() as cur:
             cur.execute(self.INSERT_AUDIO, (audio_name, file_hash, total_hashes))
+            self.audio_cache.pop(cur.lastrowid, None)
             return cur.lastrowid
 
+    def normalize_hash(self, hsh: Union[str, int]) -> str:
+        """
+        Converts a fingerprint hash to the upper case hexadecimal form HEX(hash) returns. The hash column is
+        BINARY(10), which right pads shorter values with zero bytes, so 'packed' hashes (8 bytes) are padded
+        the same way, keeping their 64-bit value in the first 8 bytes (see hash_to_int).
+
+        :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+        :return: the hash as stored in the database.
+        """
+        return hash_to_hex(hsh).ljust(HASH_HEX_WIDTH, '0')
+
+    def iter_fingerprints(self, batch_size: int = MEMORY_INDEX_LOAD_BATCH_SIZE) \
+            -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Streams the whole fingerprints table through an unbuffered cursor.
+
+        :param batch_size: number of rows fetched at once.
+        :return: an iterator over (hashes, audio_indexes, offsets) arrays of up to batch_size fingerprints,
+        hashes as given by hash_to_int and audio indexes as given by audio_index.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ALL_HASHES)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                hashes, audio_ids, offsets = zip(*rows)
+                yield (np.fromiter((hash_to_int(hsh) for hsh in hashes), dtype=np.int64, count=len(hashes)),
+                       np.fromiter((self.audio_index(audio_id) for audio_id in audio_ids), dtype=np.int32,
+                                   count=len(audio_ids)),
+                       np.array(offsets, dtype=np.int32))
+
     def __getstate__(self):
         return self._options,
 
     def __setstate__(self, state):
+        super().__init__()
         self._options, = state
         self.cursor = cursor_factory(**self._options)
 
 
 def cursor_factory(**factory_options):
-    def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+    factory_options = dict(factory_options)
+    pool_options = factory_options.pop("pool", {})
+    key = pool_key(dict(factory_options, pool=pool_options))
+
+    def pool():
+        return get_pool(key, lambda: ConnectionPool(lambda: mysql.connector.connect(**factory_options), _ping,
+                                                    _close, **pool_options))
+
+    def cursor(dictionary=False, buffered=False):
+        return Cursor(pool(), dictionary=dictionary, buffered=buffered)
+
+    cursor.pool = pool
     return cursor
 
 
+def _ping(conn) -> bool:
+    # raises if the server is gone, it doesn't try to reconnect.
+    conn.ping(reconnect=False)
+    return True
+
+
+def _close(conn) -> None:
+    conn.close()
+
+
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Takes a connection from the pool and returns an open cursor, the transaction
+    is committed on exit, or rolled back if an exception was raised.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, pool: ConnectionPool, dictionary=False, buffered=False):
         super().__init__()
-
-        self._cache = queue.Queue(maxsize=5)
-
-        try:
-            conn = self._cache.get_nowait()
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-        except queue.Empty:
-            conn = mysql.connector.connect(**options)
-
-        self.conn = conn
+        self.pool = pool
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        self.buffered = buffered
 
     def __enter__(self):
-        self.cursor = self.conn.cursor(dictionary=self.dictionary)
+        self.conn = self.pool.acquire()
+        try:
+            self.cursor = self.conn.cursor(dictionary=self.dictionary, buffered=self.buffered)
+        except Error:
+            self.pool.release(self.conn, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is DatabaseError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
+        broken = False
         try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except Error:
+            if extype is None:
+                self.pool.release(self.conn, broken=True)
+                raise
+            broken = True
+
+        # Put it back on the pool, unless the connection was lost.
+        self.pool.release(self.conn, broken=broken)
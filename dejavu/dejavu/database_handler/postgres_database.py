@@ -1,9 +1,14 @@
-import queue
+import struct
+from io import BytesIO, StringIO
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import psycopg2
+from psycopg2.extensions import connection
 from psycopg2.extras import DictCursor
 
-from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.base_classes.common_database import (CommonDatabase, hash_to_hex,
+                                                 hash_to_int)
 from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_HASH, FIELD_OFFSET, FIELD_AUDIO_ID,
                                     FIELD_AUDIO_NAME, FIELD_TOTAL_HASHES, FIELD_MATCHED_AUDIO_RELATED_KEY,
@@ -20,7 +25,33 @@ from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_RELATED_AUDIOS_FINGERPRINTED_CONFIDENCE, FIELD_RELATED_AUDIOS_OFFSET,
                                     FIELD_RELATED_AUDIOS_OFFSET_SECONDS, FIELD_RELATED_AUDIOS_FILE_SHA1,
                                     MATCHED_AUDIOS_TABLE_NAME, MATCHED_INFORMATION_TABLE_NAME,
-                                    RELATED_AUDIOS_TABLE_NAME, FINGERPRINTS_TABLE_NAME, AUDIOS_TABLE_NAME)
+                                    RELATED_AUDIOS_TABLE_NAME, FINGERPRINTS_TABLE_NAME, AUDIOS_TABLE_NAME,
+                                    FINGERPRINTS_STAGING_TABLE_NAME, MATCH_CANDIDATES_PER_AUDIO,
+                                    MEMORY_INDEX_LOAD_BATCH_SIZE, HASH_STATS_TABLE_NAME,
+                                    HASH_STATS_AUDIOS_TABLE_NAME, FIELD_HASH_AUDIOS, FIELD_HASH_POSTINGS,
+                                    HASH_STATS_BATCH_SIZE)
+from dejavu.database_handler.connection_pool import (ConnectionPool, get_pool,
+                                                     pool_key, reset_pools)
+from dejavu.logic.fingerprint_index import IndexSegment
+from dejavu.logic.index_file import write_index_file
+
+
+# signature, flags and header extension length of the binary COPY format.
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+
+# rows sent by each COPY when bulk loading fingerprints.
+COPY_BATCH_SIZE = 100000
+
+# hashes sent in each array parameter when looking up fingerprints.
+ARRAY_BATCH_SIZE = 10000
+
+# queries with at least this amount of unique hashes are copied to a temporary table and joined at once.
+TEMP_TABLE_MIN_HASHES = 100000
+
+# audios whose fingerprints are converted in each transaction when migrating hashes to BIGINT.
+MIGRATION_BATCH_SIZE = 100
+
 
 class PostgreSQLDatabase(CommonDatabase):
     type = "postgres"
@@ -105,6 +136,28 @@ class PostgreSQLDatabase(CommonDatabase):
         VALUES (%s, decode(%s, 'hex'), %s) ON CONFLICT DO NOTHING;
     """
 
+    # BULK INSERTS
+    # the staging table lives as long as the (pooled) connection and is emptied on every commit.
+    CREATE_FINGERPRINTS_STAGING_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "{FINGERPRINTS_STAGING_TABLE_NAME}" (
+            "{FIELD_HASH}" BYTEA NOT NULL
+        ,   "{FIELD_AUDIO_ID}" CHAR(32) NOT NULL
+        ,   "{FIELD_OFFSET}" INT NOT NULL
+        ) ON COMMIT DELETE ROWS;
+    """
+
+    COPY_FINGERPRINTS = f"""
+        COPY "{FINGERPRINTS_STAGING_TABLE_NAME}" ("{FIELD_HASH}", "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}")
+        FROM STDIN WITH (FORMAT binary);
+    """
+
+    MERGE_FINGERPRINTS = f"""
+        INSERT INTO "{FINGERPRINTS_TABLE_NAME}" ("{FIELD_AUDIO_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}")
+        SELECT "{FIELD_AUDIO_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_STAGING_TABLE_NAME}"
+        ON CONFLICT DO NOTHING;
+    """
+
     INSERT_AUDIOS = f"""
         INSERT INTO "{AUDIOS_TABLE_NAME}" ("{FIELD_AUDIO_ID}","{FIELD_AUDIO_NAME}", "{FIELD_FILE_SHA1}","{FIELD_TOTAL_HASHES}")
         VALUES (%s, %s, decode(%s, 'hex'), %s)
@@ -136,8 +189,173 @@ class PostgreSQLDatabase(CommonDatabase):
         WHERE "{FIELD_HASH}" IN (%s);
     """
 
+    SELECT_LIMITED = f"""
+        SELECT upper(encode("{FIELD_HASH}", 'hex')), "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}"
+        WHERE "{FIELD_HASH}" = decode(%s, 'hex')
+        LIMIT %s;
+    """
+
     SELECT_ALL = f'SELECT "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}" FROM "{FINGERPRINTS_TABLE_NAME}";'
 
+    # every fingerprint with its hash as a signed 64-bit integer, see hash_to_int. Read by a named cursor.
+    ITER_FINGERPRINTS_CURSOR = "iter_fingerprints"
+
+    SELECT_ALL_HASHES = f"""
+        SELECT ('x' || encode(substring("{FIELD_HASH}" FROM 1 FOR 8), 'hex'))::bit(64)::bigint,
+            "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}";
+    """
+
+    # ARRAY LOOKUPS
+    # prepared once per connection. The hashes are bound as a single array, so the statement is planned once,
+    # and the rows come back with the hash exactly as it was given.
+    SELECT_ARRAY_STATEMENT = "select_hashes_array"
+
+    PREPARE_SELECT_ARRAY = f"""
+        PREPARE "{SELECT_ARRAY_STATEMENT}" (text[]) AS
+        SELECT q."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+        FROM unnest($1) AS q("{FIELD_HASH}")
+        JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = decode(q."{FIELD_HASH}", 'hex');
+    """
+
+    EXECUTE_SELECT_ARRAY = f'EXECUTE "{SELECT_ARRAY_STATEMENT}" (%s);'
+
+    # large queries are copied into a session table emptied on every commit.
+    CREATE_QUERY_HASHES_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "query_hashes" ("{FIELD_HASH}" TEXT NOT NULL) ON COMMIT DELETE ROWS;
+    """
+
+    COPY_QUERY_HASHES = f'COPY "query_hashes" ("{FIELD_HASH}") FROM STDIN;'
+
+    SELECT_TEMP_STATEMENT = "select_hashes_temp"
+
+    PREPARE_SELECT_TEMP = f"""
+        PREPARE "{SELECT_TEMP_STATEMENT}" AS
+        SELECT q."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+        FROM "query_hashes" q
+        JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = decode(q."{FIELD_HASH}", 'hex');
+    """
+
+    EXECUTE_SELECT_TEMP = f'EXECUTE "{SELECT_TEMP_STATEMENT}";'
+
+    # OFFSET HISTOGRAM
+    # the (hash, offset) pairs of the query are bound as two arrays, the matches are counted per audio and
+    # offset difference, and only the most matched differences of each audio come back.
+    SELECT_HISTOGRAM_STATEMENT = "select_offset_histogram"
+
+    PREPARE_SELECT_HISTOGRAM = f"""
+        PREPARE "{SELECT_HISTOGRAM_STATEMENT}" (text[], int[], int) AS
+        WITH "query" AS (
+            SELECT decode(q."{FIELD_HASH}", 'hex') AS "{FIELD_HASH}", q."{FIELD_OFFSET}"
+            FROM unnest($1, $2) AS q("{FIELD_HASH}", "{FIELD_OFFSET}")
+        ), "matched" AS (
+            SELECT f."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+            FROM (SELECT DISTINCT "{FIELD_HASH}" FROM "query") u
+            JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = u."{FIELD_HASH}"
+        ), "histogram" AS (
+            SELECT m."{FIELD_AUDIO_ID}", m."{FIELD_OFFSET}" - q."{FIELD_OFFSET}" AS "difference", count(*) AS "count"
+            FROM "matched" m
+            JOIN "query" q ON q."{FIELD_HASH}" = m."{FIELD_HASH}"
+            GROUP BY m."{FIELD_AUDIO_ID}", m."{FIELD_OFFSET}" - q."{FIELD_OFFSET}"
+        ), "ranked" AS (
+            SELECT "{FIELD_AUDIO_ID}", "difference", "count", row_number() OVER (
+                PARTITION BY "{FIELD_AUDIO_ID}" ORDER BY "count" DESC, "difference") AS "rank"
+            FROM "histogram"
+        ), "hashes_matched" AS (
+            SELECT "{FIELD_AUDIO_ID}", count(*) AS "count"
+            FROM "matched"
+            GROUP BY "{FIELD_AUDIO_ID}"
+        )
+        SELECT r."{FIELD_AUDIO_ID}", r."difference", r."count", h."count"
+        FROM "ranked" r
+        JOIN "hashes_matched" h ON h."{FIELD_AUDIO_ID}" = r."{FIELD_AUDIO_ID}"
+        WHERE r."rank" <= $3
+        ORDER BY r."{FIELD_AUDIO_ID}", r."rank";
+    """
+
+    EXECUTE_SELECT_HISTOGRAM = f'EXECUTE "{SELECT_HISTOGRAM_STATEMENT}" (%s, %s, %s);'
+
+    # HASH STATISTICS
+    # number of audios (document frequency) and fingerprints of every hash, see update_hash_stats.
+    CREATE_HASH_STATS_TABLES = f"""
+        CREATE TABLE IF NOT EXISTS "{HASH_STATS_TABLE_NAME}" (
+            "{FIELD_HASH}" BYTEA NOT NULL
+        ,   "{FIELD_HASH_AUDIOS}" INT NOT NULL
+        ,   "{FIELD_HASH_POSTINGS}" BIGINT NOT NULL
+        ,   CONSTRAINT "pk_{HASH_STATS_TABLE_NAME}_{FIELD_HASH}" PRIMARY KEY ("{FIELD_HASH}")
+        );
+
+        CREATE INDEX IF NOT EXISTS "ix_{HASH_STATS_TABLE_NAME}_{FIELD_HASH_AUDIOS}" ON "{HASH_STATS_TABLE_NAME}"
+        USING btree ("{FIELD_HASH_AUDIOS}");
+
+        CREATE TABLE IF NOT EXISTS "{HASH_STATS_AUDIOS_TABLE_NAME}" (
+            "{FIELD_AUDIO_ID}" CHAR(32) NOT NULL
+        ,   CONSTRAINT "pk_{HASH_STATS_AUDIOS_TABLE_NAME}_{FIELD_AUDIO_ID}" PRIMARY KEY ("{FIELD_AUDIO_ID}")
+        ,   CONSTRAINT "fk_{HASH_STATS_AUDIOS_TABLE_NAME}_{FIELD_AUDIO_ID}" FOREIGN KEY ("{FIELD_AUDIO_ID}")
+                REFERENCES "{AUDIOS_TABLE_NAME}"("{FIELD_AUDIO_ID}") ON DELETE CASCADE
+        );
+    """
+
+    # the statistics of an audio are counted once it is fingerprinted, the audio being marked in the same
+    # transaction, so concurrent updates never count it twice.
+    SELECT_HASH_STATS_PENDING = f"""
+        SELECT a."{FIELD_AUDIO_ID}"
+        FROM "{AUDIOS_TABLE_NAME}" a
+        WHERE a."{FIELD_FINGERPRINTED}" = 1 AND NOT EXISTS (
+            SELECT 1 FROM "{HASH_STATS_AUDIOS_TABLE_NAME}" c WHERE c."{FIELD_AUDIO_ID}" = a."{FIELD_AUDIO_ID}")
+        ORDER BY a."{FIELD_AUDIO_ID}";
+    """
+
+    MARK_HASH_STATS_AUDIOS = f"""
+        INSERT INTO "{HASH_STATS_AUDIOS_TABLE_NAME}" ("{FIELD_AUDIO_ID}")
+        SELECT "{FIELD_AUDIO_ID}" FROM "{AUDIOS_TABLE_NAME}" WHERE "{FIELD_AUDIO_ID}" IN (%s)
+        ON CONFLICT DO NOTHING
+        RETURNING "{FIELD_AUDIO_ID}";
+    """
+
+    COUNT_HASH_STATS = f"""
+        INSERT INTO "{HASH_STATS_TABLE_NAME}" ("{FIELD_HASH}", "{FIELD_HASH_AUDIOS}", "{FIELD_HASH_POSTINGS}")
+        SELECT "{FIELD_HASH}", count(DISTINCT "{FIELD_AUDIO_ID}"), count(*)
+        FROM "{FINGERPRINTS_TABLE_NAME}"
+        WHERE "{FIELD_AUDIO_ID}" IN (%s)
+        GROUP BY "{FIELD_HASH}"
+        ON CONFLICT ("{FIELD_HASH}") DO UPDATE SET
+            "{FIELD_HASH_AUDIOS}" = "{HASH_STATS_TABLE_NAME}"."{FIELD_HASH_AUDIOS}" + EXCLUDED."{FIELD_HASH_AUDIOS}"
+        ,   "{FIELD_HASH_POSTINGS}" = "{HASH_STATS_TABLE_NAME}"."{FIELD_HASH_POSTINGS}"
+                + EXCLUDED."{FIELD_HASH_POSTINGS}";
+    """
+
+    # only the audios already counted are taken out of the statistics.
+    DISCOUNT_HASH_STATS = f"""
+        WITH "removed" AS (
+            SELECT f."{FIELD_HASH}", count(DISTINCT f."{FIELD_AUDIO_ID}") AS "audios", count(*) AS "postings"
+            FROM "{FINGERPRINTS_TABLE_NAME}" f
+            JOIN "{HASH_STATS_AUDIOS_TABLE_NAME}" c ON c."{FIELD_AUDIO_ID}" = f."{FIELD_AUDIO_ID}"
+            WHERE f."{FIELD_AUDIO_ID}" IN (%s)
+            GROUP BY f."{FIELD_HASH}"
+        )
+        UPDATE "{HASH_STATS_TABLE_NAME}" s SET
+            "{FIELD_HASH_AUDIOS}" = s."{FIELD_HASH_AUDIOS}" - r."audios"
+        ,   "{FIELD_HASH_POSTINGS}" = s."{FIELD_HASH_POSTINGS}" - r."postings"
+        FROM "removed" r
+        WHERE s."{FIELD_HASH}" = r."{FIELD_HASH}";
+    """
+
+    DELETE_EMPTY_HASH_STATS = f'DELETE FROM "{HASH_STATS_TABLE_NAME}" WHERE "{FIELD_HASH_AUDIOS}" <= 0;'
+
+    SELECT_HASH_STATS_EXISTS = f"SELECT to_regclass('\"{HASH_STATS_AUDIOS_TABLE_NAME}\"') IS NOT NULL;"
+
+    TRUNCATE_HASH_STATS = f'TRUNCATE "{HASH_STATS_TABLE_NAME}", "{HASH_STATS_AUDIOS_TABLE_NAME}";'
+
+    # the hashes found in more than %s audios, as signed 64-bit integers, see hash_to_int.
+    SELECT_STOP_HASHES = f"""
+        SELECT ('x' || encode(substring("{FIELD_HASH}" FROM 1 FOR 8), 'hex'))::bit(64)::bigint,
+            "{FIELD_HASH_AUDIOS}"
+        FROM "{HASH_STATS_TABLE_NAME}"
+        WHERE "{FIELD_HASH_AUDIOS}" > %s;
+    """
+
     SELECT_AUDIO = f"""
         SELECT
             "{FIELD_AUDIO_NAME}"
@@ -147,6 +365,16 @@ class PostgreSQLDatabase(CommonDatabase):
         WHERE "{FIELD_AUDIO_ID}" = %s;
     """
 
+    SELECT_AUDIOS_BY_IDS = f"""
+        SELECT
+            "{FIELD_AUDIO_ID}"
+        ,   "{FIELD_AUDIO_NAME}"
+        ,   upper(encode("{FIELD_FILE_SHA1}", 'hex')) AS "{FIELD_FILE_SHA1}"
+        ,   "{FIELD_TOTAL_HASHES}"
+        FROM "{AUDIOS_TABLE_NAME}"
+        WHERE "{FIELD_AUDIO_ID}" IN (%s);
+    """
+
     SELECT_NUM_FINGERPRINTS = f'SELECT COUNT(*) AS n FROM "{FINGERPRINTS_TABLE_NAME}";'
 
     COUNT_MATCHED_AUDIOS = f'SELECT COUNT(*)  FROM "{MATCHED_INFORMATION_TABLE_NAME}" WHERE "{FIELD_MATCHED_INFORMATION_AUDIO_MD5}" = %s;'
@@ -240,7 +468,9 @@ class PostgreSQLDatabase(CommonDatabase):
     """
 
     # DROPS
-    DROP_FINGERPRINTS = F'DROP TABLE IF EXISTS "{FINGERPRINTS_TABLE_NAME}";'
+    # the hash statistics go with the fingerprints they count.
+    DROP_FINGERPRINTS = F'DROP TABLE IF EXISTS "{HASH_STATS_AUDIOS_TABLE_NAME}", "{HASH_STATS_TABLE_NAME}", ' \
+                        F'"{FINGERPRINTS_TABLE_NAME}";'
     DROP_AUDIOS = F'DROP TABLE IF EXISTS "{AUDIOS_TABLE_NAME}";'
     DROP_MATCHED_INFORMATION = F'DROP TABLE IF EXISTS "{MATCHED_INFORMATION_TABLE_NAME}";'
     DROP_RELATED_AUDIOS = F'DROP TABLE IF EXISTS "{RELATED_AUDIOS_TABLE_NAME}";'
@@ -271,9 +501,16 @@ class PostgreSQLDatabase(CommonDatabase):
         self._options = options
 
     def after_fork(self) -> None:
-        # Clear the cursor cache, we don't want any stale connections from
-        # the previous process.
-        Cursor.clear_cache()
+        super().after_fork()
+        # Forget the pooled connections, we don't want to share the connections
+        # of the previous process.
+        reset_pools()
+
+    def pool_stats(self) -> Dict[str, float]:
+        """
+        :return: usage statistics of the connection pool of this process, see ConnectionPool.stats.
+        """
+        return self.cursor.pool().stats()
 
     def insert_audios(self, audio_id: str, audio_name: str, file_hash: str, total_hashes: int) -> int:
         """
@@ -285,10 +522,224 @@ class PostgreSQLDatabase(CommonDatabase):
         :param total_hashes: amount of hashes to be inserted on fingerprint table.
         :return: the inserted id.
         """
+        self.audio_cache.pop(audio_id, None)
         with self.cursor() as cur:
             cur.execute(self.INSERT_AUDIOS, (audio_id, audio_name, file_hash, total_hashes))
             return cur.fetchone()[0]
 
+    def insert_hashes(self, audio_id: str, hashes: List[Tuple[Union[str, int], int]],
+                      batch_size: int = COPY_BATCH_SIZE) -> None:
+        """
+        Insert a multitude of fingerprints.
+
+        Rows are streamed in the binary COPY format into a session staging table, then merged into the
+        fingerprints table with a single statement, skipping duplicates just like INSERT_FINGERPRINT does.
+
+        :param audio_id: Song identifier the fingerprints belong to
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format, or a packed hash
+            - offset: Offset this hash was created from/at.
+        :param batch_size: number of rows sent by each COPY.
+        """
+        hashes = list(hashes)
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_FINGERPRINTS_STAGING_TABLE)
+            for index in range(0, len(hashes), batch_size):
+                cur.copy_expert(self.COPY_FINGERPRINTS,
+                                copy_buffer(audio_id, hashes[index: index + batch_size], self.copy_hash))
+            cur.execute(self.MERGE_FINGERPRINTS)
+        self.add_to_hash_filter(hashes)
+
+    def return_matches(self, hashes: List[Tuple[Union[str, int], int]], batch_size: int = ARRAY_BATCH_SIZE) \
+            -> Tuple[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]], Dict[str, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values, see CommonDatabase.return_matches.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+        :param batch_size: number of hashes bound to each array lookup.
+        :return: the (audio_indexes, offset_differences, weights) arrays of the matches and a dictionary with
+        the amount of hashes matched in each audio.
+        """
+        return super().return_matches(hashes, batch_size)
+
+    def return_aligned_matches(self, hashes: List[Tuple[Union[str, int], int]],
+                               candidates: int = MATCH_CANDIDATES_PER_AUDIO) \
+            -> Tuple[List[Tuple[int, int, int]], Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values and counts, for each audio, how many of them
+        match at each offset difference. The whole query is sent at once and the histogram is computed by
+        the server, so only the candidates cross the network instead of every matching row.
+
+        Stop hashes (see use_stop_hashes) are left out of the query with the skip policy, the matches are
+        fetched and counted by CommonDatabase.return_aligned_matches with the others.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+        :param candidates: number of offset differences returned per audio, the most matched ones.
+        :return: a list of (sid, offset_difference, count) tuples and a dictionary with the amount of hashes
+        matched (not considering duplicated hashes) in each audio.
+        """
+        if self.stop_hashes is not None and self.stop_hashes.policy != "skip":
+            return super().return_aligned_matches(hashes, candidates)
+
+        hashes = list(hashes)
+        values = [self.normalize_hash(hsh) for hsh, _ in hashes]
+        offsets = [int(offset) for _, offset in hashes]
+        if self.stop_hashes is not None:
+            stop, _ = self.stop_hashes.find(np.fromiter((hash_to_int(value) for value in values), dtype=np.int64,
+                                                        count=len(values)))
+            values = [value for value, is_stop in zip(values, stop) if not is_stop]
+            offsets = [offset for offset, is_stop in zip(offsets, stop) if not is_stop]
+
+        results = []
+        dedup_hashes = {}
+        with self.cursor() as cur:
+            prepare(cur, self.SELECT_HISTOGRAM_STATEMENT, self.PREPARE_SELECT_HISTOGRAM)
+            cur.execute(self.EXECUTE_SELECT_HISTOGRAM, (values, offsets, candidates))
+            for sid, offset, count, hashes_matched in cur:
+                results.append((sid, offset, count))
+                dedup_hashes[sid] = hashes_matched
+
+        return results, dedup_hashes
+
+    def select_matches(self, cur, values: List[Union[str, int]],
+                       batch_size: int = ARRAY_BATCH_SIZE) -> Iterator[Tuple]:
+        """
+        Looks up the fingerprints of a set of hashes with a statement prepared once per connection, binding
+        up to batch_size hashes as a single array parameter. Queries with TEMP_TABLE_MIN_HASHES hashes or more
+        are copied to a temporary table and joined with the fingerprints at once instead.
+
+        :param cur: open cursor.
+        :param values: unique hashes, as given by normalize_hash.
+        :param batch_size: number of hashes per array.
+        :return: an iterator over the (hash, audio_id, offset) rows found.
+        """
+        if len(values) >= TEMP_TABLE_MIN_HASHES:
+            cur.execute(self.CREATE_QUERY_HASHES_TABLE)
+            cur.copy_expert(self.COPY_QUERY_HASHES, StringIO("".join(f"{value}\n" for value in values)))
+            prepare(cur, self.SELECT_TEMP_STATEMENT, self.PREPARE_SELECT_TEMP)
+            cur.execute(self.EXECUTE_SELECT_TEMP)
+            yield from cur
+            return
+
+        prepare(cur, self.SELECT_ARRAY_STATEMENT, self.PREPARE_SELECT_ARRAY)
+        for index in range(0, len(values), batch_size):
+            cur.execute(self.EXECUTE_SELECT_ARRAY, (values[index: index + batch_size],))
+            yield from cur
+
+    def iter_fingerprints(self, batch_size: int = MEMORY_INDEX_LOAD_BATCH_SIZE) \
+            -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Streams the whole fingerprints table through a server side cursor.
+
+        :param batch_size: number of rows fetched by each round trip.
+        :return: an iterator over (hashes, audio_indexes, offsets) arrays of up to batch_size fingerprints,
+        hashes as given by hash_to_int and audio indexes as given by audio_index.
+        """
+        with self.cursor(name=self.ITER_FINGERPRINTS_CURSOR) as cur:
+            cur.itersize = batch_size
+            cur.execute(self.SELECT_ALL_HASHES)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                hashes, audio_ids, offsets = zip(*rows)
+                yield (np.array(hashes, dtype=np.int64),
+                       np.fromiter((self.audio_index(audio_id) for audio_id in audio_ids), dtype=np.int32,
+                                   count=len(audio_ids)),
+                       np.array(offsets, dtype=np.int32))
+
+    def export_index_file(self, path: str, batch_size: int = MEMORY_INDEX_LOAD_BATCH_SIZE) -> int:
+        """
+        Builds a fingerprint index file (see dejavu.logic.index_file) with the whole fingerprints table. The
+        index is sorted in memory before being written.
+
+        :param path: path of the file, replaced if it exists.
+        :param batch_size: number of rows fetched by each round trip of the server side cursor.
+        :return: the number of fingerprints exported.
+        """
+        segment = IndexSegment.from_batches(self.iter_fingerprints(batch_size))
+        write_index_file(path, segment, self.audio_ids)
+        return len(segment)
+
+    def update_hash_stats(self, batch_size: int = HASH_STATS_BATCH_SIZE, full: bool = False) -> int:
+        """
+        Counts, for every hash, the audios (document frequency) and fingerprints it is found in. Only the
+        audios fingerprinted since the last update are counted, committing every batch_size audios, so the
+        update can be stopped and resumed. Deleted audios are taken out of the statistics as they are deleted.
+
+        :param batch_size: number of audios counted in each transaction.
+        :param full: whether to count every audio again from scratch.
+        :return: the number of audios counted.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_HASH_STATS_TABLES)
+            if full:
+                cur.execute(self.TRUNCATE_HASH_STATS)
+            cur.execute(self.SELECT_HASH_STATS_PENDING)
+            audio_ids = [audio_id for audio_id, in cur]
+
+        counted = 0
+        for index in range(0, len(audio_ids), batch_size):
+            batch = audio_ids[index: index + batch_size]
+            with self.cursor() as cur:
+                cur.execute(self.MARK_HASH_STATS_AUDIOS % ', '.join(['%s'] * len(batch)), batch)
+                marked = [audio_id for audio_id, in cur]
+                if marked:
+                    cur.execute(self.COUNT_HASH_STATS % ', '.join(['%s'] * len(marked)), marked)
+                counted += len(marked)
+            print(f"Counted the hashes of {index + len(batch)}/{len(audio_ids)} audios")
+
+        if self.stop_hashes is not None:
+            self.use_stop_hashes(self.stop_hashes.policy, self.stop_hashes.max_df, self.stop_hashes.cap)
+        return counted
+
+    def select_stop_hashes(self, max_df: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the hashes found in more than max_df audios from the hash statistics, see update_hash_stats.
+
+        :param max_df: number of audios a hash can be found in before it is a stop hash.
+        :return: a tuple of arrays (hashes, dfs), hashes as given by hash_to_int.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_HASH_STATS_TABLES)
+            cur.execute(self.SELECT_STOP_HASHES, (max_df,))
+            rows = cur.fetchall()
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys, dfs = zip(*rows)
+        return np.array(keys, dtype=np.int64), np.array(dfs, dtype=np.int64)
+
+    def delete_audios_by_id(self, audio_ids: List[str], batch_size: int = 1000) -> None:
+        """
+        Given a list of audio ids it deletes all audios specified and their corresponding fingerprints, which
+        are taken out of the hash statistics in the same transaction.
+
+        :param audio_ids: audio ids to be deleted from the database.
+        :param batch_size: number of query's batches.
+        """
+        for audio_id in audio_ids:
+            self.audio_cache.pop(audio_id, None)
+
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_HASH_STATS_EXISTS)
+            hash_stats = cur.fetchone()[0]
+            for index in range(0, len(audio_ids), batch_size):
+                batch = audio_ids[index: index + batch_size]
+                in_values = ', '.join(['%s'] * len(batch))
+                if hash_stats:
+                    cur.execute(self.DISCOUNT_HASH_STATS % in_values, batch)
+                cur.execute(self.DELETE_AUDIOS % in_values, batch)
+            if hash_stats:
+                cur.execute(self.DELETE_EMPTY_HASH_STATS)
+
+    @staticmethod
+    def copy_hash(hsh: Union[str, int]) -> bytes:
+        """
+        :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+        :return: the hash as a binary COPY BYTEA value.
+        """
+        return bytes.fromhex(hash_to_hex(hsh))
+
     def insert_matched_information(self, id: str, audio_id: str, audio_name: str, audio_md5: str,total_time: float,
                                    fingerprint_time: float, query_time: float, align_time: float, date_created: str, related_key: str):
         with self.cursor() as cur:
@@ -309,63 +760,416 @@ class PostgreSQLDatabase(CommonDatabase):
         return self._options,
 
     def __setstate__(self, state):
+        super().__init__()
         self._options, = state
         self.cursor = cursor_factory(**self._options)
 
 
+class PostgreSQLBigIntDatabase(PostgreSQLDatabase):
+    """
+    PostgreSQL database storing fingerprint hashes as BIGINT with a btree index, so hashes go to and come back
+    from the queries as plain integers, with no hex encoding on either side. 'packed' hashes are stored as
+    they are, 'sha1' hashes keep their first 64 bits (see hash_to_int).
+
+    A catalog created by PostgreSQLDatabase is converted in place with migrate_hashes.
+    """
+    type = "postgres_bigint"
+
+    CREATE_FINGERPRINTS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS "{FINGERPRINTS_TABLE_NAME}" (
+            "{FIELD_HASH}" BIGINT NOT NULL
+        ,   "{FIELD_AUDIO_ID}" CHAR(32) NOT NULL
+        ,   "{FIELD_OFFSET}" INT NOT NULL
+        ,   "date_created" TIMESTAMP NOT NULL DEFAULT now()
+        ,   "date_modified" TIMESTAMP NOT NULL DEFAULT now()
+        ,   CONSTRAINT "uq_{FINGERPRINTS_TABLE_NAME}" UNIQUE  ("{FIELD_AUDIO_ID}", "{FIELD_OFFSET}", "{FIELD_HASH}")
+        ,   CONSTRAINT "fk_{FINGERPRINTS_TABLE_NAME}_{FIELD_AUDIO_ID}" FOREIGN KEY ("{FIELD_AUDIO_ID}")
+                REFERENCES "{AUDIOS_TABLE_NAME}"("{FIELD_AUDIO_ID}") ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS "ix_{FINGERPRINTS_TABLE_NAME}_{FIELD_HASH}" ON "{FINGERPRINTS_TABLE_NAME}"
+        USING btree ("{FIELD_HASH}");
+    """
+
+    CREATE_FINGERPRINTS_TABLE_INDEX = f"""
+        CREATE INDEX "ix_{FINGERPRINTS_TABLE_NAME}_{FIELD_HASH}" ON "{FINGERPRINTS_TABLE_NAME}"
+        USING btree ("{FIELD_HASH}");
+    """
+
+    INSERT_FINGERPRINT = f"""
+        INSERT INTO "{FINGERPRINTS_TABLE_NAME}" (
+                "{FIELD_AUDIO_ID}"
+            ,   "{FIELD_HASH}"
+            ,   "{FIELD_OFFSET}")
+        VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;
+    """
+
+    # BULK INSERTS
+    # named apart from the BYTEA staging table, pooled connections may be shared with PostgreSQLDatabase.
+    CREATE_FINGERPRINTS_STAGING_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "{FINGERPRINTS_STAGING_TABLE_NAME}_bigint" (
+            "{FIELD_HASH}" BIGINT NOT NULL
+        ,   "{FIELD_AUDIO_ID}" CHAR(32) NOT NULL
+        ,   "{FIELD_OFFSET}" INT NOT NULL
+        ) ON COMMIT DELETE ROWS;
+    """
+
+    COPY_FINGERPRINTS = f"""
+        COPY "{FINGERPRINTS_STAGING_TABLE_NAME}_bigint" ("{FIELD_HASH}", "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}")
+        FROM STDIN WITH (FORMAT binary);
+    """
+
+    MERGE_FINGERPRINTS = f"""
+        INSERT INTO "{FINGERPRINTS_TABLE_NAME}" ("{FIELD_AUDIO_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}")
+        SELECT "{FIELD_AUDIO_ID}", "{FIELD_HASH}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_STAGING_TABLE_NAME}_bigint"
+        ON CONFLICT DO NOTHING;
+    """
+
+    # SELECTS
+    SELECT = f"""
+        SELECT "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}"
+        WHERE "{FIELD_HASH}" = %s;
+    """
+
+    SELECT_MULTIPLE = f"""
+        SELECT "{FIELD_HASH}", "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}"
+        WHERE "{FIELD_HASH}" IN (%s);
+    """
+
+    SELECT_LIMITED = f"""
+        SELECT "{FIELD_HASH}", "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}"
+        WHERE "{FIELD_HASH}" = %s
+        LIMIT %s;
+    """
+
+    SELECT_ALL_HASHES = f"""
+        SELECT "{FIELD_HASH}", "{FIELD_AUDIO_ID}", "{FIELD_OFFSET}"
+        FROM "{FINGERPRINTS_TABLE_NAME}";
+    """
+
+    # ARRAY LOOKUPS
+    SELECT_ARRAY_STATEMENT = "select_hashes_array_bigint"
+
+    PREPARE_SELECT_ARRAY = f"""
+        PREPARE "{SELECT_ARRAY_STATEMENT}" (bigint[]) AS
+        SELECT q."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+        FROM unnest($1) AS q("{FIELD_HASH}")
+        JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    EXECUTE_SELECT_ARRAY = f'EXECUTE "{SELECT_ARRAY_STATEMENT}" (%s);'
+
+    CREATE_QUERY_HASHES_TABLE = f"""
+        CREATE TEMPORARY TABLE IF NOT EXISTS "query_hashes_bigint" ("{FIELD_HASH}" BIGINT NOT NULL)
+        ON COMMIT DELETE ROWS;
+    """
+
+    COPY_QUERY_HASHES = f'COPY "query_hashes_bigint" ("{FIELD_HASH}") FROM STDIN;'
+
+    SELECT_TEMP_STATEMENT = "select_hashes_temp_bigint"
+
+    PREPARE_SELECT_TEMP = f"""
+        PREPARE "{SELECT_TEMP_STATEMENT}" AS
+        SELECT q."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+        FROM "query_hashes_bigint" q
+        JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = q."{FIELD_HASH}";
+    """
+
+    EXECUTE_SELECT_TEMP = f'EXECUTE "{SELECT_TEMP_STATEMENT}";'
+
+    # OFFSET HISTOGRAM
+    SELECT_HISTOGRAM_STATEMENT = "select_offset_histogram_bigint"
+
+    PREPARE_SELECT_HISTOGRAM = f"""
+        PREPARE "{SELECT_HISTOGRAM_STATEMENT}" (bigint[], int[], int) AS
+        WITH "query" AS (
+            SELECT q."{FIELD_HASH}" AS "{FIELD_HASH}", q."{FIELD_OFFSET}"
+            FROM unnest($1, $2) AS q("{FIELD_HASH}", "{FIELD_OFFSET}")
+        ), "matched" AS (
+            SELECT f."{FIELD_HASH}", f."{FIELD_AUDIO_ID}", f."{FIELD_OFFSET}"
+            FROM (SELECT DISTINCT "{FIELD_HASH}" FROM "query") u
+            JOIN "{FINGERPRINTS_TABLE_NAME}" f ON f."{FIELD_HASH}" = u."{FIELD_HASH}"
+        ), "histogram" AS (
+            SELECT m."{FIELD_AUDIO_ID}", m."{FIELD_OFFSET}" - q."{FIELD_OFFSET}" AS "difference", count(*) AS "count"
+            FROM "matched" m
+            JOIN "query" q ON q."{FIELD_HASH}" = m."{FIELD_HASH}"
+            GROUP BY m."{FIELD_AUDIO_ID}", m."{FIELD_OFFSET}" - q."{FIELD_OFFSET}"
+        ), "ranked" AS (
+            SELECT "{FIELD_AUDIO_ID}", "difference", "count", row_number() OVER (
+                PARTITION BY "{FIELD_AUDIO_ID}" ORDER BY "count" DESC, "difference") AS "rank"
+            FROM "histogram"
+        ), "hashes_matched" AS (
+            SELECT "{FIELD_AUDIO_ID}", count(*) AS "count"
+            FROM "matched"
+            GROUP BY "{FIELD_AUDIO_ID}"
+        )
+        SELECT r."{FIELD_AUDIO_ID}", r."difference", r."count", h."count"
+        FROM "ranked" r
+        JOIN "hashes_matched" h ON h."{FIELD_AUDIO_ID}" = r."{FIELD_AUDIO_ID}"
+        WHERE r."rank" <= $3
+        ORDER BY r."{FIELD_AUDIO_ID}", r."rank";
+    """
+
+    EXECUTE_SELECT_HISTOGRAM = f'EXECUTE "{SELECT_HISTOGRAM_STATEMENT}" (%s, %s, %s);'
+
+    # HASH STATISTICS
+    CREATE_HASH_STATS_TABLES = f"""
+        CREATE TABLE IF NOT EXISTS "{HASH_STATS_TABLE_NAME}" (
+            "{FIELD_HASH}" BIGINT NOT NULL
+        ,   "{FIELD_HASH_AUDIOS}" INT NOT NULL
+        ,   "{FIELD_HASH_POSTINGS}" BIGINT NOT NULL
+        ,   CONSTRAINT "pk_{HASH_STATS_TABLE_NAME}_{FIELD_HASH}" PRIMARY KEY ("{FIELD_HASH}")
+        );
+
+        CREATE INDEX IF NOT EXISTS "ix_{HASH_STATS_TABLE_NAME}_{FIELD_HASH_AUDIOS}" ON "{HASH_STATS_TABLE_NAME}"
+        USING btree ("{FIELD_HASH_AUDIOS}");
+
+        CREATE TABLE IF NOT EXISTS "{HASH_STATS_AUDIOS_TABLE_NAME}" (
+            "{FIELD_AUDIO_ID}" CHAR(32) NOT NULL
+        ,   CONSTRAINT "pk_{HASH_STATS_AUDIOS_TABLE_NAME}_{FIELD_AUDIO_ID}" PRIMARY KEY ("{FIELD_AUDIO_ID}")
+        ,   CONSTRAINT "fk_{HASH_STATS_AUDIOS_TABLE_NAME}_{FIELD_AUDIO_ID}" FOREIGN KEY ("{FIELD_AUDIO_ID}")
+                REFERENCES "{AUDIOS_TABLE_NAME}"("{FIELD_AUDIO_ID}") ON DELETE CASCADE
+        );
+    """
+
+    SELECT_STOP_HASHES = f"""
+        SELECT "{FIELD_HASH}", "{FIELD_HASH_AUDIOS}"
+        FROM "{HASH_STATS_TABLE_NAME}"
+        WHERE "{FIELD_HASH_AUDIOS}" > %s;
+    """
+
+    # MIGRATION FROM BYTEA HASHES
+    SELECT_HASH_TYPE = f"""
+        SELECT "data_type"
+        FROM "information_schema"."columns"
+        WHERE "table_name" = '{FINGERPRINTS_TABLE_NAME}' AND "column_name" = '{FIELD_HASH}'
+        AND "table_schema" = current_schema();
+    """
+
+    MIGRATE_ADD_COLUMN = f"""
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" ADD COLUMN IF NOT EXISTS "{FIELD_HASH}_bigint" BIGINT;
+    """
+
+    MIGRATE_SELECT_AUDIO_IDS = f'SELECT "{FIELD_AUDIO_ID}" FROM "{AUDIOS_TABLE_NAME}" ORDER BY "{FIELD_AUDIO_ID}";'
+
+    # the first 8 bytes of the hash, read as a big endian signed integer.
+    MIGRATE_CONVERT = f"""
+        UPDATE "{FINGERPRINTS_TABLE_NAME}"
+        SET "{FIELD_HASH}_bigint" = ('x' || encode(substring("{FIELD_HASH}" FROM 1 FOR 8), 'hex'))::bit(64)::bigint
+        WHERE "{FIELD_HASH}_bigint" IS NULL
+    """
+
+    MIGRATE_CONVERT_AUDIOS = MIGRATE_CONVERT + f' AND "{FIELD_AUDIO_ID}" IN (%s);'
+
+    MIGRATE_LOCK = f'LOCK TABLE "{FINGERPRINTS_TABLE_NAME}" IN ACCESS EXCLUSIVE MODE;'
+
+    MIGRATE_SWAP_COLUMNS = f"""
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" DROP CONSTRAINT "uq_{FINGERPRINTS_TABLE_NAME}";
+        DROP INDEX IF EXISTS "ix_{FINGERPRINTS_TABLE_NAME}_{FIELD_HASH}";
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" DROP COLUMN "{FIELD_HASH}";
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" RENAME COLUMN "{FIELD_HASH}_bigint" TO "{FIELD_HASH}";
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" ALTER COLUMN "{FIELD_HASH}" SET NOT NULL;
+        ALTER TABLE "{FINGERPRINTS_TABLE_NAME}" ADD CONSTRAINT "uq_{FINGERPRINTS_TABLE_NAME}"
+            UNIQUE ("{FIELD_AUDIO_ID}", "{FIELD_OFFSET}", "{FIELD_HASH}");
+        CREATE INDEX "ix_{FINGERPRINTS_TABLE_NAME}_{FIELD_HASH}" ON "{FINGERPRINTS_TABLE_NAME}"
+        USING btree ("{FIELD_HASH}");
+        DROP TABLE IF EXISTS "{HASH_STATS_AUDIOS_TABLE_NAME}", "{HASH_STATS_TABLE_NAME}";
+    """
+
+    # IN
+    IN_MATCH = "%s"
+
+    def setup(self) -> None:
+        """
+        Called on creation or shortly afterwards, a catalog still storing BYTEA hashes has to be migrated.
+        """
+        super().setup()
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_HASH_TYPE)
+            hash_type = cur.fetchone()[0]
+        if hash_type != "bigint":
+            print(f"The {FINGERPRINTS_TABLE_NAME} table stores {hash_type} hashes, "
+                  f"run `python dejavu.py --migrate-hashes` to convert them.")
+
+    def normalize_hash(self, hsh: Union[str, int]) -> int:
+        """
+        :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+        :return: the hash as a signed 64-bit integer.
+        """
+        return hash_to_int(hsh)
+
+    @staticmethod
+    def copy_hash(hsh: Union[str, int]) -> bytes:
+        """
+        :param hsh: a 'sha1' hash (hexadecimal string) or a 'packed' hash (64-bit integer).
+        :return: the hash as a binary COPY BIGINT value.
+        """
+        return struct.pack(">q", hash_to_int(hsh))
+
+    def migrate_hashes(self, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+        """
+        Converts in place a fingerprints table storing BYTEA hashes to BIGINT ones. The hashes are copied
+        to a new column committing every batch_size audios, so the migration can be stopped and resumed, and
+        the table only gets locked at the end to swap the columns and rebuild the indexes. Fingerprints keep
+        being inserted and queried in the old format until then. The hash statistics are dropped, they have
+        to be counted again with update_hash_stats.
+
+        :param batch_size: number of audios whose fingerprints are converted in each transaction.
+        :return: the number of fingerprints converted.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_HASH_TYPE)
+            if cur.fetchone()[0] == "bigint":
+                return 0
+            cur.execute(self.MIGRATE_ADD_COLUMN)
+            cur.execute(self.MIGRATE_SELECT_AUDIO_IDS)
+            audio_ids = [audio_id for audio_id, in cur]
+
+        converted = 0
+        for index in range(0, len(audio_ids), batch_size):
+            batch = audio_ids[index: index + batch_size]
+            with self.cursor() as cur:
+                cur.execute(self.MIGRATE_CONVERT_AUDIOS % ', '.join(['%s'] * len(batch)), batch)
+                converted += cur.rowcount
+            print(f"Converted the fingerprints of {index + len(batch)}/{len(audio_ids)} audios")
+
+        # fingerprints inserted meanwhile are converted once nothing else can write to the table.
+        with self.cursor() as cur:
+            cur.execute(self.MIGRATE_LOCK)
+            cur.execute(self.MIGRATE_CONVERT)
+            converted += cur.rowcount
+            cur.execute(self.MIGRATE_SWAP_COLUMNS)
+
+        return converted
+
+
+def copy_buffer(audio_id: str, hashes: List[Tuple[Union[str, int], int]],
+                encode_hash: Callable[[Union[str, int]], bytes] = PostgreSQLDatabase.copy_hash) -> BytesIO:
+    """
+    Encodes fingerprint rows in the binary COPY format.
+
+    :param audio_id: Song identifier the fingerprints belong to.
+    :param hashes: A sequence of tuples in the format (hash, offset).
+    :param encode_hash: converts a hash to the binary value of the hash column.
+    :return: a buffer with the header, a (hash, audio_id, offset) tuple per fingerprint and the trailer.
+    """
+    audio_id = audio_id.encode('ascii')
+    row_formats = {}
+    buffer = BytesIO()
+    buffer.write(COPY_HEADER)
+    for hsh, offset in hashes:
+        hsh = encode_hash(hsh)
+        row_format = row_formats.get(len(hsh))
+        if row_format is None:
+            # field count, then the length and value of each field.
+            row_format = row_formats[len(hsh)] = struct.Struct(f">hi{len(hsh)}si{len(audio_id)}sii")
+        buffer.write(row_format.pack(3, len(hsh), hsh, len(audio_id), audio_id, 4, int(offset)))
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def prepare(cur, name: str, statement: str) -> None:
+    """
+    Prepares a statement on the connection of the cursor, unless it was already prepared on it.
+
+    :param cur: open cursor.
+    :param name: name of the prepared statement.
+    :param statement: PREPARE statement.
+    """
+    if name not in cur.connection.prepared:
+        cur.execute(statement)
+        cur.connection.prepared.add(name)
+
+
+class Connection(connection):
+    """
+    psycopg2 connection keeping track of the statements prepared on it, prepared statements live as long
+    as the session.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
 def cursor_factory(**factory_options):
-    def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+    factory_options = dict(factory_options)
+    pool_options = factory_options.pop("pool", {})
+    key = pool_key(dict(factory_options, pool=pool_options))
 
+    def connect():
+        return psycopg2.connect(connection_factory=Connection, **factory_options)
+
+    def pool():
+        return get_pool(key, lambda: ConnectionPool(connect, _ping, _close, **pool_options))
+
+    def cursor(dictionary=False, name=None, **options):
+        # psycopg2 cursors are buffered unless named, the buffered option only matters to mysql.
+        return Cursor(pool(), dictionary=dictionary, name=name)
+
+    cursor.pool = pool
     return cursor
 
 
+def _ping(conn) -> bool:
+    if conn.closed:
+        return False
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1;")
+    conn.rollback()
+    return True
+
+
+def _close(conn) -> None:
+    conn.close()
+
+
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Takes a connection from the pool and returns an open cursor, the transaction
+    is committed on exit, or rolled back if an exception was raised. Named cursors
+    are server side ones, their rows are fetched as they are iterated.
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
         cur.execute(query)
         ...
     """
 
-    def __init__(self, dictionary=False, **options):
+    def __init__(self, pool: ConnectionPool, dictionary=False, name=None):
         super().__init__()
-
-        self._cache = queue.Queue(maxsize=5)
-
-        try:
-            conn = self._cache.get_nowait()
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-        except queue.Empty:
-            conn = psycopg2.connect(**options)
-
-        self.conn = conn
+        self.pool = pool
         self.dictionary = dictionary
-
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        self.name = name
 
     def __enter__(self):
-        if self.dictionary:
-            self.cursor = self.conn.cursor(cursor_factory=DictCursor)
-        else:
-            self.cursor = self.conn.cursor()
+        self.conn = self.pool.acquire()
+        try:
+            if self.dictionary:
+                self.cursor = self.conn.cursor(self.name, cursor_factory=DictCursor)
+            else:
+                self.cursor = self.conn.cursor(self.name)
+        except psycopg2.Error:
+            self.pool.release(self.conn, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a PostgreSQL related error we try to rollback the cursor.
-        if extype is psycopg2.DatabaseError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
+        broken = False
         try:
-            self._cache.put_nowait(self.conn)
-        except queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except psycopg2.Error:
+            if extype is None:
+                self.pool.release(self.conn, broken=True)
+                raise
+            broken = True
+
+        # Put it back on the pool, unless the connection was lost.
+        self.pool.release(self.conn, broken=broken or bool(self.conn.closed))
@@ -0,0 +1,62 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# added to the offset differences so they fit the low 32 bits of the combined keys as non negative values.
+OFFSET_BIAS = 2 ** 31
+
+
+def count_offsets(audio_indexes: np.ndarray, offsets: np.ndarray, candidates: int = 1,
+                  weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts how many matches each audio has at each offset difference and keeps the most matched ones.
+
+    Every (audio, offset) pair is combined in a single int64 key, so the whole histogram is a single
+    np.unique call over the matches.
+
+    :param audio_indexes: dense index of the audio of each match.
+    :param offsets: offset difference (database offset - sampled offset) of each match.
+    :param candidates: number of offset differences kept per audio.
+    :param weights: what each match counts, 1 for every match when None.
+    :return: a tuple of arrays (audio_indexes, offsets, counts) with up to `candidates` rows per audio, sorted
+    by audio and then by decreasing count, the smallest offset first on ties.
+    """
+    if not len(audio_indexes):
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+
+    keys = (np.asarray(audio_indexes, dtype=np.int64) << 32) | (np.asarray(offsets, dtype=np.int64) + OFFSET_BIAS)
+    if weights is None:
+        keys, counts = np.unique(keys, return_counts=True)
+    else:
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights)
+    key_audios = (keys >> 32).astype(np.int32)
+    key_offsets = ((keys & 0xFFFFFFFF) - OFFSET_BIAS).astype(np.int32)
+
+    # the keys come sorted by audio and offset, sort each audio by decreasing count.
+    order = np.lexsort((key_offsets, -counts, key_audios))
+    key_audios, key_offsets, counts = key_audios[order], key_offsets[order], counts[order]
+
+    # rank of every row within its audio.
+    starts = np.flatnonzero(np.r_[True, key_audios[1:] != key_audios[:-1]])
+    lengths = np.diff(np.r_[starts, len(key_audios)])
+    ranks = np.arange(len(key_audios)) - np.repeat(starts, lengths)
+
+    keep = ranks < candidates
+    return key_audios[keep], key_offsets[keep], counts[keep]
+
+
+def top_counts(counts: np.ndarray, topn: int) -> np.ndarray:
+    """
+    :param counts: number of aligned matches of each candidate.
+    :param topn: number of candidates wanted.
+    :return: the positions of the topn highest counts, highest first, the lowest position first on ties.
+    """
+    counts = np.asarray(counts)
+    if topn <= 0:
+        return np.zeros(0, dtype=np.intp)
+
+    top = np.arange(len(counts))
+    if len(counts) > topn:
+        top = np.argpartition(-counts, topn - 1)[:topn]
+    return top[np.lexsort((top, -counts[top]))]
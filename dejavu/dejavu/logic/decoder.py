@@ -1,13 +1,16 @@
 import fnmatch
+import io
 import os
-from hashlib import sha1
-from typing import List, Tuple
+from hashlib import md5, sha1
+from math import gcd
+from typing import Iterator, List, Tuple
 
 import numpy as np
 from pydub import AudioSegment
-from pydub.utils import audioop
+from scipy.signal import resample_poly
 
-from dejavu.third_party import wavio
+from dejavu.config.settings import CHANNEL_STRATEGIES, CHANNEL_STRATEGY
+from dejavu.logic import ffmpeg_decoder, wav_reader
 
 
 def unique_hash(file_path: str, block_size: int = 2**20) -> str:
@@ -32,10 +35,20 @@ def unique_hash(file_path: str, block_size: int = 2**20) -> str:
 
 
 def unique_md5(file_path: str) -> str:
+    return file_digests(file_path)[1]
 
-    with open(file_path, 'rb') as fp:
-        data = fp.read()
-    return sha1.md5(data).hexdigest()
+
+def file_digests(file_path: str, block_size: int = 2**20) -> Tuple[str, str]:
+    """
+    Computes both the sha1 (as unique_hash does) and the md5 of a file with a single read.
+
+    :param file_path: path to file.
+    :param block_size: read block size.
+    :return: tuple of (sha1, md5) in an hexagesimal string form.
+    """
+    digests = [sha1(), md5()]
+    _update_digests(file_path, digests, block_size)
+    return _hexdigests(digests)
 
 
 def find_files(path: str, extensions: List[str]) -> List[Tuple[str, str]]:
@@ -46,60 +59,172 @@ def find_files(path: str, extensions: List[str]) -> List[Tuple[str, str]]:
     :param extensions: file extensions to look for.
     :return: a list of tuples with file name and its extension.
     """
+    return list(iter_files(path, extensions))
+
+
+def iter_files(path: str, extensions: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Lazy version of find_files, files are yielded while the directory tree is still being walked.
+
+    :param path: path to a directory with audio files.
+    :param extensions: file extensions to look for.
+    :return: an iterator over tuples with file name and its extension.
+    """
     # Allow both with ".mp3" and without "mp3" to be used for extensions
     extensions = [e.replace(".", "") for e in extensions]
 
-    results = []
     for dirpath, dirnames, files in os.walk(path):
         for extension in extensions:
             for f in fnmatch.filter(files, f"*.{extension}"):
                 p = os.path.join(dirpath, f)
-                results.append((p, extension))
-    return results
+                yield p, extension
 
 
-def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
+def read(file_name: str, limit: int = None, fs: int = None, start: float = None)\
+        -> Tuple[List[List[int]], int, str]:
     """
-    Reads any file supported by pydub (ffmpeg) and returns the data contained
-    within. If file reading fails due to input being a 24-bit wav file,
-    wavio is used as a backup.
+    Reads any file supported by ffmpeg and returns the data contained within.
+    PCM WAV files are memory mapped, other files are piped straight out of
+    ffmpeg when it is available, otherwise pydub is used.
 
     Can be optionally limited to a certain amount of seconds from the start
     of the file by specifying the `limit` parameter. This is the amount of
-    seconds from the start of the file.
+    seconds from the start of the file, or from `start` if given, in which
+    case the decoder seeks to it and nothing before it is decoded.
+
+    Can be optionally resampled to the analysis sampling rate `fs`.
 
     :param file_name: file to be read.
     :param limit: number of seconds to limit.
+    :param fs: sampling rate to resample the channels to, None keeps the file rate.
+    :param start: second to start reading from.
     :return: tuple list of (channels, sample_rate, content_file_hash).
     """
-    # pydub does not support 24-bit wav files, use wavio when this occurs
-    try:
-        audiofile = AudioSegment.from_file(file_name)
+    channels, frame_rate, file_hash, _ = read_hashed(file_name, limit=limit, fs=fs, start=start)
+    return channels, frame_rate, file_hash
+
+
+def read_hashed(file_name: str, limit: int = None, fs: int = None, start: float = None)\
+        -> Tuple[List[np.ndarray], int, str, str]:
+    """
+    Same as read, but the sha1 and md5 of the file are computed from the same bytes fed to the decoder, so
+    the file is read from disk only once.
+
+    :param file_name: file to be read.
+    :param limit: number of seconds to limit.
+    :param fs: sampling rate to resample the channels to, None keeps the file rate.
+    :param start: second to start reading from.
+    :return: tuple of (channels, sample_rate, sha1, md5).
+    """
+    digests = [sha1(), md5()]
+
+    channels = None
+    if wav_reader.is_wav(file_name):
+        try:
+            channels, frame_rate = wav_reader.read(file_name, limit=limit, start=start)
+        except wav_reader.WavFormatError:
+            # compressed or exotic wav files are left to ffmpeg.
+            pass
+        else:
+            # the mapped samples are then served from the pages this read brought into memory.
+            _update_digests(file_name, digests)
+
+    if channels is None and ffmpeg_decoder.available():
+        # limit and resampling are applied by ffmpeg itself, before anything reaches us.
+        channels, frame_rate = ffmpeg_decoder.read(file_name, limit=limit, fs=fs, start=start, digests=digests)
+        return (channels, frame_rate, *_hexdigests(digests))
+
+    if channels is None:
+        with open(file_name, "rb") as f:
+            content = f.read()
+        for digest in digests:
+            digest.update(content)
+
+        audiofile = AudioSegment.from_file(io.BytesIO(content), format=os.path.splitext(file_name)[1][1:] or None)
+        del content
+
+        if start:
+            audiofile = audiofile[start * 1000:]
 
         if limit:
             audiofile = audiofile[:limit * 1000]
 
-        data = np.fromstring(audiofile.raw_data, np.int16)
+        data = np.frombuffer(audiofile.raw_data, np.int16)
 
         channels = []
         for chn in range(audiofile.channels):
             channels.append(data[chn::audiofile.channels])
 
-        audiofile.frame_rate
-    except audioop.error:
-        _, _, audiofile = wavio.readwav(file_name)
+        frame_rate = audiofile.frame_rate
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+    if fs and fs != frame_rate:
+        channels = resample(channels, frame_rate, fs)
+        frame_rate = fs
 
-        audiofile = audiofile.T
-        audiofile = audiofile.astype(np.int16)
+    return (channels, frame_rate, *_hexdigests(digests))
 
-        channels = []
-        for chn in audiofile:
-            channels.append(chn)
 
-    return channels, audiofile.frame_rate, unique_hash(file_name)
+def _update_digests(file_path: str, digests: list, block_size: int = 2**20) -> None:
+    with open(file_path, "rb") as f:
+        while True:
+            buf = f.read(block_size)
+            if not buf:
+                break
+            for digest in digests:
+                digest.update(buf)
+
+
+def _hexdigests(digests: list) -> Tuple[str, str]:
+    # sha1 is kept upper case, as unique_hash returns it.
+    file_sha1, file_md5 = digests
+    return file_sha1.hexdigest().upper(), file_md5.hexdigest()
+
+
+def resample(channels: List[np.ndarray], fs: int, target_fs: int) -> List[np.ndarray]:
+    """
+    Resamples the channels with a polyphase filter, which includes the anti-aliasing low pass filter.
+
+    :param channels: list of channels, each one an array of samples.
+    :param fs: current sampling rate.
+    :param target_fs: sampling rate to resample to.
+    :return: the resampled channels, as float32 arrays.
+    """
+    if fs == target_fs:
+        return list(channels)
+
+    divisor = gcd(int(fs), int(target_fs))
+    up, down = int(target_fs) // divisor, int(fs) // divisor
+    return [resample_poly(np.asarray(channel, dtype=np.float32), up, down).astype(np.float32, copy=False)
+            for channel in channels]
+
+
+def select_channels(channels: List[np.ndarray], strategy: str = CHANNEL_STRATEGY) -> List[np.ndarray]:
+    """
+    Applies the channel strategy to the decoded channels.
+
+    :param channels: list of channels, each one an array of samples.
+    :param strategy: one of CHANNEL_STRATEGIES, 'per_channel' returns the channels as they are, 'mono' a single
+    channel with their average and 'best' the single channel with the highest energy.
+    :return: list of channels to fingerprint.
+    """
+    if strategy not in CHANNEL_STRATEGIES:
+        raise ValueError(f"Unsupported channel strategy {strategy}, use one of {CHANNEL_STRATEGIES}.")
+
+    if strategy == 'per_channel' or len(channels) <= 1:
+        return list(channels)
+
+    if strategy == 'mono':
+        mono = np.asarray(channels[0], dtype=np.float32).copy()
+        for channel in channels[1:]:
+            mono += channel
+        mono /= len(channels)
+        return [mono]
+
+    energies = []
+    for channel in channels:
+        channel = np.asarray(channel, dtype=np.float64)
+        energies.append(np.dot(channel, channel))
+    return [channels[int(np.argmax(energies))]]
 
 
 def get_audio_name_from_path(file_path: str) -> str:
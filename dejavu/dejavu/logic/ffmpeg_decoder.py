@@ -0,0 +1,248 @@
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (DECODER_BLOCK_SIZE, FFMPEG_BINARY,
+                                    FFPROBE_BINARY)
+
+# bytes of a s16le sample
+SAMPLE_WIDTH = 2
+
+# formats whose index may sit at the end of the file, ffmpeg needs to seek so they cannot be fed through a pipe.
+UNSEEKABLE_FORMATS = {"mov", "mp4", "m4a", "3gp", "3g2", "mj2"}
+
+# bytes read from the file at once when ffmpeg is fed through its stdin.
+FEED_BLOCK_SIZE = 2 ** 20
+
+
+def available() -> bool:
+    """
+    :return: whether both ffmpeg and ffprobe can be found.
+    """
+    return shutil.which(FFMPEG_BINARY) is not None and shutil.which(FFPROBE_BINARY) is not None
+
+
+def probe(file_name: str) -> Tuple[int, int, float]:
+    """
+    Reads the format of the first audio stream of a file with ffprobe.
+
+    :param file_name: file to be probed.
+    :return: tuple of (sample_rate, channels, duration in seconds), the duration is None if unknown.
+    """
+    sample_rate, channels, duration, _ = _probe(file_name)
+    return sample_rate, channels, duration
+
+
+def _probe(file_name: str) -> Tuple[int, int, float, List[str]]:
+    command = [FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+               "-show_entries", "stream=sample_rate,channels,duration:format=duration,format_name",
+               "-of", "json", file_name]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise DecodingError(f"ffprobe failed on {file_name}: {process.stderr.decode('utf-8', 'replace').strip()}")
+
+    info = json.loads(process.stdout.decode('utf-8'))
+    if not info.get("streams"):
+        raise DecodingError(f"{file_name} has no audio stream")
+
+    stream, container = info["streams"][0], info.get("format", {})
+    duration = stream.get("duration") or container.get("duration")
+    return (int(stream["sample_rate"]), int(stream["channels"]), float(duration) if duration else None,
+            container.get("format_name", "").split(","))
+
+
+def read(file_name: str, limit: float = None, fs: int = None, start: float = None, channels: int = None,
+         block_size: int = DECODER_BLOCK_SIZE, digests: list = None) -> Tuple[List[np.ndarray], int]:
+    """
+    Decodes a whole file (or the requested window of it) with ffmpeg.
+
+    The s16le output of ffmpeg is read from the pipe straight into a buffer preallocated from the duration
+    reported by ffprobe, in blocks of block_size frames, so the samples are neither copied nor held twice.
+    Channels are returned as strided views over that buffer.
+
+    If hashlib objects are given in digests, the file is read once by this process which updates them and
+    feeds ffmpeg through its stdin at the same time, so hashing the file takes no extra read. Formats ffmpeg
+    has to seek into (mp4 and alike), and any file decoded from a start second, are hashed by a second,
+    concurrent read instead: ffmpeg can't seek in a pipe, it would decode and drop everything before start.
+
+    :param file_name: file to be read.
+    :param limit: number of seconds to decode, None decodes until the end of the file.
+    :param fs: sampling rate ffmpeg resamples to, None keeps the file rate.
+    :param start: second to start decoding from, ffmpeg seeks to it before decoding.
+    :param channels: number of channels ffmpeg mixes the audio to, None keeps the file layout.
+    :param block_size: number of frames read from the pipe at once.
+    :param digests: hashlib objects updated with the whole content of the file.
+    :return: tuple of (channels, sample_rate).
+    """
+    frame_rate, n_channels, duration, formats = _output_format(file_name, limit, fs, start, channels)
+
+    seconds = duration if duration is not None else limit
+    capacity = int((seconds or 0) * frame_rate) + block_size
+    buffer = np.empty((capacity, n_channels), dtype=np.int16)
+
+    frames = 0
+    feed = digests is not None and not start and not UNSEEKABLE_FORMATS.intersection(formats)
+    with _open_pipe(file_name, limit, fs, start, channels, feed=feed) as process:
+        feeder = None
+        if digests is not None:
+            feeder = threading.Thread(target=_feed, args=(file_name, digests, process if feed else None))
+            feeder.start()
+
+        while True:
+            if frames + block_size > len(buffer):
+                # the reported duration fell short (e.g. vbr mp3s), grow geometrically.
+                buffer = np.concatenate((buffer[:frames], np.empty((len(buffer), n_channels), dtype=np.int16)))
+
+            read_frames = _read_block(process.stdout, buffer[frames:frames + block_size])
+            frames += read_frames
+            if read_frames < block_size:
+                break
+
+        if feeder:
+            feeder.join()
+        _check_process(process, file_name)
+
+    data = buffer[:frames]
+    return [data[:, chn] for chn in range(n_channels)], frame_rate
+
+
+def read_stream(file_name: str, limit: float = None, fs: int = None, start: float = None, channels: int = None,
+                block_size: int = DECODER_BLOCK_SIZE) -> Tuple[Iterator[List[np.ndarray]], int, int]:
+    """
+    Chunked version of read, the file is decoded as it is consumed so memory usage does not depend on the
+    length of the audio.
+
+    Every block is read into the same preallocated buffer, so the yielded channel views are only valid until
+    the next block is requested and have to be copied to be kept.
+
+    :param file_name: file to be read.
+    :param limit: number of seconds to decode, None decodes until the end of the file.
+    :param fs: sampling rate ffmpeg resamples to, None keeps the file rate.
+    :param start: second to start decoding from, ffmpeg seeks to it before decoding.
+    :param channels: number of channels ffmpeg mixes the audio to, None keeps the file layout.
+    :param block_size: number of frames of each block.
+    :return: tuple of (iterator over lists with a view per channel of each block, sample_rate, channels).
+    """
+    frame_rate, n_channels, _, _ = _output_format(file_name, limit, fs, start, channels)
+
+    def blocks() -> Iterator[List[np.ndarray]]:
+        buffer = np.empty((block_size, n_channels), dtype=np.int16)
+        with _open_pipe(file_name, limit, fs, start, channels) as process:
+            while True:
+                read_frames = _read_block(process.stdout, buffer)
+                if read_frames:
+                    yield [buffer[:read_frames, chn] for chn in range(n_channels)]
+                if read_frames < block_size:
+                    break
+
+            _check_process(process, file_name)
+
+    return blocks(), frame_rate, n_channels
+
+
+def _output_format(file_name: str, limit: float, fs: int, start: float, channels: int)\
+        -> Tuple[int, int, float, List[str]]:
+    frame_rate, n_channels, duration, formats = _probe(file_name)
+    if duration is not None and start:
+        duration = max(duration - start, 0)
+    if duration is not None and limit is not None:
+        duration = min(duration, limit)
+    return fs or frame_rate, channels or n_channels, duration, formats
+
+
+def _open_pipe(file_name: str, limit: float, fs: int, start: float, channels: int,
+               feed: bool = False) -> subprocess.Popen:
+    command = [FFMPEG_BINARY, "-nostdin", "-v", "error"]
+    # as input options ffmpeg seeks and stops at the source instead of decoding and dropping the samples.
+    if start:
+        command += ["-ss", str(start)]
+    if limit is not None:
+        command += ["-t", str(limit)]
+    command += ["-i", "pipe:0" if feed else file_name, "-vn", "-map", "0:a:0", "-f", "s16le", "-acodec", "pcm_s16le"]
+    if fs:
+        command += ["-ar", str(fs)]
+    if channels:
+        command += ["-ac", str(channels)]
+    command += ["-"]
+
+    # stderr goes to a file rather than a pipe, which ffmpeg would block on once full while stdout is still read.
+    errors = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=errors)
+    except BaseException:
+        errors.close()
+        raise
+    # closed along with the pipes when the process is exited, and read back by _check_process.
+    process.stderr = errors
+    return process
+
+
+def _feed(file_name: str, digests: list, process: subprocess.Popen = None) -> None:
+    """
+    Reads the whole file updating the digests and, if a process is given, writes it to its stdin as well.
+
+    :param file_name: file to be read.
+    :param digests: hashlib objects to update.
+    :param process: ffmpeg process reading the file from its stdin.
+    """
+    stdin = process.stdin if process else None
+    with open(file_name, "rb") as f:
+        while True:
+            block = f.read(FEED_BLOCK_SIZE)
+            if not block:
+                break
+            for digest in digests:
+                digest.update(block)
+            if stdin:
+                try:
+                    stdin.write(block)
+                except OSError:
+                    # ffmpeg already stopped reading (e.g. once the limit was reached), keep on hashing.
+                    _close(stdin)
+                    stdin = None
+    if stdin:
+        _close(stdin)
+
+
+def _close(stdin) -> None:
+    # closing flushes the pending bytes, which fails if ffmpeg is gone but closes the pipe anyway.
+    try:
+        stdin.close()
+    except OSError:
+        pass
+
+
+def _read_block(pipe, block: np.ndarray) -> int:
+    """
+    Fills a block of frames from the pipe, it only reads less than the whole block at the end of the stream.
+
+    :param pipe: stdout of the ffmpeg process.
+    :param block: C contiguous frames x channels int16 array to read into.
+    :return: number of complete frames read.
+    """
+    view = memoryview(block).cast('B')
+    filled = 0
+    while filled < len(view):
+        read_bytes = pipe.readinto(view[filled:])
+        if not read_bytes:
+            break
+        filled += read_bytes
+    return filled // (SAMPLE_WIDTH * block.shape[1])
+
+
+def _check_process(process: subprocess.Popen, file_name: str) -> None:
+    process.stdout.close()
+    if process.wait() != 0:
+        process.stderr.seek(0)
+        stderr = process.stderr.read()
+        raise DecodingError(f"ffmpeg failed on {file_name}: {stderr.decode('utf-8', 'replace').strip()}")
+
+
+class DecodingError(Exception):
+    pass
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+from typing import Optional
+
+from dejavu.logic.decoder import unique_hash
+
+
+class FileManifest(object):
+    """
+    Local record of the content hash of already scanned files, keyed by their path, size and modification
+    time, so rescanning a directory only hashes the files that were added or modified since the last scan.
+
+    It is stored as a single sqlite file. The instance may be used from several threads, as long as they do
+    not use it at the same time.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT NOT NULL PRIMARY KEY
+            ,   size INTEGER NOT NULL
+            ,   mtime INTEGER NOT NULL
+            ,   sha1 TEXT NOT NULL
+            );
+        """)
+        self.connection.commit()
+
+    def get(self, file_path: str, stat: os.stat_result = None) -> Optional[str]:
+        """
+        Looks up the content hash of a file.
+
+        :param file_path: path to the file.
+        :param stat: result of os.stat on the file, it is taken if not given.
+        :return: the sha1 of the file, or None if the file is unknown or changed since it was hashed.
+        """
+        stat = stat or os.stat(file_path)
+        row = self.connection.execute(
+            "SELECT sha1 FROM files WHERE path = ? AND size = ? AND mtime = ?;",
+            (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, file_path: str, file_hash: str, stat: os.stat_result = None) -> None:
+        """
+        Records the content hash of a file, call commit to persist it.
+
+        :param file_path: path to the file.
+        :param file_hash: sha1 of the file, as given by decoder.unique_hash.
+        :param stat: result of os.stat on the file taken before hashing it, it is taken if not given.
+        """
+        stat = stat or os.stat(file_path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime, sha1) VALUES (?, ?, ?, ?);",
+            (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, file_hash)
+        )
+
+    def hash(self, file_path: str) -> str:
+        """
+        Content hash of a file, only computed if the file is unknown or changed since it was hashed.
+
+        :param file_path: path to the file.
+        :return: the sha1 of the file.
+        """
+        stat = os.stat(file_path)
+        file_hash = self.get(file_path, stat)
+        if file_hash is None:
+            file_hash = unique_hash(file_path)
+            self.put(file_path, file_hash, stat)
+            self.commit()
+        return file_hash
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,63 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Tuple
+
+from dejavu.config.settings import HASHING_THREADS
+from dejavu.logic.decoder import iter_files, unique_hash
+from dejavu.logic.file_manifest import FileManifest
+
+
+def scan_files(path: str, extensions: List[str], nthreads: int = HASHING_THREADS,
+               manifest: FileManifest = None) -> Iterator[Tuple[str, str]]:
+    """
+    Walks a directory and hashes the files found in a thread pool, yielding each file as soon as its hash is
+    known, so the consumer can start working while the scan is still running. Hashing is I/O bound, hence
+    threads are enough to keep several reads in flight.
+
+    Files whose path, size and modification time are in the manifest are not hashed again, and the ones
+    hashed are added to it.
+
+    :param path: path to a directory with audio files.
+    :param extensions: file extensions to look for.
+    :param nthreads: amount of threads hashing files.
+    :param manifest: manifest of already hashed files.
+    :return: an iterator over tuples with file name and its sha1, in no particular order.
+    """
+    # bound the files hashed ahead of the consumer, so a huge tree is not buffered in memory.
+    max_pending = nthreads * 4
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            file_name, stat = pending.pop(future)
+            try:
+                file_hash = future.result()
+            except OSError as err:
+                print(f"Cannot hash {file_name}: {str(err)}, skipping...")
+                continue
+            if manifest:
+                manifest.put(file_name, file_hash, stat)
+            yield file_name, file_hash
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        try:
+            for file_name, _ in iter_files(path, extensions):
+                try:
+                    stat = os.stat(file_name)
+                except OSError:
+                    # removed while scanning
+                    continue
+                file_hash = manifest.get(file_name, stat) if manifest else None
+                if file_hash:
+                    yield file_name, file_hash
+                    continue
+
+                pending[executor.submit(unique_hash, file_name)] = (file_name, stat)
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from collect(done)
+
+            yield from collect(list(pending))
+        finally:
+            if manifest:
+                manifest.commit()
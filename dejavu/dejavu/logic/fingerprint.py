@@ -1,11 +1,10 @@
 import hashlib
-from operator import itemgetter
-from typing import List, Tuple
+import multiprocessing
+from typing import Iterable, Iterator, List, Tuple, Union
 
-import matplotlib.mlab as mlab
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.ndimage.filters import maximum_filter
+from scipy.ndimage.filters import (maximum_filter, maximum_filter1d,
+                                   minimum_filter1d)
 from scipy.ndimage.morphology import (binary_erosion,
                                       generate_binary_structure,
                                       iterate_structure)
@@ -13,9 +12,16 @@ from scipy.ndimage.morphology import (binary_erosion,
 from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
                                     DEFAULT_FAN_VALUE, DEFAULT_FS,
                                     DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
-                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
-                                    MIN_HASH_TIME_DELTA,
+                                    FINGERPRINT_HASH_FORMAT,
+                                    FINGERPRINT_REDUCTION, HASH_FORMATS,
+                                    MAX_HASH_TIME_DELTA, MIN_HASH_TIME_DELTA,
+                                    PACKED_HASH_DELTA_BITS,
+                                    PACKED_HASH_FREQ_BITS,
+                                    PARALLEL_FINGERPRINT_SEGMENT_SECONDS,
+                                    PEAK_DENSITY, PEAK_DENSITY_BANDS,
+                                    PEAK_DENSITY_SLICE_SECONDS,
                                     PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.spectrogram import spectrogram
 
 
 def fingerprint(channel_samples: List[int],
@@ -23,7 +29,9 @@ def fingerprint(channel_samples: List[int],
                 wsize: int = DEFAULT_WINDOW_SIZE,
                 wratio: float = DEFAULT_OVERLAP_RATIO,
                 fan_value: int = DEFAULT_FAN_VALUE,
-                amp_min: int = DEFAULT_AMP_MIN) -> List[Tuple[str, int]]:
+                amp_min: int = DEFAULT_AMP_MIN,
+                hash_format: str = FINGERPRINT_HASH_FORMAT,
+                peak_density: float = PEAK_DENSITY) -> List[Tuple[Union[str, int], int]]:
     """
     FFT the channel, log transform output, find local maxima, then return locally sensitive hashes.
 
@@ -33,23 +41,215 @@ def fingerprint(channel_samples: List[int],
     :param wratio: ratio by which each sequential window overlaps the last and the next window.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
+    :param peak_density: if given, target amount of peaks per second, see PEAK_DENSITY.
     :return: a list of hashes with their corresponding offsets.
     """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
+    # FFT the signal and extract frequency components, already log transformed (in dB).
+    arr2D = spectrogram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
 
-    # Apply log transform since specgram function returns linear array. 0s are excluded to avoid np warning.
-    arr2D = 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
-
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    if peak_density:
+        freqs, times, amps = get_2D_peak_arrays(arr2D, amp_min=amp_min, return_amps=True)
+        keep = select_peaks(freqs, times, amps, arr2D.shape[0],
+                            *_density_parameters(peak_density, Fs=Fs, wsize=wsize, wratio=wratio))
+        freqs, times = freqs[keep], times[keep]
+    else:
+        freqs, times = get_2D_peak_arrays(arr2D, amp_min=amp_min)
 
     # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+    hashes, offsets = generate_hash_arrays(np.column_stack((freqs, times)), fan_value=fan_value,
+                                           hash_format=hash_format)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def fingerprint_stream(chunks: Iterable[np.ndarray],
+                       Fs: int = DEFAULT_FS,
+                       wsize: int = DEFAULT_WINDOW_SIZE,
+                       wratio: float = DEFAULT_OVERLAP_RATIO,
+                       fan_value: int = DEFAULT_FAN_VALUE,
+                       amp_min: int = DEFAULT_AMP_MIN,
+                       hash_format: str = FINGERPRINT_HASH_FORMAT,
+                       peak_density: float = PEAK_DENSITY) -> Iterator[List[Tuple[Union[str, int], int]]]:
+    """
+    Streaming version of fingerprint, it takes the channel as consecutive blocks of samples and yields the
+    hashes as soon as they can no longer change. Only the context needed to produce exactly the same output
+    as fingerprint does is kept between blocks, that is the samples of the window overlap, the spectrogram
+    columns of a peak neighborhood and the last peaks not yet paired with fan_value neighbors, so memory
+    usage does not depend on the length of the audio.
+
+    Peaks are always paired in time order, hence the output matches fingerprint only when PEAK_SORT is set
+    (the default).
+
+    :param chunks: iterable of 1-D arrays with consecutive samples of a single channel.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
+    :param peak_density: if given, target amount of peaks per second, see PEAK_DENSITY.
+    :return: an iterator over lists of hashes with their corresponding offsets, which concatenated are the
+    same list fingerprint would return for the whole channel.
+    """
+    hop = wsize - int(wsize * wratio)
+    # the peak of a column depends on the PEAK_NEIGHBORHOOD_SIZE columns at each side of it.
+    context = PEAK_NEIGHBORHOOD_SIZE
+
+    pending = np.zeros(0, dtype=np.int16)  # samples not consumed by a window yet
+    columns = None  # spectrogram columns kept for the peak neighborhoods
+    columns_start = 0  # index of the first column in columns
+    peaks_done = 0  # columns whose peaks were already extracted
+    carry = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))  # peaks not fully paired yet
+    if peak_density:
+        slice_columns, peaks_per_band = _density_parameters(peak_density, Fs=Fs, wsize=wsize, wratio=wratio)
+        # peaks of the time slice not complete yet, they can only be selected once the whole slice is known.
+        unselected = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+    framed = False  # whether at least one window was taken from the signal
+
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        final = chunk is None
+
+        if not final:
+            pending = np.concatenate((pending, np.asarray(chunk)))
+
+        new_columns = None
+        if len(pending) >= wsize:
+            n_frames = 1 + (len(pending) - wsize) // hop
+            new_columns = spectrogram(pending[:(n_frames - 1) * hop + wsize], Fs=Fs, wsize=wsize, wratio=wratio)
+            pending = pending[n_frames * hop:]
+            framed = True
+        elif final and not framed:
+            # signals shorter than a window are zero padded to a single window by the spectrogram
+            new_columns = spectrogram(pending, Fs=Fs, wsize=wsize, wratio=wratio)
+
+        if new_columns is not None:
+            columns = new_columns if columns is None else np.concatenate((columns, new_columns), axis=1)
+
+        if columns is None:
+            continue
+
+        columns_end = columns_start + columns.shape[1]
+        peaks_until = columns_end if final else columns_end - context
+        if peaks_until <= peaks_done:
+            continue
+
+        # peaks_done - context >= columns_start always holds, so every column gets its whole neighborhood
+        # or the true border of the spectrogram.
+        freqs, times, amps = get_2D_peak_arrays(columns, amp_min=amp_min, return_amps=True)
+        times = times + columns_start
+        keep = (times >= peaks_done) & (times < peaks_until)
+        freqs, times = freqs[keep], times[keep]
+        if peak_density:
+            freqs, times, amps = (np.concatenate((unselected[0], freqs)), np.concatenate((unselected[1], times)),
+                                  np.concatenate((unselected[2], amps[keep])))
+            complete = times < (peaks_until if final else peaks_until - peaks_until % slice_columns)
+            unselected = (freqs[~complete], times[~complete], amps[~complete])
+            freqs, times, amps = freqs[complete], times[complete], amps[complete]
+            keep = select_peaks(freqs, times, amps, columns.shape[0], slice_columns, peaks_per_band)
+            freqs, times = freqs[keep], times[keep]
+        order = np.argsort(times, kind='stable')
+        freqs = np.concatenate((carry[0], freqs[order]))
+        times = np.concatenate((carry[1], times[order]))
+
+        peaks_done = peaks_until
+        drop = max(peaks_done - context - columns_start, 0)
+        columns = columns[:, drop:]
+        columns_start += drop
+
+        # a peak is fully paired once its fan_value - 1 successors are known.
+        n_anchors = len(times) if final else max(len(times) - (fan_value - 1), 0)
+        hashes, offsets = _hash_peak_arrays(freqs, times, fan_value, hash_format, n_anchors=n_anchors)
+        carry = (freqs[n_anchors:], times[n_anchors:])
+
+        if len(offsets):
+            yield list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def fingerprint_parallel(channel_samples: np.ndarray,
+                         Fs: int = DEFAULT_FS,
+                         wsize: int = DEFAULT_WINDOW_SIZE,
+                         wratio: float = DEFAULT_OVERLAP_RATIO,
+                         fan_value: int = DEFAULT_FAN_VALUE,
+                         amp_min: int = DEFAULT_AMP_MIN,
+                         hash_format: str = FINGERPRINT_HASH_FORMAT,
+                         peak_density: float = PEAK_DENSITY,
+                         nprocesses: int = None,
+                         segment_seconds: float = PARALLEL_FINGERPRINT_SEGMENT_SECONDS)\
+        -> List[Tuple[Union[str, int], int]]:
+    """
+    Parallel version of fingerprint for long channels, it returns exactly the same list.
+
+    The spectrogram columns are split in segments and the peaks of each segment are found in a process pool,
+    every worker reads PEAK_NEIGHBORHOOD_SIZE extra columns at each side so peaks next to the seams see their
+    whole neighborhood. Peaks are already in global column coordinates, so they are just concatenated and
+    paired in a single pass afterwards, hence no pair across a seam is lost or duplicated.
+
+    :param channel_samples: channel samples to fingerprint.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
+    :param peak_density: if given, target amount of peaks per second, see PEAK_DENSITY.
+    :param nprocesses: amount of processes, all the available cpus if not given.
+    :param segment_seconds: length in seconds of each segment.
+    :return: a list of hashes with their corresponding offsets.
+    """
+    samples = np.asarray(channel_samples)
+    hop = wsize - int(wsize * wratio)
+    n_columns = 1 + (len(samples) - wsize) // hop if len(samples) >= wsize else 1
+    segment_columns = max(int(segment_seconds * Fs / hop), 1)
+    density = _density_parameters(peak_density, Fs=Fs, wsize=wsize, wratio=wratio) if peak_density else None
+    if density:
+        # segments hold whole time slices, so the strongest peaks of each slice are selected by a single worker.
+        segment_columns += -segment_columns % density[0]
+
+    try:
+        nprocesses = nprocesses or multiprocessing.cpu_count()
+    except NotImplementedError:
+        nprocesses = 1
+
+    if nprocesses <= 1 or n_columns <= segment_columns:
+        return fingerprint(samples, Fs=Fs, wsize=wsize, wratio=wratio, fan_value=fan_value, amp_min=amp_min,
+                           hash_format=hash_format, peak_density=peak_density)
+
+    context = PEAK_NEIGHBORHOOD_SIZE
+    segments = []
+    for first in range(0, n_columns, segment_columns):
+        last = min(first + segment_columns, n_columns)
+        # columns [start, end) are analysed, only the peaks in [first, last) are kept.
+        start, end = max(first - context, 0), min(last + context, n_columns)
+        segments.append((samples[start * hop:(end - 1) * hop + wsize], start, first, last, Fs, wsize, wratio,
+                         amp_min, density))
+
+    with multiprocessing.Pool(min(nprocesses, len(segments))) as pool:
+        peaks = pool.map(_segment_peaks, segments)
+
+    freqs = np.concatenate([segment_freqs for segment_freqs, _ in peaks])
+    times = np.concatenate([segment_times for _, segment_times in peaks])
+
+    hashes, offsets = generate_hash_arrays(np.column_stack((freqs, times)), fan_value=fan_value,
+                                           hash_format=hash_format)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def _segment_peaks(arguments) -> Tuple[np.ndarray, np.ndarray]:
+    # Pool.map sends arguments as tuples so we have to unpack them ourself.
+    samples, start, first, last, Fs, wsize, wratio, amp_min, density = arguments
+
+    arr2D = spectrogram(samples, Fs=Fs, wsize=wsize, wratio=wratio)
+    freqs, times, amps = get_2D_peak_arrays(arr2D, amp_min=amp_min, return_amps=True)
+    times = times + start
+    keep = (times >= first) & (times < last)
+    freqs, times, amps = freqs[keep], times[keep], amps[keep]
+    if density:
+        keep = select_peaks(freqs, times, amps, arr2D.shape[0], *density)
+        freqs, times = freqs[keep], times[keep]
+    return freqs, times
 
 
 def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN)\
@@ -62,6 +262,112 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
     :return: a list composed by a list of frequencies and times.
     """
+    freqs_filter, times_filter = get_2D_peak_arrays(arr2D, amp_min=amp_min)
+
+    if plot:
+        import matplotlib.pyplot as plt
+
+        # scatter of the peaks
+        fig, ax = plt.subplots()
+        ax.imshow(arr2D)
+        ax.scatter(times_filter, freqs_filter)
+        ax.set_xlabel('Time')
+        ax.set_ylabel('Frequency')
+        ax.set_title("Spectrogram")
+        plt.gca().invert_yaxis()
+        plt.show()
+
+    return list(zip(freqs_filter, times_filter))
+
+
+def get_2D_peak_arrays(arr2D: np.array, amp_min: int = DEFAULT_AMP_MIN, return_amps: bool = False)\
+        -> Tuple[np.ndarray, ...]:
+    """
+    Columnar version of get_2D_peaks.
+
+    :param arr2D: matrix representing the spectogram.
+    :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param return_amps: whether to return the amplitudes of the peaks as well.
+    :return: an array with the frequencies of the peaks and another one with their times, followed by another
+    one with their amplitudes if return_amps is set.
+    """
+    if CONNECTIVITY_MASK == 2:
+        detected_peaks = _square_peaks_mask(arr2D, PEAK_NEIGHBORHOOD_SIZE)
+    else:
+        detected_peaks = _morphology_peaks_mask(arr2D, CONNECTIVITY_MASK)
+
+    # extract peaks
+    amps = arr2D[detected_peaks]
+    freqs, times = np.where(detected_peaks)
+
+    # filter peaks
+    amps = amps.flatten()
+
+    # get indices for frequency and time
+    filter_idxs = np.where(amps > amp_min)
+
+    if return_amps:
+        return freqs[filter_idxs], times[filter_idxs], amps[filter_idxs]
+    return freqs[filter_idxs], times[filter_idxs]
+
+
+def select_peaks(freqs: np.ndarray, times: np.ndarray, amps: np.ndarray, n_bins: int, slice_columns: int,
+                 peaks_per_band: int, bands: int = PEAK_DENSITY_BANDS) -> np.ndarray:
+    """
+    Selects the peaks_per_band strongest peaks of each time slice and frequency band, which bounds the amount
+    of peaks (and therefore hashes) per second regardless of how dense the audio is. Ties in amplitude are
+    broken by frequency and time, so the selection does not depend on the order of the peaks.
+
+    :param freqs: frequency of each peak.
+    :param times: time of each peak, slices are aligned to multiples of slice_columns.
+    :param amps: amplitude of each peak.
+    :param n_bins: amount of frequency bins of the spectrogram.
+    :param slice_columns: amount of spectrogram columns of each time slice.
+    :param peaks_per_band: maximum amount of peaks kept per time slice and frequency band.
+    :param bands: amount of equally wide frequency bands.
+    :return: a boolean mask with the peaks to keep.
+    """
+    band = np.minimum(freqs * bands // n_bins, bands - 1)
+    group = (times // slice_columns) * bands + band
+
+    # by group, then from the strongest to the weakest peak.
+    order = np.lexsort((times, freqs, -amps, group))
+    sorted_groups = group[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(order) else order
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+
+    keep = np.zeros(len(freqs), dtype=bool)
+    keep[order[rank < peaks_per_band]] = True
+    return keep
+
+
+def _density_parameters(peak_density: float, Fs: int = DEFAULT_FS, wsize: int = DEFAULT_WINDOW_SIZE,
+                        wratio: float = DEFAULT_OVERLAP_RATIO) -> Tuple[int, int]:
+    """
+    Translates a target amount of peaks per second to spectrogram units.
+
+    :param peak_density: target amount of peaks per second.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :return: the amount of columns of each time slice and the amount of peaks kept per slice and band.
+    """
+    hop = wsize - int(wsize * wratio)
+    slice_columns = max(int(round(PEAK_DENSITY_SLICE_SECONDS * Fs / hop)), 1)
+    peaks_per_band = max(int(round(peak_density * slice_columns * hop / Fs / PEAK_DENSITY_BANDS)), 1)
+    return slice_columns, peaks_per_band
+
+
+def _morphology_peaks_mask(arr2D: np.array, connectivity: int = CONNECTIVITY_MASK,
+                           neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE) -> np.ndarray:
+    """
+    Boolean mask of the spectrogram with True at its local maxima, for any morphology mask.
+
+    :param arr2D: matrix representing the spectogram.
+    :param connectivity: connectivity of the morphology mask, see CONNECTIVITY_MASK.
+    :param neighborhood_size: number of cells around a peak, see PEAK_NEIGHBORHOOD_SIZE.
+    :return: a boolean matrix with the shape of arr2D.
+    """
     # Original code from the repo is using a morphology mask that does not consider diagonal elements
     # as neighbors (basically a diamond figure) and then applies a dilation over it, so what I'm proposing
     # is to change from the current diamond figure to a just a normal square one:
@@ -73,14 +379,14 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     # I've made now the mask shape configurable in order to allow both ways of find maximum peaks.
     # That being said, we generate the mask by using the following function
     # https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.generate_binary_structure.html
-    struct = generate_binary_structure(2, CONNECTIVITY_MASK)
+    struct = generate_binary_structure(2, connectivity)
 
     #  And then we apply dilation using the following function
     #  http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.iterate_structure.html
     #  Take into account that if PEAK_NEIGHBORHOOD_SIZE is 2 you can avoid the use of the scipy functions and just
     #  change it by the following code:
     #  neighborhood = np.ones((PEAK_NEIGHBORHOOD_SIZE * 2 + 1, PEAK_NEIGHBORHOOD_SIZE * 2 + 1), dtype=bool)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+    neighborhood = iterate_structure(struct, neighborhood_size)
 
     # find local maxima using our filter mask
     local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
@@ -90,67 +396,164 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
 
     # Boolean mask of arr2D with True at peaks (applying XOR on both matrices).
-    detected_peaks = local_max != eroded_background
+    return local_max != eroded_background
 
-    # extract peaks
-    amps = arr2D[detected_peaks]
-    freqs, times = np.where(detected_peaks)
 
-    # filter peaks
-    amps = amps.flatten()
+def _square_peaks_mask(arr2D: np.array, neighborhood_size: int = PEAK_NEIGHBORHOOD_SIZE) -> np.ndarray:
+    """
+    Same as _morphology_peaks_mask for the square mask (CONNECTIVITY_MASK = 2), but way faster.
 
-    # get indices for frequency and time
-    filter_idxs = np.where(amps > amp_min)
+    Dilating the 3x3 square neighborhood_size times gives a (2 * neighborhood_size + 1) square, so both the
+    maximum filter and the erosion are separable and can be done as two 1-D passes. Besides, the eroded
+    background is empty whenever the spectrogram has no exact zeros, so the erosion is skipped in that case.
 
-    freqs_filter = freqs[filter_idxs]
-    times_filter = times[filter_idxs]
+    :param arr2D: matrix representing the spectogram.
+    :param neighborhood_size: number of cells around a peak, see PEAK_NEIGHBORHOOD_SIZE.
+    :return: a boolean matrix with the shape of arr2D.
+    """
+    size = 2 * neighborhood_size + 1
 
-    if plot:
-        # scatter of the peaks
-        fig, ax = plt.subplots()
-        ax.imshow(arr2D)
-        ax.scatter(times_filter, freqs_filter)
-        ax.set_xlabel('Time')
-        ax.set_ylabel('Frequency')
-        ax.set_title("Spectrogram")
-        plt.gca().invert_yaxis()
-        plt.show()
+    local_max = maximum_filter1d(maximum_filter1d(arr2D, size, axis=0), size, axis=1) == arr2D
 
-    return list(zip(freqs_filter, times_filter))
+    if arr2D.all():
+        return local_max
 
+    # binary erosion with a border value of 1 is a minimum filter with a constant border of 1.
+    background = (arr2D == 0).view(np.uint8)
+    eroded_background = minimum_filter1d(
+        minimum_filter1d(background, size, axis=0, mode='constant', cval=1),
+        size, axis=1, mode='constant', cval=1
+    )
 
-def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE) -> List[Tuple[str, int]]:
+    return local_max != eroded_background.view(bool)
+
+
+def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE,
+                    hash_format: str = FINGERPRINT_HASH_FORMAT) -> List[Tuple[Union[str, int], int]]:
     """
     Hash list structure:
        sha1_hash[0:FINGERPRINT_REDUCTION]    time_offset
         [(e05b341a9b77a51fd26, 32), ... ]
+    or, for the 'packed' hash format:
+       freq1 | freq2 | t_delta               time_offset
+        [(3298534883528, 32), ... ]
 
     :param peaks: list of peak frequencies and times.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
     :return: a list of hashes with their corresponding offsets.
     """
-    # frequencies are in the first position of the tuples
-    idx_freq = 0
-    # times are in the second position of the tuples
-    idx_time = 1
+    hashes, offsets = generate_hash_arrays(peaks, fan_value=fan_value, hash_format=hash_format)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def generate_hash_arrays(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE,
+                         hash_format: str = FINGERPRINT_HASH_FORMAT) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Columnar version of generate_hashes, all the (i, i + j) pairs of peaks within the fan value are built
+    at once and filtered by MIN_HASH_TIME_DELTA and MAX_HASH_TIME_DELTA with masks.
+
+    :param peaks: list (or n x 2 array) of peak frequencies and times.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
+    :return: an array of hashes (int64 for 'packed', strings for 'sha1') and an int32 array with their
+    corresponding offsets.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+    # frequencies are in the first column and times in the second one
+    freqs, times = peaks[:, 0], peaks[:, 1]
 
     if PEAK_SORT:
-        peaks.sort(key=itemgetter(1))
+        order = np.argsort(times, kind='stable')
+        freqs, times = freqs[order], times[order]
+
+    return _hash_peak_arrays(freqs, times, fan_value, hash_format)
+
 
-    hashes = []
-    for i in range(len(peaks)):
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks):
+def _hash_peak_arrays(freqs: np.ndarray, times: np.ndarray, fan_value: int, hash_format: str,
+                      n_anchors: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hashes the pairs of the given (already sorted) peaks.
+
+    :param freqs: frequency of each peak.
+    :param times: time of each peak.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param hash_format: format of the generated hashes, one of HASH_FORMATS.
+    :param n_anchors: if given, only pairs starting at the first n_anchors peaks are hashed.
+    :return: an array of hashes and an int32 array with their corresponding offsets.
+    """
+    if hash_format not in HASH_FORMATS:
+        raise ValueError(f"Unsupported hash format {hash_format}, use one of {HASH_FORMATS}.")
 
-                freq1 = peaks[i][idx_freq]
-                freq2 = peaks[i + j][idx_freq]
-                t1 = peaks[i][idx_time]
-                t2 = peaks[i + j][idx_time]
-                t_delta = t2 - t1
+    anchors, targets = _pair_indices(times, fan_value, n_anchors=n_anchors)
+    t_delta = times[targets] - times[anchors]
+    keys = pack_hashes(freqs[anchors], freqs[targets], t_delta)
+    offsets = times[anchors].astype(np.int32)
 
-                if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(f"{str(freq1)}|{str(freq2)}|{str(t_delta)}".encode('utf-8'))
+    if hash_format == 'packed':
+        return keys, offsets
+
+    # the same (freq1, freq2, t_delta) triplet shows up many times, so sha1 is only computed once per triplet.
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    freq1, freq2, delta = unpack_hashes(unique_keys)
+    digests = np.array([
+        hashlib.sha1(f"{str(f1)}|{str(f2)}|{str(dt)}".encode('utf-8')).hexdigest()[0:FINGERPRINT_REDUCTION]
+        for f1, f2, dt in zip(freq1.tolist(), freq2.tolist(), delta.tolist())
+    ], dtype=f'U{FINGERPRINT_REDUCTION}')
+
+    return digests[inverse.reshape(-1)], offsets
+
+
+def pack_hashes(freq1: np.ndarray, freq2: np.ndarray, t_delta: np.ndarray) -> np.ndarray:
+    """
+    Packs the (freq1, freq2, t_delta) fields of a fingerprint into 64-bit integers.
+
+    :param freq1: frequency bins of the anchor peaks.
+    :param freq2: frequency bins of the paired peaks.
+    :param t_delta: time distances between both peaks.
+    :return: an int64 array with the packed hashes.
+    """
+    freq1 = np.asarray(freq1, dtype=np.int64)
+    freq2 = np.asarray(freq2, dtype=np.int64)
+    t_delta = np.asarray(t_delta, dtype=np.int64)
+    return ((freq1 << (PACKED_HASH_FREQ_BITS + PACKED_HASH_DELTA_BITS))
+            | (freq2 << PACKED_HASH_DELTA_BITS)
+            | t_delta)
+
+
+def unpack_hashes(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Inverse of pack_hashes.
+
+    :param hashes: packed hashes.
+    :return: a tuple of arrays with freq1, freq2 and t_delta.
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    freq_mask = (1 << PACKED_HASH_FREQ_BITS) - 1
+    delta_mask = (1 << PACKED_HASH_DELTA_BITS) - 1
+    freq1 = (hashes >> (PACKED_HASH_FREQ_BITS + PACKED_HASH_DELTA_BITS)) & freq_mask
+    freq2 = (hashes >> PACKED_HASH_DELTA_BITS) & freq_mask
+    return freq1, freq2, hashes & delta_mask
+
+
+def _pair_indices(times: np.ndarray, fan_value: int, n_anchors: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Builds the indices of every (i, i + j) pair of peaks, 1 <= j < fan_value, whose time distance lies
+    within MIN_HASH_TIME_DELTA and MAX_HASH_TIME_DELTA. Pairs are returned in the same order the original
+    nested loop generated them (by i, then by j).
+
+    :param times: time of each peak.
+    :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param n_anchors: if given, only pairs starting at the first n_anchors peaks are built.
+    :return: anchor and target indices of the pairs.
+    """
+    n = len(times)
+    anchors = np.arange(n if n_anchors is None else n_anchors)[:, np.newaxis]
+    targets = anchors + np.arange(1, max(fan_value, 1))[np.newaxis, :]
 
-                    hashes.append((h.hexdigest()[0:FINGERPRINT_REDUCTION], t1))
+    in_range = targets < n
+    targets = np.minimum(targets, max(n - 1, 0))
+    t_delta = times[targets] - times[anchors] if n else np.zeros(targets.shape, dtype=np.int64)
+    mask = in_range & (MIN_HASH_TIME_DELTA <= t_delta) & (t_delta <= MAX_HASH_TIME_DELTA)
 
-    return hashes
+    return np.broadcast_to(anchors, targets.shape)[mask], targets[mask]
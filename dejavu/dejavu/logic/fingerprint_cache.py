@@ -0,0 +1,207 @@
+import json
+import os
+from hashlib import sha1
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
+                                    DEFAULT_FAN_VALUE, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE,
+                                    FINGERPRINT_CACHE_MAX_SIZE,
+                                    FINGERPRINT_CACHE_SCAN_INTERVAL,
+                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
+                                    MIN_HASH_TIME_DELTA,
+                                    PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+
+# every setting that changes the generated hashes, they are part of the cache key.
+FINGERPRINT_SETTINGS = {
+    "wsize": DEFAULT_WINDOW_SIZE,
+    "wratio": DEFAULT_OVERLAP_RATIO,
+    "fan_value": DEFAULT_FAN_VALUE,
+    "amp_min": DEFAULT_AMP_MIN,
+    "connectivity_mask": CONNECTIVITY_MASK,
+    "peak_neighborhood_size": PEAK_NEIGHBORHOOD_SIZE,
+    "min_hash_time_delta": MIN_HASH_TIME_DELTA,
+    "max_hash_time_delta": MAX_HASH_TIME_DELTA,
+    "peak_sort": PEAK_SORT,
+    "fingerprint_reduction": FINGERPRINT_REDUCTION,
+}
+
+# fraction of max_size the cache is brought down to when evicting, so a full cache isn't scanned on every put.
+EVICTION_TARGET = 0.9
+
+# size in bytes of each cache directory as last known by this process, and entries stored since it was scanned.
+# Kept per process rather than per instance, since pool workers get a new copy of the cache with every task.
+_usage: Dict[str, List[int]] = {}
+
+
+class FingerprintCache(object):
+    """
+    Local directory with the fingerprints of already processed files, so decoding and fingerprinting the same
+    file again (e.g. after a db rebuild or when retrying a job) can be skipped.
+
+    Entries are keyed by the content hash of the file plus every parameter affecting its hashes, and stored as
+    uncompressed .npz files holding an array of hashes and an int32 array of offsets. Once the directory grows
+    over max_size bytes the least recently used entries are evicted.
+
+    The digests of every file seen are also recorded by path, size and modification time (see get_digests), so
+    cached files are looked up without reading them, and the others are hashed by the same read that decodes
+    them.
+    """
+    EXTENSION = ".npz"
+    DIGESTS_EXTENSION = ".digests"
+
+    def __init__(self, path: str, max_size: int = FINGERPRINT_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(file_hash: str, **parameters) -> str:
+        """
+        Builds the cache key of a file.
+
+        :param file_hash: content hash of the file, as given by decoder.unique_hash.
+        :param parameters: every option used to decode and fingerprint the file (limit, analysis_fs,
+        channel_strategy, fingerprint options...).
+        :return: the key of the file in the cache.
+        """
+        parameters = dict(FINGERPRINT_SETTINGS, **parameters)
+        serialized = json.dumps(parameters, sort_keys=True, default=str)
+        return sha1(f"{file_hash.upper()}|{serialized}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Tuple[Union[str, int], int]]]:
+        """
+        Looks up the fingerprints of a file.
+
+        :param key: key of the file in the cache.
+        :return: a list of hashes with their corresponding offsets, or None if the file is not cached.
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                hashes, offsets = entry["hashes"], entry["offsets"]
+        except (OSError, KeyError, ValueError):
+            # missing, evicted by another process or partially written entries are just a miss.
+            return None
+
+        # bump the entry so it becomes the most recently used one.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        if hashes.dtype.kind == 'S':
+            hashes = hashes.astype(str)
+        return list(zip(hashes.tolist(), offsets.tolist()))
+
+    def get_digests(self, file_path: str, stat: os.stat_result = None) -> Optional[Tuple[str, str]]:
+        """
+        Looks up the digests recorded for a file by put_digests.
+
+        :param file_path: path to the file.
+        :param stat: result of os.stat on the file, it is taken if not given.
+        :return: tuple of (sha1, md5) of the file, or None if the file is unknown or changed since.
+        """
+        try:
+            with open(self._digests_path(file_path, stat or os.stat(file_path)), "r") as f:
+                file_sha1, file_md5 = f.read().split()
+        except (OSError, ValueError):
+            return None
+        return file_sha1, file_md5
+
+    def put_digests(self, file_path: str, file_sha1: str, file_md5: str, stat: os.stat_result = None) -> None:
+        """
+        Records the digests of a file.
+
+        :param file_path: path to the file.
+        :param file_sha1: sha1 of the file, as given by decoder.unique_hash.
+        :param file_md5: md5 of the file.
+        :param stat: result of os.stat on the file taken before reading it, it is taken if not given.
+        """
+        path = self._digests_path(file_path, stat or os.stat(file_path))
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(f"{file_sha1.upper()} {file_md5}")
+        self._replace(temp_path, path)
+
+    def put(self, key: str, fingerprints: List[Tuple[Union[str, int], int]]) -> None:
+        """
+        Stores the fingerprints of a file and evicts the least recently used entries if needed.
+
+        :param key: key of the file in the cache.
+        :param fingerprints: a sequence of tuples in the format (hash, offset).
+        """
+        fingerprints = list(fingerprints)
+        hashes = np.array([hsh for hsh, _ in fingerprints])
+        if hashes.dtype.kind == 'U':
+            # hexadecimal hashes are stored as bytes, which takes a quarter of the space.
+            hashes = hashes.astype(bytes)
+        elif not len(fingerprints):
+            hashes = hashes.astype(np.int64)
+        offsets = np.array([offset for _, offset in fingerprints], dtype=np.int32)
+
+        path = self._entry_path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, hashes=hashes, offsets=offsets)
+        self._replace(temp_path, path)
+
+    def _replace(self, temp_path: str, path: str) -> None:
+        # the directory is only scanned again when the running total goes over max_size or every
+        # FINGERPRINT_CACHE_SCAN_INTERVAL entries, scanning it on every put is quadratic over an ingest.
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        usage = _usage.get(self.path)
+        if usage is None or usage[1] >= FINGERPRINT_CACHE_SCAN_INTERVAL:
+            self.evict()
+            return
+        usage[0] += size
+        usage[1] += 1
+        if usage[0] > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries once the cache is over max_size bytes, down to EVICTION_TARGET
+        of it.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICTION_TARGET if total > self.max_size else self.max_size
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        _usage[self.path] = [total, 0]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: the number of entries and the bytes used by the cache.
+        """
+        entries = self._entries()
+        return {"entries": len(entries), "size": sum(size for _, size, _ in entries), "max_size": self.max_size}
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith((self.EXTENSION, self.DIGESTS_EXTENSION)):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}{self.EXTENSION}")
+
+    def _digests_path(self, file_path: str, stat: os.stat_result) -> str:
+        key = sha1(f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f"{key}{self.DIGESTS_EXTENSION}")
@@ -0,0 +1,186 @@
+import threading
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import MEMORY_INDEX_MERGE_SIZE
+
+
+class IndexSegment(object):
+    """
+    Immutable inverted index over a set of fingerprints. The unique hashes are kept sorted in `keys`, and the
+    postings of keys[i], an (audio index, offset) pair per fingerprint, are audios[starts[i]:starts[i + 1]]
+    and offsets[starts[i]:starts[i + 1]].
+    """
+
+    def __init__(self, keys: np.ndarray, starts: np.ndarray, audios: np.ndarray, offsets: np.ndarray):
+        self.keys = keys
+        self.starts = starts
+        self.audios = audios
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, hashes: np.ndarray, audios: np.ndarray, offsets: np.ndarray) -> "IndexSegment":
+        """
+        Sorts a set of fingerprints into a segment, repeated fingerprints are kept once.
+
+        :param hashes: int64 hash of each fingerprint.
+        :param audios: audio index of each fingerprint.
+        :param offsets: offset of each fingerprint.
+        :return: the segment.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        audios = np.asarray(audios, dtype=np.int32)
+        offsets = np.asarray(offsets, dtype=np.int32)
+
+        order = np.lexsort((offsets, audios, hashes))
+        hashes, audios, offsets = hashes[order], audios[order], offsets[order]
+        if len(hashes):
+            unique = np.r_[True, (hashes[1:] != hashes[:-1]) | (audios[1:] != audios[:-1])
+                           | (offsets[1:] != offsets[:-1])]
+            hashes, audios, offsets = hashes[unique], audios[unique], offsets[unique]
+
+        keys, first = np.unique(hashes, return_index=True)
+        starts = np.r_[first, len(hashes)].astype(np.int64)
+        return cls(keys, starts, audios, offsets)
+
+    @classmethod
+    def from_batches(cls, batches: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> "IndexSegment":
+        """
+        Builds a segment at once from fingerprints given in batches, see build.
+
+        :param batches: (hashes, audios, offsets) arrays of the fingerprints indexed.
+        :return: the segment.
+        """
+        hashes, audios, offsets = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int32)], \
+            [np.zeros(0, dtype=np.int32)]
+        for batch_hashes, batch_audios, batch_offsets in batches:
+            hashes.append(batch_hashes)
+            audios.append(batch_audios)
+            offsets.append(batch_offsets)
+        return cls.build(np.concatenate(hashes), np.concatenate(audios), np.concatenate(offsets))
+
+    @classmethod
+    def empty(cls) -> "IndexSegment":
+        """
+        :return: a segment without fingerprints.
+        """
+        return cls.build(np.zeros(0), np.zeros(0), np.zeros(0))
+
+    def __len__(self) -> int:
+        return len(self.audios)
+
+    def postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: a tuple of arrays (hashes, audios, offsets) with every fingerprint of the segment.
+        """
+        return np.repeat(self.keys, np.diff(self.starts)), self.audios, self.offsets
+
+    def lookup(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the postings of a set of hashes, a binary search over the keys gives the range of each one.
+
+        :param values: int64 hashes looked up.
+        :return: a tuple of arrays (positions, audios, offsets) with a row per posting found, where positions
+        is the index in values of the hash of the posting.
+        """
+        found = np.searchsorted(self.keys, values)
+        hit = found < len(self.keys)
+        hit[hit] = self.keys[found[hit]] == values[hit]
+        positions = np.flatnonzero(hit)
+
+        begins = self.starts[found[positions]]
+        lengths = self.starts[found[positions] + 1] - begins
+        total = int(lengths.sum())
+        rows = np.repeat(begins - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+        return np.repeat(positions, lengths), self.audios[rows], self.offsets[rows]
+
+
+class FingerprintIndex(object):
+    """
+    In memory inverted index of fingerprints, made of a large segment holding most of them and a small one
+    taking the fingerprints added since, which is merged into the large one once it holds merge_size
+    fingerprints. Lookups can run while fingerprints are added or removed, the segments are never modified,
+    only replaced.
+    """
+
+    def __init__(self, segment: IndexSegment = None, merge_size: int = MEMORY_INDEX_MERGE_SIZE):
+        self.merge_size = merge_size
+        self._segments = (IndexSegment.empty() if segment is None else segment, IndexSegment.empty())
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, batches: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+             merge_size: int = MEMORY_INDEX_MERGE_SIZE) -> "FingerprintIndex":
+        """
+        Builds an index at once.
+
+        :param batches: (hashes, audios, offsets) arrays of the fingerprints indexed.
+        :param merge_size: see FingerprintIndex.
+        :return: the index.
+        """
+        return cls(IndexSegment.from_batches(batches), merge_size)
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._segments)
+
+    def add(self, hashes: np.ndarray, audios: np.ndarray, offsets: np.ndarray) -> None:
+        """
+        Adds fingerprints to the index, the ones already indexed are skipped.
+
+        :param hashes: int64 hash of each fingerprint.
+        :param audios: audio index of each fingerprint.
+        :param offsets: offset of each fingerprint.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        audios = np.asarray(audios, dtype=np.int32)
+        offsets = np.asarray(offsets, dtype=np.int32)
+        with self._lock:
+            main, recent = self._segments
+
+            # the recent segment gets rid of its own repeated fingerprints when rebuilt, not of the main ones.
+            positions, found_audios, found_offsets = main.lookup(hashes)
+            indexed = positions[(audios[positions] == found_audios) & (offsets[positions] == found_offsets)]
+            keep = np.ones(len(hashes), dtype=bool)
+            keep[indexed] = False
+
+            recent_hashes, recent_audios, recent_offsets = recent.postings()
+            recent = IndexSegment.build(np.r_[recent_hashes, hashes[keep]], np.r_[recent_audios, audios[keep]],
+                                        np.r_[recent_offsets, offsets[keep]])
+            if len(recent) >= self.merge_size:
+                main, recent = self._merge(main, recent), IndexSegment.empty()
+            self._segments = (main, recent)
+
+    def remove_audios(self, audio_indexes: Iterable[int]) -> None:
+        """
+        Drops every fingerprint of some audios, both segments are rebuilt without them.
+
+        :param audio_indexes: audio index of the audios removed.
+        """
+        audio_indexes = np.fromiter(audio_indexes, dtype=np.int32)
+        with self._lock:
+            segments = []
+            for segment in self._segments:
+                hashes, audios, offsets = segment.postings()
+                keep = ~np.isin(audios, audio_indexes)
+                segments.append(segment if keep.all() else IndexSegment.build(hashes[keep], audios[keep],
+                                                                              offsets[keep]))
+            self._segments = tuple(segments)
+
+    def lookup(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the postings of a set of hashes, see IndexSegment.lookup.
+
+        :param values: int64 hashes looked up.
+        :return: a tuple of arrays (positions, audios, offsets) with a row per posting found.
+        """
+        values = np.asarray(values, dtype=np.int64)
+        results = [segment.lookup(values) for segment in self._segments]
+        return tuple(np.concatenate(columns) for columns in zip(*results))
+
+    @staticmethod
+    def _merge(main: IndexSegment, recent: IndexSegment) -> IndexSegment:
+        main_hashes, main_audios, main_offsets = main.postings()
+        recent_hashes, recent_audios, recent_offsets = recent.postings()
+        return IndexSegment.build(np.r_[main_hashes, recent_hashes], np.r_[main_audios, recent_audios],
+                                  np.r_[main_offsets, recent_offsets])
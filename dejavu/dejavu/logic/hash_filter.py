@@ -0,0 +1,136 @@
+import math
+import os
+from typing import Dict
+
+import numpy as np
+
+# bytes of the bit array counted at once when computing its fill ratio.
+POPCOUNT_CHUNK_SIZE = 1 << 24
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over int64 fingerprint hashes (see hash_to_int): contains answers False for hashes that were
+    never added, and True for the added ones plus a small fraction of the others, the false positives.
+
+    Each hash sets n_hashes bits of an array of n_bits, picked by double hashing two splitmix64 mixes of it.
+    The filter also counts how many hashes were queried, how many it let through and how many of those were
+    actually found, see stats.
+    """
+
+    def __init__(self, n_bits: int, n_hashes: int, bits: np.ndarray = None):
+        self.n_bits = max(int(n_bits), 8)
+        self.n_hashes = max(int(n_hashes), 1)
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8) if bits is None else bits
+        self.queried = 0
+        self.passed = 0
+        self.found = 0
+
+    @classmethod
+    def for_capacity(cls, capacity: int, false_positive_rate: float) -> "BloomFilter":
+        """
+        Sizes a filter to hold capacity hashes with the given false positive rate.
+
+        :param capacity: number of unique hashes expected.
+        :param false_positive_rate: fraction of absent hashes let through once capacity hashes are added.
+        :return: an empty filter.
+        """
+        capacity = max(int(capacity), 1)
+        n_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        return cls(n_bits, round(n_bits / capacity * math.log(2)))
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """
+        :param path: path of a filter written by save.
+        :return: the filter.
+        """
+        with np.load(path) as stored:
+            return cls(int(stored["n_bits"]), int(stored["n_hashes"]), stored["bits"])
+
+    def save(self, path: str) -> None:
+        """
+        Writes the filter as an uncompressed .npz file, replacing the previous one at once.
+
+        :param path: path of the file.
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, n_bits=self.n_bits, n_hashes=self.n_hashes, bits=self.bits)
+        os.replace(temp_path, path)
+
+    def _positions(self, keys: np.ndarray) -> np.ndarray:
+        keys = np.asarray(keys, dtype=np.int64).view(np.uint64)
+        first = _mix(keys)
+        second = _mix(keys ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        return np.stack([(first + np.uint64(i) * second) % np.uint64(self.n_bits) for i in range(self.n_hashes)])
+
+    def add(self, keys: np.ndarray) -> None:
+        """
+        :param keys: int64 hashes added.
+        """
+        positions = np.unique(self._positions(keys))
+        masks = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        byte_indexes, starts = np.unique(positions >> np.uint64(3), return_index=True)
+        if len(byte_indexes):
+            self.bits[byte_indexes.astype(np.int64)] |= np.bitwise_or.reduceat(masks, starts)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: int64 hashes looked up.
+        :return: a boolean array, False for the hashes surely absent.
+        """
+        positions = self._positions(keys)
+        masks = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        return np.all(self.bits[(positions >> np.uint64(3)).astype(np.int64)] & masks, axis=0)
+
+    def merge(self, other: "BloomFilter") -> None:
+        """
+        Adds every hash of another filter of the same size.
+
+        :param other: the filter merged into this one.
+        """
+        if (other.n_bits, other.n_hashes) != (self.n_bits, self.n_hashes):
+            raise ValueError("Only filters of the same size can be merged.")
+        self.bits |= other.bits
+
+    def record(self, queried: int, passed: int, found: int) -> None:
+        """
+        Counts the outcome of a lookup.
+
+        :param queried: number of unique hashes given to the filter.
+        :param passed: number of them let through.
+        :param found: number of them that had fingerprints.
+        """
+        self.queried += queried
+        self.passed += passed
+        self.found += found
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: the lookups counted so far:
+            - queried, dropped, passed: unique query hashes given to the filter, surely absent and let through.
+            - hit_rate: fraction of the hashes let through that had fingerprints.
+            - false_positive_rate: fraction of the absent hashes that were let through anyway.
+            - expected_false_positive_rate: false positive rate given how full the filter is.
+        """
+        dropped = self.queried - self.passed
+        false_positives = self.passed - self.found
+        absent = false_positives + dropped
+        ones = sum(int(np.unpackbits(self.bits[index: index + POPCOUNT_CHUNK_SIZE]).sum())
+                   for index in range(0, len(self.bits), POPCOUNT_CHUNK_SIZE))
+        return {
+            "queried": self.queried,
+            "dropped": dropped,
+            "passed": self.passed,
+            "hit_rate": self.found / self.passed if self.passed else 0.0,
+            "false_positive_rate": false_positives / absent if absent else 0.0,
+            "expected_false_positive_rate": (ones / self.n_bits) ** self.n_hashes,
+        }
+
+
+def _mix(keys: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, uint64 products wrap around.
+    keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return keys ^ (keys >> np.uint64(31))
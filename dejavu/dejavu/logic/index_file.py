@@ -0,0 +1,107 @@
+import os
+import struct
+from typing import List
+
+import numpy as np
+
+from dejavu.logic.fingerprint_index import IndexSegment
+
+# Layout of an index file, little endian, every section starting at a multiple of 8 bytes:
+#   header    HEADER_SIZE bytes: magic, version, audio id width, number of keys, postings and audios.
+#   keys      int64[keys], the unique hashes (see hash_to_int) in ascending order.
+#   starts    int64[keys + 1], the postings of keys[i] are postings[starts[i]:starts[i + 1]].
+#   postings  (int32 audio, int32 offset)[postings], audio being a position in the audio ids table.
+#   audio ids bytes[audios], ascii audio ids, null padded to the audio id width.
+MAGIC = b"DJVINDEX"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQ")
+HEADER_SIZE = 64
+
+POSTING = np.dtype([("audio", "<i4"), ("offset", "<i4")])
+
+
+class IndexFile(object):
+    """
+    Read only fingerprint index stored in a file (see write_index_file). Every section is memory mapped, so
+    opening it takes no time whatever its size, and all the processes reading the same file share a single
+    copy of it in the page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise IndexFileError(f"{path} is not a fingerprint index file.")
+        magic, version, audio_id_size, n_keys, n_postings, n_audios = HEADER.unpack_from(header)
+        if magic != MAGIC:
+            raise IndexFileError(f"{path} is not a fingerprint index file.")
+        if version != VERSION:
+            raise IndexFileError(f"{path} has version {version} of the index file format, {VERSION} was expected.")
+
+        position = HEADER_SIZE
+        sections = []
+        for dtype, count in ((np.dtype("<i8"), n_keys), (np.dtype("<i8"), n_keys + 1), (POSTING, n_postings),
+                             (np.dtype(f"S{audio_id_size}"), n_audios)):
+            sections.append(self._map(dtype, position, count))
+            position += _aligned(dtype.itemsize * count)
+        keys, starts, postings, audio_ids = sections
+
+        self.segment = IndexSegment(keys, starts, postings["audio"], postings["offset"])
+        self.audio_ids = [audio_id.decode("ascii") for audio_id in audio_ids]
+
+    def _map(self, dtype: np.dtype, position: int, count: int) -> np.ndarray:
+        if count == 0:
+            # empty files or sections can't be mapped.
+            return np.zeros(0, dtype=dtype)
+        try:
+            return np.memmap(self.path, dtype=dtype, mode="r", offset=position, shape=(count,))
+        except ValueError:
+            raise IndexFileError(f"{self.path} is truncated.")
+
+    def __len__(self) -> int:
+        return len(self.segment)
+
+    def lookup(self, values: np.ndarray):
+        """
+        Finds the postings of a set of hashes, see IndexSegment.lookup.
+
+        :param values: int64 hashes looked up.
+        :return: a tuple of arrays (positions, audios, offsets) with a row per posting found, audios being
+        positions in audio_ids.
+        """
+        return self.segment.lookup(np.asarray(values, dtype=np.int64))
+
+
+def write_index_file(path: str, segment: IndexSegment, audio_ids: List[str]) -> None:
+    """
+    Writes a fingerprint index file, the file is replaced at once, so readers opening it meanwhile get either
+    the previous version or the new one.
+
+    :param path: path of the file.
+    :param segment: the fingerprints indexed.
+    :param audio_ids: audio id of every audio index referenced by the segment.
+    """
+    audio_ids = np.array([audio_id.encode("ascii") for audio_id in audio_ids], dtype=bytes)
+    audio_id_size = max(audio_ids.dtype.itemsize, 1)
+    postings = np.empty(len(segment), dtype=POSTING)
+    postings["audio"] = segment.audios
+    postings["offset"] = segment.offsets
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, audio_id_size, len(segment.keys), len(segment), len(audio_ids))
+                .ljust(HEADER_SIZE, b"\0"))
+        for section in (np.asarray(segment.keys, dtype="<i8"), np.asarray(segment.starts, dtype="<i8"), postings,
+                        audio_ids.astype(f"S{audio_id_size}")):
+            section.tofile(f)
+            f.write(b"\0" * (_aligned(section.nbytes) - section.nbytes))
+    os.replace(temp_path, path)
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) // 8 * 8
+
+
+class IndexFileError(Exception):
+    pass
@@ -1,12 +1,12 @@
 from time import time
-from typing import Dict
+from typing import Dict, Set, Tuple
 import os
 import uuid
-import hashlib
 from datetime import datetime
 import dejavu.logic.decoder as decoder
 from dejavu.base_classes.base_recognizer import BaseRecognizer
-from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME, QUERY_TIME,
+from dejavu.config.settings import (ALIGN_TIME, DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, FINGERPRINT_TIME, QUERY_TIME,
                                     RESULTS, TOTAL_TIME,
                                     FIELD_FILE_SHA1,
                                     FINGERPRINTED_CONFIDENCE,
@@ -19,11 +19,50 @@ class FileRecognizer(BaseRecognizer):
     def __init__(self, dejavu):
         super().__init__(dejavu)
 
-    def recognize_file(self, local_audio_path: str, related_key: str, audio_id: str) -> Dict[str, any]:
-        channels, self.Fs, sha1 = decoder.read(local_audio_path, self.dejavu.limit)
-        with open(local_audio_path, 'rb') as fp:
-            data = fp.read()
-        file_md5 = hashlib.md5(data).hexdigest()
+    def recognize_file(self, local_audio_path: str, related_key: str, audio_id: str, start: float = None,
+                       end: float = None) -> Dict[str, any]:
+        """
+        Recognizes an audio file, or just a time window of it.
+
+        :param local_audio_path: path to the file.
+        :param related_key: key the match is stored with.
+        :param audio_id: id of the recognized audio.
+        :param start: second of the file to start recognizing from, the decoder seeks to it.
+        :param end: second of the file to stop recognizing at.
+        :return: a dictionary with the times taken by each step and the matched audios. Offsets are relative
+        to the whole file, even if only a window of it was recognized.
+        """
+        if end is not None and end <= (start or 0):
+            raise ValueError(f"The end of the window ({end}s) must come after its start ({start or 0}s).")
+
+        limit = self.dejavu.limit
+        if end is not None:
+            limit = min(limit, end - (start or 0)) if limit else end - (start or 0)
+
+        # look for already computed fingerprints before decoding the file.
+        cache, cache_key, hashes = self.dejavu.fingerprint_cache, None, None
+        if cache:
+            parameters = self.dejavu.get_fingerprint_parameters()
+            parameters["limit"] = limit
+            parameters.update(parameters.pop("fingerprint_options"))
+            if start:
+                # whole file fingerprints keep the same key they are stored with at ingest time.
+                parameters["start"] = start
+            # files whose digests are unknown are a miss, they are hashed by the read that decodes them.
+            stat = os.stat(local_audio_path)
+            digests = cache.get_digests(local_audio_path, stat)
+            if digests:
+                file_sha1, file_md5 = digests
+                cache_key = cache.key(file_sha1, **parameters)
+                hashes = cache.get(cache_key)
+
+        if hashes is None:
+            # the md5 is computed from the same read of the file the decoder is fed with.
+            channels, self.Fs, file_sha1, file_md5 = decoder.read_hashed(local_audio_path, limit,
+                                                                         fs=self.dejavu.analysis_fs, start=start)
+            if cache:
+                cache.put_digests(local_audio_path, file_sha1, file_md5, stat)
+                cache_key = cache.key(file_sha1, **parameters)
         c = self.dejavu.db.count_matched_audios_by_md5(file_md5)
         if c > 0:
             return Dict["None", "None"]
@@ -32,7 +71,15 @@ class FileRecognizer(BaseRecognizer):
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         match_id = uuid.uuid1().hex
         t = time()
-        matches, fingerprint_time, query_time, align_time = self._recognize(*channels)
+        if hashes is None:
+            hashes, fingerprint_time = self._fingerprint(*channels)
+            if cache_key:
+                cache.put(cache_key, hashes)
+        else:
+            hashes, fingerprint_time = set(hashes), 0
+        if start:
+            hashes = self._shift_offsets(hashes, start)
+        matches, query_time, align_time = self._match(hashes)
         t = time() - t
         # insert a matched information into database
         self.dejavu.db.insert_matched_information(match_id, audio_id, name, file_md5, t, fingerprint_time, query_time, align_time, now, related_key)
@@ -44,7 +91,7 @@ class FileRecognizer(BaseRecognizer):
             hashes_matched = match[HASHES_MATCHED]
             input_confidence = match[INPUT_CONFIDENCE]
             fingerprinted_confidence = match[FINGERPRINTED_CONFIDENCE]
-            offset = match[OFFSET].item()
+            offset = int(match[OFFSET])
             offset_seconds = match[OFFSET_SECS]
             file_sha1 = match[FIELD_FILE_SHA1]
             related_id = uuid.uuid1().hex
@@ -61,5 +108,11 @@ class FileRecognizer(BaseRecognizer):
 
         return results
 
-    def recognize(self, filename: str) -> Dict[str, any]:
-        return self.recognize_file(filename)
+    def _shift_offsets(self, hashes: Set[Tuple[any, int]], seconds: float) -> Set[Tuple[any, int]]:
+        # offsets are counted in windows of the rate align_matches converts them back to seconds with.
+        fs = self.dejavu.analysis_fs or DEFAULT_FS
+        shift = int(round(seconds * fs / (DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO)))
+        return {(hsh, offset + shift) for hsh, offset in hashes}
+
+    def recognize(self, filename: str, *args, **kwargs) -> Dict[str, any]:
+        return self.recognize_file(filename, *args, **kwargs)
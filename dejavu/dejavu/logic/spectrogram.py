@@ -0,0 +1,125 @@
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, SPECTROGRAM_BLOCK_SIZE)
+
+try:
+    # scipy.fft keeps float32 inputs in single precision, numpy.fft always upcasts to complex128.
+    from scipy.fft import rfft
+except ImportError:
+    from numpy.fft import rfft
+
+
+def spectrogram(channel_samples: np.ndarray,
+                Fs: int = DEFAULT_FS,
+                wsize: int = DEFAULT_WINDOW_SIZE,
+                wratio: float = DEFAULT_OVERLAP_RATIO,
+                dtype: np.dtype = np.float32,
+                block_size: int = SPECTROGRAM_BLOCK_SIZE) -> np.ndarray:
+    """
+    Computes the power spectral density of the channel in decibels, using the same framing, hanning window
+    and scaling as matplotlib.mlab.specgram followed by a 10 * log10 transform (0s are left as 0s).
+
+    Frames are views over the samples built with stride tricks and they are windowed and FFTed in blocks,
+    so no copy of the whole signal nor of the complex spectrum is ever allocated.
+
+    :param channel_samples: channel samples.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :param dtype: floating point type used for the computations and the result.
+    :param block_size: amount of frames transformed at once.
+    :return: a (wsize // 2 + 1) x frames matrix with the spectrogram in dB.
+    """
+    samples = np.asarray(channel_samples)
+    hop = wsize - int(wsize * wratio)
+
+    # as in mlab.specgram, signals shorter than a window are zero padded to one window.
+    if len(samples) < wsize:
+        samples = np.concatenate((samples, np.zeros(wsize - len(samples), dtype=samples.dtype)))
+
+    frames = frame_signal(samples, wsize, hop)
+    n_frames = frames.shape[0]
+
+    window = hann_window(wsize, dtype)
+    scale = psd_scale(wsize, Fs, dtype)
+
+    # the result is filled as frames x bins, which is the natural layout of the FFT output, and returned
+    # transposed as a view.
+    result = np.empty((n_frames, wsize // 2 + 1), dtype=dtype)
+    for start in range(0, n_frames, block_size):
+        block = frames[start:start + block_size].astype(dtype)
+        block *= window
+        spectrum = rfft(block, axis=1)
+        out = result[start:start + block_size]
+        np.multiply(spectrum.real, spectrum.real, out=out)
+        out += spectrum.imag * spectrum.imag
+        out *= scale
+
+    to_decibels(result)
+    return result.T
+
+
+def frame_signal(samples: np.ndarray, wsize: int, hop: int) -> np.ndarray:
+    """
+    Read only view of the signal split in overlapping frames, no data is copied.
+
+    :param samples: 1-D array of samples, at least wsize long.
+    :param wsize: frame size.
+    :param hop: distance in samples between the start of two consecutive frames.
+    :return: a frames x wsize view over the samples.
+    """
+    n_frames = 1 + (len(samples) - wsize) // hop
+    stride = samples.strides[0]
+    return as_strided(samples, shape=(n_frames, wsize), strides=(stride * hop, stride), writeable=False)
+
+
+def to_decibels(power: np.ndarray) -> np.ndarray:
+    """
+    In place 10 * log10 transform, 0s are left untouched to avoid the np warning.
+
+    :param power: power spectrum.
+    :return: the same array, now in dB.
+    """
+    np.log10(power, out=power, where=power > 0)
+    power *= 10
+    return power
+
+
+@lru_cache(maxsize=None)
+def hann_window(wsize: int, dtype: np.dtype = np.float32) -> np.ndarray:
+    """
+    Symmetric hanning window (the one used by mlab.window_hanning), cached per (wsize, dtype).
+
+    :param wsize: window size.
+    :param dtype: floating point type of the window.
+    :return: a read only window.
+    """
+    window = np.hanning(wsize).astype(dtype)
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=None)
+def psd_scale(wsize: int, Fs: int, dtype: np.dtype = np.float32) -> np.ndarray:
+    """
+    Per frequency bin scaling of the squared FFT magnitudes to a one-sided power spectral density, same as
+    mlab with scale_by_freq=True: divided by Fs and the window energy, and every bin but DC and Nyquist doubled.
+
+    :param wsize: window size.
+    :param Fs: audio sampling rate.
+    :param dtype: floating point type of the result.
+    :return: a read only array with a factor per frequency bin.
+    """
+    window = np.hanning(wsize)
+    scale = np.full(wsize // 2 + 1, 1.0 / (Fs * (window ** 2).sum()))
+    if wsize % 2:
+        scale[1:] *= 2
+    else:
+        scale[1:-1] *= 2
+    scale = scale.astype(dtype)
+    scale.flags.writeable = False
+    return scale
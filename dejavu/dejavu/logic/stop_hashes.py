@@ -0,0 +1,65 @@
+from typing import Tuple
+
+import numpy as np
+
+# what is done with the stop hashes of a query:
+#   skip        they are not looked up.
+#   cap         at most `cap` fingerprints are fetched for each of them.
+#   downweight  they are looked up, but each of their matches counts max_df / df when aligning.
+STOP_HASH_POLICIES = ("skip", "cap", "downweight")
+
+
+class StopHashes(object):
+    """
+    Hashes found in more than max_df audios (silence, hum, jingles...), which match almost anything and whose
+    fingerprints make up huge row sets, together with the number of audios (df) each one is found in.
+    """
+
+    def __init__(self, keys: np.ndarray, dfs: np.ndarray, policy: str, max_df: int, cap: int):
+        if policy not in STOP_HASH_POLICIES:
+            raise ValueError(f"Unknown stop hash policy {policy}, use one of {', '.join(STOP_HASH_POLICIES)}.")
+        order = np.argsort(keys)
+        self.keys = np.asarray(keys, dtype=np.int64)[order]
+        self.dfs = np.asarray(dfs, dtype=np.int64)[order]
+        self.policy = policy
+        self.max_df = max_df
+        self.cap = cap
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def find(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param values: int64 hashes looked up.
+        :return: a tuple of arrays (stop, dfs), whether each hash is a stop hash and its df (0 if it isn't).
+        """
+        values = np.asarray(values, dtype=np.int64)
+        if not len(self.keys):
+            return np.zeros(len(values), dtype=bool), np.zeros(len(values), dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.keys, values), len(self.keys) - 1)
+        stop = self.keys[found] == values
+        return stop, np.where(stop, self.dfs[found], 0)
+
+    def weights(self, dfs: np.ndarray) -> np.ndarray:
+        """
+        :param dfs: df of some hashes, as given by find.
+        :return: the weight of a match of each hash when aligning, 1 for the hashes that aren't stop hashes.
+        """
+        dfs = np.asarray(dfs, dtype=np.float64)
+        return np.where(dfs > self.max_df, self.max_df / np.maximum(dfs, 1), 1.0)
+
+
+def cap_postings(positions: np.ndarray, cap: int) -> np.ndarray:
+    """
+    :param positions: hash of each fingerprint found, as a position in the values looked up.
+    :param cap: fingerprints kept per hash.
+    :return: a boolean array keeping the first cap fingerprints of each hash.
+    """
+    order = np.argsort(positions, kind="stable")
+    sorted_positions = positions[order]
+    starts = np.flatnonzero(np.r_[True, sorted_positions[1:] != sorted_positions[:-1]]) if len(positions) \
+        else np.zeros(0, dtype=np.int64)
+    ranks = np.arange(len(positions)) - np.repeat(starts, np.diff(np.r_[starts, len(positions)]))
+    keep = np.zeros(len(positions), dtype=bool)
+    keep[order] = ranks < cap
+    return keep
@@ -0,0 +1,131 @@
+import os
+import struct
+from typing import List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import DECODER_BLOCK_SIZE
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# data chunk sizes left by writers that could not seek back to fill it in (streams, ffmpeg writing to a pipe).
+UNSET_CHUNK_SIZES = (0, 0xFFFFFFFF)
+
+
+def is_wav(file_name: str) -> bool:
+    """
+    :param file_name: file to be checked.
+    :return: whether the file starts with a RIFF/WAVE header.
+    """
+    try:
+        with open(file_name, "rb") as f:
+            header = f.read(12)
+    except OSError:
+        return False
+    return len(header) == 12 and header[0:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def parse_header(file_name: str) -> Tuple[int, int, int, int, int, int]:
+    """
+    Walks the RIFF chunks of a WAV file up to its data chunk.
+
+    :param file_name: WAV file.
+    :return: tuple of (format_tag, channels, sample_rate, bits_per_sample, data_offset, frames).
+    """
+    file_size = os.path.getsize(file_name)
+    fmt = None
+    with open(file_name, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise WavFormatError(f"{file_name} is not a RIFF/WAVE file")
+
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise WavFormatError(f"{file_name} has no data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+
+            if chunk_id == b"fmt ":
+                body = f.read(chunk_size)
+                if len(body) < 16:
+                    raise WavFormatError(f"{file_name} has a truncated fmt chunk")
+                format_tag, channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", body[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # the actual format is the first two bytes of the sub format GUID.
+                    format_tag, = struct.unpack("<H", body[24:26])
+                fmt = (format_tag, channels, sample_rate, bits, block_align)
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise WavFormatError(f"{file_name} has its data chunk before the fmt chunk")
+                data_offset = f.tell()
+                # writers that could not seek back leave the size unset, take everything up to the end.
+                data_size = file_size - data_offset
+                if chunk_size not in UNSET_CHUNK_SIZES:
+                    data_size = min(chunk_size, data_size)
+                format_tag, channels, sample_rate, bits, block_align = fmt
+                if not channels or block_align != channels * ((bits + 7) // 8):
+                    raise WavFormatError(f"{file_name} has an unsupported block alignment")
+                return format_tag, channels, sample_rate, bits, data_offset, data_size // block_align
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def read(file_name: str, limit: float = None, start: float = None,
+         block_size: int = DECODER_BLOCK_SIZE) -> Tuple[List[np.ndarray], int]:
+    """
+    Reads a PCM WAV file without loading it in memory. The data chunk is memory mapped and every channel is
+    returned as a 16-bit strided view over it, so pages are only read from disk as the samples are used.
+
+    16-bit data is viewed as it is. For 24 and 32-bit integer data the 16 most significant bits of every
+    sample (the same ones ffmpeg keeps when converting to s16) are viewed in place as unaligned int16 values.
+    Only 8-bit and float data, which have no int16 representation within the file, are converted, in blocks
+    of block_size frames.
+
+    :param file_name: WAV file.
+    :param limit: number of seconds to read, None reads until the end of the file.
+    :param start: second to start reading from.
+    :param block_size: number of frames converted at once when a conversion is needed.
+    :return: tuple of (channels, sample_rate).
+    """
+    format_tag, n_channels, sample_rate, bits, data_offset, frames = parse_header(file_name)
+    sample_width = (bits + 7) // 8
+
+    first = min(int(round((start or 0) * sample_rate)), frames)
+    last = frames if limit is None else min(first + int(round(limit * sample_rate)), frames)
+    n_frames = last - first
+    offset = data_offset + first * n_channels * sample_width
+
+    if n_frames <= 0:
+        return [np.zeros(0, dtype=np.int16) for _ in range(n_channels)], sample_rate
+
+    if format_tag == WAVE_FORMAT_PCM and sample_width in (2, 3, 4):
+        # view the two most significant bytes of each little endian sample.
+        data = np.memmap(file_name, dtype=np.uint8, mode="r", offset=offset,
+                         shape=(n_frames * n_channels * sample_width,))
+        samples = np.ndarray(shape=(n_frames, n_channels), dtype="<i2", buffer=data, offset=sample_width - 2,
+                             strides=(n_channels * sample_width, sample_width))
+    elif format_tag == WAVE_FORMAT_PCM and sample_width == 1:
+        data = np.memmap(file_name, dtype=np.uint8, mode="r", offset=offset, shape=(n_frames, n_channels))
+        samples = _convert(data, block_size, lambda block: (block.astype(np.int16) - 128) << 8)
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT and sample_width in (4, 8):
+        dtype = "<f4" if sample_width == 4 else "<f8"
+        data = np.memmap(file_name, dtype=dtype, mode="r", offset=offset, shape=(n_frames, n_channels))
+        samples = _convert(data, block_size, lambda block: np.clip(np.rint(block * 32768), -32768, 32767))
+    else:
+        raise WavFormatError(f"{file_name} has an unsupported format ({format_tag}, {bits} bits)")
+
+    return [samples[:, chn] for chn in range(n_channels)], sample_rate
+
+
+def _convert(data: np.ndarray, block_size: int, conversion) -> np.ndarray:
+    samples = np.empty(data.shape, dtype=np.int16)
+    for start in range(0, len(data), block_size):
+        samples[start:start + block_size] = conversion(data[start:start + block_size])
+    return samples
+
+
+class WavFormatError(Exception):
+    pass
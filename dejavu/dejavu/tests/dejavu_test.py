@@ -1,3 +1,4 @@
+import csv
 import fnmatch
 import person
 import logging
@@ -12,17 +13,21 @@ import matplotlib.pyplot as plt
 import numpy as np
 from pydub import AudioSegment
 
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
-                                    DEFAULT_WINDOW_SIZE, HASHES_MATCHED,
-                                    OFFSET, RESULTS, AUDIO_NAME, TOTAL_TIME)
-from dejavu.logic.decoder import get_audio_name_from_path
+from dejavu.config.settings import (HASHES_MATCHED, OFFSET_SECS,
+                                    PEAK_NEIGHBORHOOD_SIZE, RESULTS,
+                                    AUDIO_NAME, TOTAL_TIME)
+from dejavu.logic.decoder import get_audio_name_from_path, read
+from dejavu.logic.fingerprint import (_morphology_peaks_mask,
+                                      _square_peaks_mask, fingerprint)
+from dejavu.logic.spectrogram import spectrogram
 
 
 class DejavuTest:
-    def __init__(self, folder, seconds):
+    def __init__(self, folder, seconds, config=None):
         super().__init__()
 
         self.test_folder = folder
+        self.config = config
         self.test_seconds = seconds
         self.test_audios = []
 
@@ -118,12 +123,10 @@ class DejavuTest:
             splits = get_audio_name_from_path(f).split("_")
             audio = "_".join(splits[0:len(get_audio_name_from_path(f).split("_")) - 2])
             line = self.get_line_id(audio)
-            result = subprocess.check_output([
-                "python",
-                "dejavu.py",
-                '-r',
-                'file',
-                join(self.test_folder, f)])
+            command = ["python", "dejavu.py"]
+            if self.config:
+                command += ['-c', self.config]
+            result = subprocess.check_output(command + ['-r', 'file', join(self.test_folder, f)])
 
             if result.strip() == "None":
                 log_msg('No match')
@@ -160,8 +163,8 @@ class DejavuTest:
                     audio_start_time = re.findall("_[^_]+", f.replace(audio, ""))
                     audio_start_time = audio_start_time[0].lstrip("_ ")
 
-                    result_start_time = round((match[OFFSET] * DEFAULT_WINDOW_SIZE *
-                                               DEFAULT_OVERLAP_RATIO) / DEFAULT_FS, 0)
+                    # offset_seconds already accounts for the analysis sampling rate
+                    result_start_time = round(match[OFFSET_SECS], 0)
 
                     self.result_matching_times[line][col] = int(result_start_time) - int(audio_start_time)
                     if abs(self.result_matching_times[line][col]) == 1:
@@ -264,6 +267,86 @@ def generate_test_files(src, dest, nseconds, fmts=[".mp3", ".wav"], padding=10):
                 test_file_name])
 
 
+def compare_peak_finders(arr2D, neighborhood_size=PEAK_NEIGHBORHOOD_SIZE):
+    """
+    Compares the separable peak finder against the morphology based one with
+    a square mask (CONNECTIVITY_MASK = 2) over the spectrogram `arr2D`.
+
+    Returns the amount of cells where both peak masks differ.
+    """
+    expected = _morphology_peaks_mask(arr2D, connectivity=2, neighborhood_size=neighborhood_size)
+    actual = _square_peaks_mask(arr2D, neighborhood_size=neighborhood_size)
+    return int(np.count_nonzero(expected != actual))
+
+
+def check_peak_finders(seed=None, trials=20):
+    """
+    Runs compare_peak_finders over synthetic spectrograms, with and without
+    exact zeros (silence), plateaus and sizes below the neighborhood.
+
+    Returns True if both peak finders agreed on every spectrogram.
+    """
+    rng = np.random.RandomState(seed)
+    matching = True
+    for trial in range(trials):
+        n_samples = rng.randint(1, 10) * 4096 * (1 + trial % 4)
+        samples = (rng.randn(n_samples) * 10 ** rng.randint(0, 4)).astype(np.int16)
+        if trial % 2:
+            # silence at random places gives exact zeros in the spectrogram.
+            start = rng.randint(0, n_samples)
+            samples[start:start + rng.randint(0, n_samples)] = 0
+        arr2D = np.array(spectrogram(samples))
+        if trial % 3 == 0:
+            # plateaus of equal values
+            arr2D = np.round(arr2D / 10) * 10
+        for neighborhood_size in (1, 2, PEAK_NEIGHBORHOOD_SIZE):
+            differences = compare_peak_finders(arr2D, neighborhood_size)
+            if differences:
+                matching = False
+                log_msg(f'peak finders differ in {differences} cells for spectrogram {arr2D.shape} '
+                        f'and neighborhood {neighborhood_size}')
+    return matching
+
+
+def report_peak_density(src, peak_density, results_folder, fmts=[".mp3", ".wav"], log=True, silent=False):
+    """
+    Fingerprints every file recursively in `src` directory of given format
+    keeping every peak and keeping `peak_density` peaks per second, and
+    records the amount of hashes of both in `results_folder`/peak_density.csv.
+
+    Returns the total amount of hashes with every peak and with the peak density.
+    """
+    rows = []
+    total_seconds, total_full, total_reduced = 0, 0, 0
+    for fmt in fmts:
+        for audiosource in get_files_recursive(src, fmt):
+            channels, fs, _ = read(audiosource)
+            full, reduced = set(), set()
+            for channel in channels:
+                full |= set(fingerprint(channel, Fs=fs))
+                reduced |= set(fingerprint(channel, Fs=fs, peak_density=peak_density))
+            seconds = len(channels[0]) / fs if len(channels) else 0
+
+            total_seconds += seconds
+            total_full += len(full)
+            total_reduced += len(reduced)
+            rows.append((basename(audiosource), round(seconds, 3), len(full), len(reduced),
+                         round(len(full) / seconds, 1) if seconds else 0,
+                         round(len(reduced) / seconds, 1) if seconds else 0))
+
+    with open(join(results_folder, "peak_density.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "seconds", "hashes", f"hashes_{peak_density}pps", "hashes_per_second",
+                         f"hashes_per_second_{peak_density}pps"])
+        writer.writerows(rows)
+
+    if total_full:
+        log_msg(f"peak density {peak_density} peaks/second: {total_reduced} hashes instead of {total_full} "
+                f"({round(100 * (1 - total_reduced / total_full), 1)}% less) over {round(total_seconds, 1)} "
+                f"seconds of audio", log=log, silent=silent)
+    return total_full, total_reduced
+
+
 def log_msg(msg, log=True, silent=False):
     if log:
         logging.debug(msg)
@@ -0,0 +1,132 @@
+import argparse
+import csv
+import json
+import logging
+import time
+import uuid
+from os import makedirs
+from os.path import basename, exists, join
+
+from dejavu import Dejavu
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import CHANNEL_STRATEGIES
+from dejavu.logic import decoder
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.tests.dejavu_test import log_msg
+
+
+def benchmark_channels(src: str, extensions: list, limit: int, results_folder: str, log: bool, silent: bool) -> None:
+    """
+    Fingerprints every file found in `src` with each channel strategy, and records
+    the amount of fingerprint rows and the ingest time (decoding + fingerprinting).
+    """
+    rows = []
+    totals = {strategy: [0, 0.0] for strategy in CHANNEL_STRATEGIES}
+    for file_name, _ in decoder.find_files(src, extensions):
+        for strategy in CHANNEL_STRATEGIES:
+            t = time.time()
+            channels, fs, _ = decoder.read(file_name, limit)
+            hashes = set()
+            for channel in decoder.select_channels(channels, strategy):
+                hashes |= set(fingerprint(channel, Fs=fs))
+            elapsed = time.time() - t
+
+            totals[strategy][0] += len(hashes)
+            totals[strategy][1] += elapsed
+            rows.append((basename(file_name), strategy, len(channels), len(hashes), round(elapsed, 3)))
+            log_msg(f"{basename(file_name)} [{strategy}]: {len(hashes)} rows in {round(elapsed, 3)} seconds",
+                    log=log, silent=silent)
+
+    for strategy, (n_rows, elapsed) in totals.items():
+        log_msg(f"total [{strategy}]: {n_rows} rows in {round(elapsed, 3)} seconds", log=log, silent=silent)
+
+    with open(join(results_folder, "channel_strategies.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "strategy", "channels", "rows", "seconds"])
+        writer.writerows(rows)
+
+
+def benchmark_insert(config_path: str, src: str, extensions: list, limit: int, results_folder: str, log: bool,
+                     silent: bool) -> None:
+    """
+    Fingerprints every file found in `src` and inserts its fingerprints with both the generic executemany
+    path and the insert_hashes of the configured database (COPY for postgres), recording the rows per second
+    of each. Every audio inserted is deleted right after, so the database is left as it was.
+    """
+    with open(config_path) as f:
+        djv = Dejavu(json.load(f))
+    methods = {"executemany": CommonDatabase.insert_hashes, djv.db.type: type(djv.db).insert_hashes}
+
+    rows = []
+    totals = {method: [0, 0.0] for method in methods}
+    for file_name, _ in decoder.find_files(src, extensions):
+        channels, fs, file_hash = decoder.read(file_name, limit)
+        hashes = set()
+        for channel in channels:
+            hashes |= set(fingerprint(channel, Fs=fs))
+        hashes = list(hashes)
+
+        for method, insert_hashes in methods.items():
+            audio_id = uuid.uuid1().hex
+            djv.db.insert_audios(audio_id, f"benchmark {basename(file_name)}", file_hash, len(hashes))
+            t = time.time()
+            insert_hashes(djv.db, audio_id, hashes)
+            elapsed = time.time() - t
+            djv.db.delete_audios_by_id([audio_id])
+
+            totals[method][0] += len(hashes)
+            totals[method][1] += elapsed
+            rows_per_second = round(len(hashes) / elapsed) if elapsed else 0
+            rows.append((basename(file_name), method, len(hashes), round(elapsed, 3), rows_per_second))
+            log_msg(f"{basename(file_name)} [{method}]: {len(hashes)} rows in {round(elapsed, 3)} seconds "
+                    f"({rows_per_second} rows/s)", log=log, silent=silent)
+
+    for method, (n_rows, elapsed) in totals.items():
+        rows_per_second = round(n_rows / elapsed) if elapsed else 0
+        log_msg(f"total [{method}]: {n_rows} rows in {round(elapsed, 3)} seconds ({rows_per_second} rows/s)",
+                log=log, silent=silent)
+
+    with open(join(results_folder, "insert.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file", "method", "rows", "seconds", "rows_per_second"])
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs benchmarks for dejavu to evaluate '
+                                                 'the cost of its configuration options.')
+    parser.add_argument("-res", "--results-folder", action="store", default="./dejavu_benchmark_results",
+                        help='Sets the path where the results are saved.')
+    parser.add_argument("-l", "--log", action="store_true", default=False, help='Enables logging.')
+    parser.add_argument("-sl", "--silent", action="store_true", default=False, help='Disables printing.')
+    parser.add_argument("-lf", "--log-file", default="results-benchmark.log",
+                        help='Set the path and filename of the log file.')
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    channels_parser = subparsers.add_parser("channels", help='Rows and ingest time per channel strategy.')
+    channels_parser.add_argument("-lim", "--limit", action="store", default=None, type=int,
+                                 help='Number of seconds to fingerprint from each file.')
+    channels_parser.add_argument("src", type=str, help='Source folder with the audios to fingerprint.')
+    channels_parser.add_argument("extensions", nargs="+", help='Extensions of the audios to fingerprint.')
+
+    insert_parser = subparsers.add_parser("insert", help='Fingerprint rows inserted per second by each '
+                                                         'insert path of the configured database.')
+    insert_parser.add_argument("-c", "--config", required=True, help='Path to the dejavu configuration file.')
+    insert_parser.add_argument("-lim", "--limit", action="store", default=None, type=int,
+                               help='Number of seconds to fingerprint from each file.')
+    insert_parser.add_argument("src", type=str, help='Source folder with the audios to fingerprint.')
+    insert_parser.add_argument("extensions", nargs="+", help='Extensions of the audios to fingerprint.')
+
+    args = parser.parse_args()
+
+    if not exists(args.results_folder):
+        makedirs(args.results_folder)
+
+    if args.log:
+        logging.basicConfig(filename=args.log_file, level=logging.DEBUG)
+
+    if args.benchmark == "channels":
+        benchmark_channels(args.src, args.extensions, args.limit, args.results_folder, args.log, args.silent)
+    elif args.benchmark == "insert":
+        benchmark_insert(args.config, args.src, args.extensions, args.limit, args.results_folder, args.log,
+                         args.silent)
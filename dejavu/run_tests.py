@@ -9,11 +9,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from dejavu.tests.dejavu_test import (DejavuTest, autolabeldoubles,
-                                      generate_test_files, log_msg, set_seed)
+                                      check_peak_finders, generate_test_files,
+                                      log_msg, report_peak_density, set_seed)
 
 
 def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent: bool,
-         log_file: str, padding: int, seed: int, src: str):
+         log_file: str, padding: int, seed: int, src: str, check_peaks: bool = False, config: str = None,
+         peak_density: float = None):
 
     # set random seed if set by user
     set_seed(seed)
@@ -26,6 +28,18 @@ def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent:
     if log:
         logging.basicConfig(filename=log_file, level=logging.DEBUG)
 
+    # check the fast peak finder against the morphology based one
+    if check_peaks:
+        if check_peak_finders(seed):
+            log_msg("peak finders are equivalent", log=log, silent=silent)
+        else:
+            log_msg("peak finders differ, see the log above", log=log, silent=silent)
+            raise SystemExit(1)
+
+    # hashes saved by keeping only peak_density peaks per second
+    if peak_density:
+        report_peak_density(src, peak_density, results_folder, log=log, silent=silent)
+
     # set test seconds
     test_seconds = [f'{i}sec' for i in range(1, seconds + 1, 1)]
 
@@ -37,7 +51,7 @@ def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent:
     log_msg(f"Running Dejavu fingerprinter on files in {src}...", log=log, silent=silent)
 
     tm = time.time()
-    djv = DejavuTest(temp_folder, test_seconds)
+    djv = DejavuTest(temp_folder, test_seconds, config=config)
     log_msg(f"finished obtaining results from dejavu in {(time.time() - tm)}", log=log, silent=silent)
 
     tests = 1  # djv
@@ -72,6 +86,13 @@ def main(seconds: int, results_folder: str, temp_folder: str, log: bool, silent:
             elif djv_match_acc != 0:
                 all_matching_times_counter[col][1][0] += 1
 
+    # recognition accuracy summary
+    for sec in range(0, n_secs):
+        matched = all_match_counter[sec][0][0]
+        log_msg(f"{test_seconds[sec]}: {round(matched * 100 / max(djv.n_lines, 1), 1)}% matched, "
+                f"{round(all_matching_times_counter[sec][0][0] * 100 / max(matched, 1), 1)}% of them at the right "
+                f"offset", log=log, silent=silent)
+
     # create plots
     djv.create_plots('Confidence', all_match_confidence, results_folder)
     djv.create_plots('Query duration', all_query_duration, results_folder)
@@ -158,9 +179,17 @@ if __name__ == '__main__':
     parser.add_argument("-pad", "--padding", action="store", default=10, type=int,
                         help='Number of seconds to pad choice of place to test from.')
     parser.add_argument("-sd", "--seed", action="store", default=None, type=int, help='Random seed.')
+    parser.add_argument("-cp", "--check-peaks", action="store_true", default=False,
+                        help='Checks the separable peak finder against the morphology based one before testing.')
+    parser.add_argument("-c", "--config", action="store", default=None,
+                        help='Configuration file given to dejavu.py to recognize the test files.')
+    parser.add_argument("-pd", "--peak-density", action="store", default=None, type=float,
+                        help='Reports the hashes saved by keeping this amount of peaks per second. The database '
+                             'of the configuration must be fingerprinted with the same peak_density for the '
+                             'accuracy results to reflect it.')
     parser.add_argument("src", type=str, help='Source folder for audios to use as tests.')
 
     args = parser.parse_args()
 
     main(args.seconds, args.results_folder, args.temp_folder, args.log, args.silent, args.log_file, args.padding,
-         args.seed, args.src)
+         args.seed, args.src, args.check_peaks, args.config, args.peak_density)